@@ -2,13 +2,18 @@ from __future__ import annotations
 
 import json
 import os
+from datetime import date
 from typing import Any, Dict, List, Optional
 
 import pandas as pd
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, Field
 
+from src import utils
+from src import wnc
 from src.agg_margins import SIMM
+from src.job_queue import DEFAULT_QUEUE_PATH, JOB_KINDS, JobQueue
+from src.result_store import DEFAULT_STORE_PATH, ResultStore
 
 
 CONFIG_ENV_VAR = "ISDA_SIMM_CONFIG"
@@ -22,6 +27,8 @@ def load_defaults() -> Dict[str, Any]:
         "crif_path": "CRIF/crif.csv",
         "calculation_currency": "USD",
         "exchange_rate": 1.0,
+        "result_store_path": DEFAULT_STORE_PATH,
+        "job_queue_path": DEFAULT_QUEUE_PATH,
     }
 
     if not os.path.exists(config_path):
@@ -66,6 +73,32 @@ class SimmRequest(BaseModel):
         default=True,
         description="Include SIMM breakdown details in the response.",
     )
+    version: Optional[str] = Field(
+        default=None,
+        description="SIMM parameter version from Weights_and_Corr, e.g. v2_6 (defaults to the latest).",
+    )
+    portfolio: Optional[str] = Field(
+        default=None,
+        description="Portfolio id. When given, the result is read from or written to the result store.",
+    )
+    calc_date: Optional[str] = Field(
+        default=None,
+        description="Calculation date of the stored result (defaults to today).",
+    )
+
+
+class JobRequest(BaseModel):
+    """Request payload for queued calculations."""
+
+    kind: str = Field(description=f"Job kind, one of {', '.join(JOB_KINDS)}.")
+    payload: Dict[str, Any] = Field(
+        default_factory=dict,
+        description=(
+            "simm/ageing: records or crif_path, calculation_currency, exchange_rate, version "
+            "(ageing also day_offsets; simm also portfolio, calc_date). "
+            "batch: inputs, output_dir, settings, format, workers, resume."
+        ),
+    )
 
 
 app = FastAPI(
@@ -90,16 +123,99 @@ def calculate_simm(payload: SimmRequest) -> Dict[str, Any]:
     rate = payload.exchange_rate if payload.exchange_rate is not None else defaults["exchange_rate"]
     path = defaults["crif_path"]
 
+    version = payload.version or wnc.DEFAULT_VERSION
+    if version not in wnc.available_versions():
+        raise HTTPException(status_code=400, detail=f"Unknown SIMM version {version}.")
+
     crif = load_crif_dataframe(payload.records, path)
-    portfolio = SIMM(crif, calc_currency, rate)
 
-    response: Dict[str, Any] = {
-        "simm_total": portfolio.simm,
-        "calculation_currency": calc_currency,
-        "exchange_rate": rate,
-    }
+    if payload.portfolio is None:
+        portfolio = SIMM(crif, calc_currency, rate, parameters=wnc.parameter_pack(version))
+        breakdown = portfolio.simm_break_down.reset_index()
+        response: Dict[str, Any] = {
+            "simm_total": portfolio.simm,
+            "calculation_currency": calc_currency,
+            "exchange_rate": rate,
+        }
+    else:
+        # Reuse a stored result for the same portfolio, date, version and input
+        calc_date = payload.calc_date or date.today().isoformat()
+        input_hash = utils.input_hash(crif)
+        with ResultStore(defaults["result_store_path"]) as store:
+            stored = store.latest(
+                portfolio=payload.portfolio, calc_date=calc_date, version=version, input_hash=input_hash,
+                calculation_currency=calc_currency, exchange_rate=float(rate),
+            )
+            if stored is None:
+                portfolio = SIMM(crif, calc_currency, rate, parameters=wnc.parameter_pack(version))
+                run_id = store.save(portfolio, payload.portfolio, calc_date, input_hash=input_hash)
+                stored = store.load(run_id)
+
+        breakdown = stored.simm_break_down
+        response = {
+            "simm_total": stored.simm,
+            "calculation_currency": calc_currency,
+            "exchange_rate": rate,
+            "run_id": stored.run_id,
+        }
 
     if payload.return_breakdown:
-        response["breakdown"] = portfolio.simm_break_down.reset_index().to_dict(orient="records")
+        response["breakdown"] = breakdown.to_dict(orient="records")
 
     return response
+
+
+@app.get("/results")
+def list_results(
+    portfolio: Optional[str] = None,
+    calc_date: Optional[str] = None,
+    version: Optional[str] = None,
+    input_hash: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """List stored SIMM runs matching the given keys, newest first."""
+    defaults = load_defaults()
+    with ResultStore(defaults["result_store_path"]) as store:
+        runs = store.find(portfolio=portfolio, calc_date=calc_date, version=version, input_hash=input_hash)
+    return runs.to_dict(orient="records")
+
+
+@app.get("/results/{run_id}")
+def get_result(run_id: int) -> Dict[str, Any]:
+    """Return a stored SIMM run with its breakdown."""
+    defaults = load_defaults()
+    with ResultStore(defaults["result_store_path"]) as store:
+        stored = store.load(run_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail=f"No stored SIMM run {run_id}.")
+    return stored.to_dict()
+
+
+@app.post("/jobs", status_code=202)
+def submit_job(request: JobRequest) -> Dict[str, Any]:
+    """Queue a SIMM, batch or ageing job for the worker processes."""
+    if request.kind not in JOB_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unsupported job kind {request.kind}.")
+
+    defaults = load_defaults()
+    payload = dict(request.payload)
+    if request.kind in ("simm", "ageing") and not payload.get("records"):
+        payload.setdefault("crif_path", defaults["crif_path"])
+    payload.setdefault("calculation_currency", defaults["calculation_currency"])
+    payload.setdefault("exchange_rate", defaults["exchange_rate"])
+    payload.setdefault("result_store_path", defaults["result_store_path"])
+
+    with JobQueue(defaults["job_queue_path"]) as queue:
+        job_id = queue.submit(request.kind, payload)
+    return {"job_id": job_id, "status": "queued"}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: int) -> Dict[str, Any]:
+    """Return the status, progress and result of a queued job."""
+    defaults = load_defaults()
+    with JobQueue(defaults["job_queue_path"]) as queue:
+        job = queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No job {job_id}.")
+    job.pop("payload")
+    return job
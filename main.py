@@ -1,20 +1,190 @@
+import argparse
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from typing import List, Optional
 
 import pandas as pd
 
+from src import wnc
+from src import utils
 from src.agg_margins import SIMM
 
 
 LOGGER = logging.getLogger(__name__)
 
+# The batch, queue, store, shared memory, snapshot and two-sided modules are imported by the
+# subcommands and flags that use them, so a plain SIMM run does not load sqlite3 or shared_memory
 
-def main() -> None:
-    """Run a SIMM calculation from the sample CRIF file."""
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(description="Calculate ISDA SIMM for a CRIF file.")
+    parser.add_argument("--crif", default="CRIF/crif.csv", help="CRIF file to load.")
+    parser.add_argument("--snapshot", default=None, help="Snapshot directory to load instead of the CRIF file.")
+    parser.add_argument("--currency", default="USD", help="Calculation currency.")
+    parser.add_argument("--rate", type=float, default=1.0, help="Exchange rate multiplier.")
+    parser.add_argument("--version", default=wnc.DEFAULT_VERSION, help="SIMM parameter version, e.g. v2_6.")
+    parser.add_argument("--portfolio", default=None, help="Portfolio id; results are stored when given.")
+    parser.add_argument("--calc-date", default=date.today().isoformat(), help="Calculation date of the stored result.")
+    parser.add_argument("--store", default=None, help="SQLite result store path (default: results/simm_results.db).")
+    parser.add_argument("--from-store", action="store_true", help="Read the latest stored result instead of calculating.")
+    parser.add_argument("--recompute", action="store_true", help="Calculate even if the same input is already stored.")
+    parser.add_argument("--two-sided", action="store_true", help="Calculate both the collect and the post SIMM (not stored).")
+    parser.add_argument("--low-memory", action="store_true", help="Read the CRIF in chunks and keep only its netted sensitivities.")
+
+    subparsers = parser.add_subparsers(dest="command")
+    batch = subparsers.add_parser("batch", help="Calculate SIMM for many CRIF files in parallel.")
+    batch.add_argument("inputs", nargs="+", help="CRIF files, directories or glob patterns (one portfolio per file).")
+    batch.add_argument("--output-dir", default="results/batch", help="Directory for totals.csv and the breakdowns.")
+    batch.add_argument("--currency", dest="batch_currency", default=None, help="Calculation currency of the run.")
+    batch.add_argument("--rate", dest="batch_rate", type=float, default=None, help="Exchange rate of the run.")
+    batch.add_argument("--version", dest="batch_version", default=None, help="SIMM parameter version of the run.")
+    batch.add_argument("--settings", default=None, help="CSV of per-portfolio calculation_currency, exchange_rate, version.")
+    # Same as batch.OUTPUT_FORMATS, spelled out so that parsing does not import the batch module
+    batch.add_argument("--format", choices=("csv", "parquet"), default="csv", help="Breakdown file format.")
+    batch.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per CPU).")
+    batch.add_argument("--no-resume", action="store_true", help="Recalculate files whose input did not change.")
+    batch.add_argument("--threads", action="store_true", help="Use a thread pool instead of worker processes.")
+
+    snapshot = subparsers.add_parser("snapshot", help="Save the netted sensitivities of a CRIF as a memory-mappable snapshot.")
+    snapshot.add_argument("source", help="CRIF file to net.")
+    snapshot.add_argument("output", help="Snapshot directory to write.")
+
+    worker = subparsers.add_parser("worker", help="Run queued jobs (see POST /jobs).")
+    worker.add_argument("--queue", default=None, help="SQLite job queue path (default: results/jobs.db).")
+    worker.add_argument("--processes", type=int, default=1, help="Number of worker processes.")
+    worker.add_argument("--poll", type=float, default=1.0, help="Seconds to wait when the queue is empty.")
+    worker.add_argument("--exit-when-empty", action="store_true", help="Stop once no job is queued.")
+    worker.add_argument("--lease", type=float, default=None,
+                        help="Seconds without a heartbeat after which a running job is queued again (default: 300).")
+    return parser.parse_args(argv)
+
+
+# Thousands separators for display only; the option is scoped so calculations never change pandas state
+def print_breakdown(breakdown: pd.DataFrame) -> None:
+    """Print a SIMM breakdown with formatted amounts."""
+    with pd.option_context('display.float_format', '{:,}'.format):
+        print(breakdown)
+
+
+def main_batch(args: argparse.Namespace) -> None:
+    """Run the batch subcommand."""
+    from src.batch import run_batch
+
+    totals = run_batch(
+        args.inputs,
+        args.output_dir,
+        calculation_currency=args.batch_currency or args.currency,
+        exchange_rate=args.batch_rate if args.batch_rate is not None else args.rate,
+        version=args.batch_version or args.version,
+        settings_path=args.settings,
+        output_format=args.format,
+        workers=args.workers,
+        resume=not args.no_resume,
+        threads=args.threads,
+    )
+    failed = totals[totals['status'] != 'ok']
+    if not failed.empty:
+        raise SystemExit(f"{len(failed)} of {len(totals)} portfolios failed; see {args.output_dir}/totals.csv.")
+
+
+def main_worker(args: argparse.Namespace) -> None:
+    """Run the worker subcommand, optionally in several processes."""
+    from src.job_queue import DEFAULT_LEASE_SECONDS, DEFAULT_QUEUE_PATH, work
+
+    queue = args.queue or DEFAULT_QUEUE_PATH
+    lease = args.lease if args.lease is not None else DEFAULT_LEASE_SECONDS
+    if args.processes <= 1:
+        work(queue, poll_interval=args.poll, exit_when_empty=args.exit_when_empty, lease_seconds=lease)
+        return
+
+    from src.shared_params import SharedParameterPacks, attach_parameter_packs
+
+    with SharedParameterPacks() as packs, ProcessPoolExecutor(
+        max_workers=args.processes, initializer=attach_parameter_packs, initargs=(packs.handles,),
+    ) as pool:
+        futures = [
+            pool.submit(work, queue, args.poll, None, args.exit_when_empty, lease)
+            for _ in range(args.processes)
+        ]
+        processed = sum(future.result() for future in futures)
+    LOGGER.info("Workers processed %d jobs.", processed)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Run a SIMM calculation from a CRIF file, or read it back from the result store."""
     logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
-    path = "CRIF/"
-    LOGGER.info("Loading CRIF data from %s", path)
-    crif = pd.read_csv(f"{path}crif.csv", header=0)
-    portfolio1 = SIMM(crif, "USD", 1)
+    args = parse_args(argv)
+
+    if args.command == "batch":
+        main_batch(args)
+        return
+
+    if args.command == "worker":
+        main_worker(args)
+        return
+
+    if args.command == "snapshot":
+        from src.snapshot import save_snapshot
+
+        save_snapshot(pd.read_csv(args.source, header=0), args.output)
+        return
+
+    if args.from_store:
+        from src.result_store import DEFAULT_STORE_PATH, ResultStore
+
+        store_path = args.store or DEFAULT_STORE_PATH
+        with ResultStore(store_path) as store:
+            stored = store.latest(portfolio=args.portfolio, calc_date=args.calc_date, version=args.version,
+                                  calculation_currency=args.currency, exchange_rate=args.rate)
+        if stored is None:
+            raise SystemExit(f"No stored SIMM result in {store_path} for portfolio={args.portfolio}, calc date {args.calc_date}.")
+        LOGGER.info("Loaded SIMM run %d from %s", stored.run_id, store_path)
+        print(stored.simm)
+        print_breakdown(stored.simm_break_down)
+        return
+
+    if args.snapshot is not None:
+        from src.snapshot import load_snapshot
+
+        LOGGER.info("Loading snapshot from %s", args.snapshot)
+        snapshot = load_snapshot(args.snapshot)
+        crif, input_hash = snapshot.to_crif(), snapshot.input_hash
+    else:
+        LOGGER.info("Loading CRIF data from %s", args.crif)
+        crif = utils.read_crif(args.crif, low_memory=args.low_memory)
+        input_hash = None
+
+    if args.two_sided:
+        from src.two_sided import two_sided_simm
+
+        both = two_sided_simm(crif, args.currency, args.rate, parameters=wnc.parameter_pack(args.version))
+        for side, portfolio in (('Collect', both.collect), ('Post', both.post)):
+            LOGGER.info("%s SIMM: %s", side, portfolio.simm)
+            print(side, portfolio.simm)
+            print_breakdown(portfolio.simm_break_down)
+        return
+
+    if args.portfolio is not None:
+        from src.result_store import DEFAULT_STORE_PATH, ResultStore
+
+        with ResultStore(args.store or DEFAULT_STORE_PATH) as store:
+            input_hash = input_hash or utils.input_hash(crif)
+            stored = None if args.recompute else store.latest(
+                portfolio=args.portfolio, calc_date=args.calc_date, version=args.version, input_hash=input_hash,
+                calculation_currency=args.currency, exchange_rate=args.rate,
+            )
+            if stored is not None:
+                LOGGER.info("Same input already stored as run %d; skipping the calculation.", stored.run_id)
+                print(stored.simm)
+                print_breakdown(stored.simm_break_down)
+                return
+
+            portfolio1 = SIMM(crif, args.currency, args.rate, parameters=wnc.parameter_pack(args.version), low_memory=args.low_memory)
+            store.save(portfolio1, args.portfolio, args.calc_date, input_hash=input_hash)
+    else:
+        portfolio1 = SIMM(crif, args.currency, args.rate, parameters=wnc.parameter_pack(args.version), low_memory=args.low_memory)
 
     # Total SIMM
     LOGGER.info("Total SIMM: %s", portfolio1.simm)
@@ -22,7 +192,7 @@ def main() -> None:
 
     # SIMM Break Down
     LOGGER.info("SIMM breakdown calculated.")
-    print(portfolio1.simm_break_down)
+    print_breakdown(portfolio1.simm_break_down)
 
 
 if __name__ == '__main__':
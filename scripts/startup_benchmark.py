@@ -0,0 +1,73 @@
+"""Measure how fast a fresh interpreter reaches its first SIMM calculation.
+
+Each sample runs in a new process, so module imports are paid every time,
+as in a CLI run or a freshly started API worker:
+
+    python scripts/startup_benchmark.py --repeat 5 --import-budget-ms 800
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+# Modules the engine must not load just to calculate SIMM
+LAZY_MODULES = ['scipy.stats', 'scipy.sparse', 'sqlite3', 'fastapi']
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import src.agg_margins
+imported = time.perf_counter()
+import pandas as pd
+crif = pd.read_csv({crif!r}, header=0)
+src.agg_margins.SIMM(crif, 'USD', 1.0)
+calculated = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - start) * 1000,
+    'first_simm_ms': (calculated - start) * 1000,
+    'loaded': [name for name in {lazy!r} if name in sys.modules],
+}}))
+"""
+
+
+def sample(crif: str) -> dict:
+    """Time one cold start in a new interpreter."""
+    code = PROBE.format(crif=crif, lazy=LAZY_MODULES)
+    output = subprocess.run(
+        [sys.executable, '-c', code], cwd=REPO_ROOT, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='Number of cold starts to sample.')
+    parser.add_argument('--crif', default='CRIF/crif.csv', help='CRIF used for the first calculation.')
+    parser.add_argument('--import-budget-ms', type=float, default=None, help='Fail when the median import time exceeds it.')
+    args = parser.parse_args()
+
+    samples = [sample(args.crif) for _ in range(args.repeat)]
+    import_ms = statistics.median(s['import_ms'] for s in samples)
+    first_simm_ms = statistics.median(s['first_simm_ms'] for s in samples)
+    loaded = sorted({name for s in samples for name in s['loaded']})
+
+    print(f"import src.agg_margins : {import_ms:8.1f} ms (median of {args.repeat})")
+    print(f"first SIMM             : {first_simm_ms:8.1f} ms (import + read CRIF + calculate)")
+    print(f"lazy modules loaded    : {', '.join(loaded) or 'none'}")
+
+    failed = bool(loaded)
+    if args.import_budget_ms is not None and import_ms > args.import_budget_ms:
+        print(f"import time exceeds the {args.import_budget_ms:.0f} ms budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
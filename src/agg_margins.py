@@ -2,85 +2,240 @@ from __future__ import annotations
 
 import logging
 from math import sqrt
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
 from . import wnc
 from . import utils
 from . import dict_margin_by_risk_class
+from .bucket_cache import BucketCache
 from .margin_risk_class import MarginByRiskClass
 
 
+# Margins by risk class and measure in the calculation currency, before exchange rate scaling
+def risk_class_margins(
+    crif: pd.DataFrame,
+    calculation_currency: str,
+    bucket_cache: Optional[BucketCache] = None,
+    parameters: Optional[wnc.ParameterPack] = None,
+) -> Dict[str, Dict[str, float]]:
+    """Calculate the unscaled margin of each risk class and risk measure."""
+    return directional_risk_class_margins(crif, calculation_currency, bucket_cache, parameters, directions=(1,))[1]
+
+
+# Margins of the CRIF as given (direction 1) and with every sensitivity negated (direction -1) in one pass
+def directional_risk_class_margins(
+    crif: pd.DataFrame,
+    calculation_currency: str,
+    bucket_cache: Optional[BucketCache] = None,
+    parameters: Optional[wnc.ParameterPack] = None,
+    directions: Tuple[int, ...] = (1, -1),
+) -> Dict[int, Dict[str, Dict[str, float]]]:
+    """Calculate the unscaled margins by risk class and measure for each direction.
+
+    Delta, vega and base correlation margins are quadratic forms that do
+    not change when every sensitivity is negated, so they are computed
+    once. Curvature reuses its bucket results and only redoes the final
+    max(sum(CVR) + lambda * K, 0) step per direction.
+    """
+    params = parameters or wnc.DEFAULT_PACK
+
+    def compute(crif: pd.DataFrame) -> Dict[int, Dict[str, Dict[str, float]]]:
+        margin = MarginByRiskClass(crif, calculation_currency, bucket_cache=bucket_cache, parameters=params)
+        return margin.margins_by_direction(directions)
+
+    if bucket_cache is None:
+        return compute(crif)
+
+    # Risk classes are margined independently: reuse each one whose rows did not change
+    risk_classes = crif['RiskType'].map(utils.risk_class_of)
+    margins_by_direction: Dict[int, Dict[str, Dict[str, float]]] = {direction: {} for direction in directions}
+    for risk_class in dict_margin_by_risk_class:
+        crif_risk_class = crif[risk_classes == risk_class]
+        if crif_risk_class.empty:
+            for direction in directions:
+                margins_by_direction[direction][risk_class] = empty_margins(risk_class)
+            continue
+
+        # Only FX delta and the rates curvature exception depend on the calculation currency
+        currency_key = calculation_currency if risk_class in ('Rates', 'FX') else None
+        key = (params.version, 'RiskClass', risk_class, currency_key, tuple(directions))
+        margins = bucket_cache.get_or_compute(
+            key,
+            utils.crif_digest(crif_risk_class),
+            lambda: {direction: dict_margins[risk_class] for direction, dict_margins in compute(crif_risk_class).items()},
+        )
+        for direction in directions:
+            margins_by_direction[direction][risk_class] = dict(margins[direction])
+    return margins_by_direction
+
+
+# Margins of a risk class without any rows
+def empty_margins(risk_class: str) -> Dict[str, float]:
+    """Zero margins of a risk class without sensitivities."""
+    return {
+        risk_measure: 0.0 for risk_measure in dict_margin_by_risk_class[risk_class]
+        if risk_measure != 'BaseCorr' or risk_class == 'CreditQ'
+    }
+
+
+def scale_margins(dict_margins: Dict[str, Dict[str, float]], exchange_rate: float) -> Dict[str, Dict[str, float]]:
+    """Convert margins by risk class with the exchange rate."""
+    return {
+        risk_class: {risk_measure: margin * exchange_rate for risk_measure, margin in measures.items()}
+        for risk_class, measures in dict_margins.items()
+    }
+
+
+# SIMM of a product class from its (scaled) margins by risk class and measure
+def product_class_simm(margins: Dict[str, Dict[str, float]], parameters: wnc.ParameterPack) -> float:
+    """Aggregate the risk class margins of a product class with the psi correlations."""
+    dict_simm_risk_class = {}
+    risk_class_list = list(dict_margin_by_risk_class.keys())
+    for risk_class in risk_class_list:
+        simm_risk_class = sum(list(margins[risk_class].values()))
+        dict_simm_risk_class[risk_class] = simm_risk_class
+
+    simm_product = 0
+    for i in range(6):
+        for j in range(6):
+            if i == j:
+                psi = 1
+            else:
+                psi = parameters.psi(risk_class_list[i], risk_class_list[j])
+
+            simm_product +=  psi \
+                          *  dict_simm_risk_class[risk_class_list[i]] \
+                          *  dict_simm_risk_class[risk_class_list[j]]
+
+    return sqrt(simm_product)
+
+
+# Add-on from the fixed amounts and the notional factors of the CRIF
+def notional_addon(crif: pd.DataFrame) -> float:
+    """Calculate add-on margin from the CRIF add-on fields."""
+    crif_factorNotional = crif[(crif['RiskType'].isin(['Param_AddOnNotionalFactor','Notional']))]
+    crif_fixed  = crif[crif['RiskType']=='Param_AddOnFixedAmount']
+
+    addon = crif_fixed['AmountUSD'].sum()
+    qualifier_list = utils.unique_list(crif_factorNotional, 'Qualifier')
+    for qualifier in qualifier_list:
+        crif_qualifier = crif_factorNotional[crif_factorNotional['Qualifier']==qualifier]
+        crif_factor    = crif_qualifier[crif_qualifier['RiskType']=='Param_AddOnNotionalFactor']
+        crif_notional  = crif_qualifier[crif_qualifier['RiskType']=='Notional']
+
+        factor   = crif_factor['AmountUSD'].sum()/100
+        notional = crif_notional['AmountUSD'].sum()
+        addon   += factor * notional
+
+    return addon
+
+
+# Product class multipliers of the CRIF less one, by product class (None without multiplier rows)
+def multiplier_scales(crif: pd.DataFrame) -> Optional[Dict[str, float]]:
+    """Multiplicative add-on scale of each product class with a multiplier row."""
+    if 'Param_ProductClassMultiplier' not in utils.unique_list(crif, 'RiskType'):
+        return None
+    df_ms = crif[crif['RiskType'] == 'Param_ProductClassMultiplier']
+    return {
+        qualifier: utils.sum_sensitivities(df_ms[df_ms['Qualifier'] == qualifier]) - 1
+        for qualifier in utils.unique_list(df_ms, 'Qualifier')
+    }
+
+
+def combine_addon(simm_by_product: Dict[str, float], scales: Optional[Dict[str, float]], notional: float) -> float:
+    """Add-on margin from the SIMM by product class, the multiplier scales and the notional add-on (rounded to cents)."""
+    addon_ms = 0.0  # addon multiplicative scales
+    if scales is not None:
+        # Once any multiplier is given, a product class without one has a multiplier of zero
+        for product_class, simm_prod in simm_by_product.items():
+            addon_ms += simm_prod * scales.get(product_class, -1)
+    return round(addon_ms + notional, 2)
+
+
+# Product class multipliers and notional add-ons on top of the SIMM of each product class
+def total_addon(crif: pd.DataFrame, simm_by_product: Dict[str, float]) -> float:
+    """Add-on margin of a CRIF given its SIMM by product class (rounded to cents)."""
+    return combine_addon(simm_by_product, multiplier_scales(crif), notional_addon(crif))
+
+
+# Unrounded margins of a SIMM run, keyed by (product class, risk class, risk measure)
+def margin_rows(portfolio: SIMM) -> Dict[Tuple[str, str, str], float]:
+    """Flatten a SIMM run into totals by product class, risk class and risk measure ('All' for subtotals)."""
+    rows = {('Total', 'All', 'All'): portfolio.simm}
+    for product_class in utils.product_list(portfolio.crif):
+        margins = portfolio.margins_product_class(product_class)
+        rows[(product_class, 'All', 'All')] = portfolio.simm_product(product_class)
+
+        for risk_class in dict_margin_by_risk_class:
+            rows[(product_class, risk_class, 'All')] = sum(margins[risk_class].values())
+            for risk_measure, margin in margins[risk_class].items():
+                rows[(product_class, risk_class, risk_measure)] = margin
+    return rows
+
+
 class SIMM:
     """Compute SIMM for a CRIF portfolio."""
 
-    def __init__(self, crif: pd.DataFrame, calculation_currency: str, exchange_rate: float) -> None:
-        self.crif = crif
+    def __init__(
+        self,
+        crif: pd.DataFrame,
+        calculation_currency: str,
+        exchange_rate: float,
+        bucket_cache: Optional[BucketCache] = None,
+        parameters: Optional[wnc.ParameterPack] = None,
+        risk_class_margins: Optional[Dict[str, Dict[str, Dict[str, float]]]] = None,
+        low_memory: bool = False,
+    ) -> None:
+        # Low-memory mode keeps only the netted engine columns and no reference to the caller's frame
+        self.low_memory = low_memory
+        self.crif = utils.aggregate_sensitivities(crif) if low_memory else crif
         self.simm = 0.0
         self.simm_break_down = pd.DataFrame()
         self.calc_currency = calculation_currency
         self.exchange_rate = exchange_rate
+        self.bucket_cache = bucket_cache
+        self.params = parameters or wnc.DEFAULT_PACK
+        # Precomputed margins by product class in the calculation currency, before exchange_rate scaling
+        self.risk_class_margins = risk_class_margins or {}
         self.logger = logging.getLogger(self.__class__.__name__)
+        self._margins_by_product: Dict[str, Dict[str, Dict[str, float]]] = {}
         self.calculate_simm()
     
     # Margin by six risk classes (IR, FX, Equity, Commodity, CreditQ, Credit Non-Q)
     def simm_risk_class(self, crif: pd.DataFrame) -> Dict[str, Dict[str, float]]:
         """Calculate SIMM for each risk class."""
-        margin = MarginByRiskClass(crif, self.calc_currency)
-        df_margin_aggregated = margin.IRDeltaMargin()     \
-                             + margin.DeltaMargin()       \
-                             + margin.IRVegaMargin()      \
-                             + margin.VegaMargin()        \
-                             + margin.IRCurvatureMargin() \
-                             + margin.CurvatureMargin()   \
-                             + margin.BaseCorrMargin()
-
-        dict_margins = df_margin_aggregated.to_dict()
-
-        # BaseCorr only presents in the CreditQ
-        for dict_risk_class in dict_margins:
-            if dict_risk_class != 'CreditQ':
-                del dict_margins[dict_risk_class]['BaseCorr']
-
-        for risk_class in dict_margins:
-            for risk_measure in dict_margins[risk_class]:
-                dict_margins[risk_class][risk_measure] *= self.exchange_rate
-        
-        return dict_margins
+        dict_margins = risk_class_margins(crif, self.calc_currency, self.bucket_cache, self.params)
+        return scale_margins(dict_margins, self.exchange_rate)
+
+    def margins_product_class(self, product_class: str) -> Dict[str, Dict[str, float]]:
+        """Margins by risk class and measure for a product class, computed once."""
+        if product_class not in self._margins_by_product:
+            if product_class in self.risk_class_margins:
+                self._margins_by_product[product_class] = scale_margins(self.risk_class_margins[product_class], self.exchange_rate)
+            else:
+                self._margins_by_product[product_class] = self.simm_risk_class(self._product_rows(product_class))
+        return self._margins_by_product[product_class]
+
+    def _product_rows(self, product_class: str) -> pd.DataFrame:
+        """CRIF rows of a product class: a row slice (view) in low-memory mode, a filtered copy otherwise."""
+        if not self.low_memory:
+            return self.crif[(self.crif['ProductClass'] == product_class)]
+        # aggregate_sensitivities keeps the rows of a product class contiguous
+        positions = np.flatnonzero(self.crif['ProductClass'].to_numpy() == product_class)
+        return self.crif.iloc[positions[0]:positions[-1] + 1] if len(positions) else self.crif.iloc[0:0]
 
     # SIMM by product class
     def simm_product(self, product_class: str) -> float:
         """Compute SIMM for a single product class."""
-
-        crif = self.crif[(self.crif['ProductClass'] == product_class)]
-     
-        dict_simm_risk_class = {}
-        risk_class_list = list(dict_margin_by_risk_class.keys())
-        simm_by_risk_class = self.simm_risk_class(crif)
-        for risk_class in risk_class_list:
-            simm_risk_class = sum(list(simm_by_risk_class[risk_class].values()))        
-            dict_simm_risk_class[risk_class] = simm_risk_class
-
-        simm_product = 0
-        for i in range(6):
-            for j in range(6):
-                if i == j:
-                    psi = 1
-                else:
-                    psi = wnc.psi(risk_class_list[i], risk_class_list[j])
-
-                simm_product +=  psi \
-                              *  dict_simm_risk_class[risk_class_list[i]] \
-                              *  dict_simm_risk_class[risk_class_list[j]]
-        
-        return sqrt(simm_product)
+        return product_class_simm(self.margins_product_class(product_class), self.params)
 
     # Calculation by product class as a pivot data frame
     def results_product_class(self, product_class: str) -> pd.DataFrame:
         """Build a SIMM breakdown for a product class."""
-        crif = self.crif[(self.crif['ProductClass'] == product_class)]
-        dict_results = self.simm_risk_class(crif)
+        dict_results = self.margins_product_class(product_class)
 
         df_main = pd.DataFrame(columns=['Risk Class','Risk Measure', 'SIMM_RiskMeasure'])
         df_risk_class = pd.DataFrame(columns=['Risk Class','SIMM_RiskClass'])
@@ -109,26 +264,11 @@ class SIMM:
     
     def addon_margin(self) -> float:
         """Calculate add-on margin from the CRIF add-on fields."""
-        crif_factorNotional = self.crif[(self.crif['RiskType'].isin(['Param_AddOnNotionalFactor','Notional']))]
-        crif_fixed  = self.crif[self.crif['RiskType']=='Param_AddOnFixedAmount']
-
-        addon = crif_fixed['AmountUSD'].sum()
-        qualifier_list = utils.unique_list(crif_factorNotional, 'Qualifier')
-        for qualifier in qualifier_list:
-            crif_qualifier = crif_factorNotional[crif_factorNotional['Qualifier']==qualifier]
-            crif_factor    = crif_qualifier[crif_qualifier['RiskType']=='Param_AddOnNotionalFactor']
-            crif_notional  = crif_qualifier[crif_qualifier['RiskType']=='Notional']
-
-            factor   = crif_factor['AmountUSD'].sum()/100
-            notional = crif_notional['AmountUSD'].sum()
-            addon   += factor * notional
-    
-        return addon
+        return notional_addon(self.crif)
 
     def calculate_simm(self) -> pd.DataFrame:
         """Calculate and store total SIMM and breakdown."""
-        addon_ms   = 0.0  # addon multiplicative scales
-        dict_addon: Dict[str, float] = {}
+        simm_by_product: Dict[str, float] = {}
         df_total = pd.DataFrame()
 
         self.logger.info("Calculating SIMM for %d product classes.", len(utils.product_list(self.crif)))
@@ -140,16 +280,9 @@ class SIMM:
             
             self.simm += simm_prod
             df_total    = pd.concat([df_total, df_prod])
+            simm_by_product[product_class] = simm_prod
 
-            if 'Param_ProductClassMultiplier' in utils.unique_list(self.crif, 'RiskType'):
-                df_ms = self.crif[self.crif['RiskType'] == 'Param_ProductClassMultiplier']
-                df_ms_prod = df_ms[df_ms['Qualifier'] == product_class]
-                ms = utils.sum_sensitivities(df_ms_prod) - 1
-                addon_ms += simm_prod * ms
-            
-            dict_addon[product_class] = simm_prod
-
-        addon_margin = round(addon_ms + self.addon_margin(), 2)
+        addon_margin = total_addon(self.crif, simm_by_product)
         self.simm  += addon_margin
         self.logger.info("Computed add-on margin: %s", addon_margin)
 
@@ -163,8 +296,5 @@ class SIMM:
         else:
             df = pd.pivot_table(df_total, index=['SIMM Total','Product Class','SIMM_ProductClass','Risk Class','SIMM_RiskClass','Risk Measure'])
 
-        pd.set_option('float_format', '{:f}'.format)
-        pd.set_option('float_format', '{:,}'.format)
-
         self.simm_break_down = df.copy()
         return df
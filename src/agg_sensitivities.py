@@ -5,19 +5,224 @@ import math
 from typing import Iterable, List, Optional
 
 import numpy as np
+import pandas as pd
 
-from . import wnc
+from . import kernels, wnc
 from . import (
     list_creditQ,
     list_credit_nonQ,
     list_equity,
     list_commodity,
     list_fx,
+    simm_tenor_list,
 )
 
 LOGGER = logging.getLogger(__name__)
 
 
+# Cross-bucket aggregation as one quadratic form instead of a double loop over buckets
+def cross_bucket_k_squared(
+    list_K: Iterable[float],
+    list_S: Iterable[float],
+    gamma: float | np.ndarray,
+    list_CR: Optional[Iterable[float]] = None,
+) -> float:
+    """sum_b K_b^2 + sum_{b != c} gamma_bc * S_b * S_c * g_bc.
+
+    ``gamma`` is a scalar or a matrix over the buckets. With ``list_CR``
+    the concentration factor g_bc = min(CR_b, CR_c) / max(CR_b, CR_c) is
+    applied, otherwise g_bc = 1.
+    """
+    K = np.asarray(list(list_K), dtype='float64')
+    S = np.asarray(list(list_S), dtype='float64')
+    weights = np.array(np.broadcast_to(np.asarray(gamma, dtype='float64'), (len(S), len(S))))
+    if list_CR is not None:
+        CR = np.asarray(list(list_CR), dtype='float64')
+        weights *= np.minimum.outer(CR, CR) / np.maximum.outer(CR, CR)
+    np.fill_diagonal(weights, 0)
+    return float(np.dot(K, K) + S @ weights @ S)
+
+
+# sum_{i != j} min(CR_i, CR_j) / max(CR_i, CR_j) * x_i * x_j, sorted by CR instead of over all pairs
+def _concentration_pair_sum(values: np.ndarray, concentration: np.ndarray, groups: Optional[np.ndarray] = None) -> float:
+    """Pair sum weighted by the concentration ratio, restricted to pairs in the same group if given.
+
+    With the entries sorted by CR, the ratio of a pair i < j is CR_i / CR_j,
+    so the sum is 2 * sum_j (x_j / CR_j) * sum_{i < j} CR_i x_i: a prefix
+    sum per group after an O(n log n) sort (see kernels.sorted_pair_sum).
+    """
+    if len(values) < 2:
+        return 0.0
+    if groups is None:
+        # Most names are below the threshold (CR == 1): their pairs have ratio 1 among
+        # themselves and 1 / CR_j with the others, so only the remainder needs sorting
+        ones = concentration == 1
+        if ones.any():
+            x_ones, x_rest, cr_rest = values[ones], values[~ones], concentration[~ones]
+            sum_ones = float(x_ones.sum())
+            return (
+                sum_ones * sum_ones - float(np.dot(x_ones, x_ones))
+                + 2.0 * sum_ones * float(np.sum(x_rest / cr_rest))
+                + _concentration_pair_sum(x_rest, cr_rest)
+            )
+        groups = np.zeros(len(values), dtype='int64')
+    order = np.lexsort((concentration, groups))
+    return kernels.sorted_pair_sum(values[order], concentration[order], groups[order])
+
+
+# Rates delta: correlation = tenor correlation x subcurve correlation, bordered by Inf and XCcy
+def rates_delta_k_squared(
+    list_WS: Iterable[float],
+    tenor: Iterable[str],
+    index: Iterable[str],
+    params: wnc.ParameterPack,
+) -> float:
+    """Quadratic form of a rates delta currency bucket from its (subcurve x tenor) WS matrix.
+
+    Curve entries correlate by rho(tenor) * phi(subcurve), so with W the
+    subcurve x tenor matrix and R the 12 x 12 tenor correlations the curve
+    part is (1 - phi) * sum_s W_s R W_s' + phi * (sum_s W_s) R (sum_s W_s)'.
+    Inflation and cross-currency basis entries add border terms against the
+    curve total.
+    """
+    ws = np.asarray(list(list_WS), dtype='float64')
+    if len(ws) < 2:
+        return float(np.dot(ws, ws))
+    index = np.asarray(list(index), dtype=object)
+    tenors = list(tenor)
+
+    inflation = index == 'Inf'
+    xccy = index == 'XCcy'
+    curve = ~(inflation | xccy)
+
+    tenor_codes = {label: code for code, label in enumerate(simm_tenor_list)}
+    columns = [tenor_codes[tenors[i]] for i in np.flatnonzero(curve)]
+    rows, subcurves = pd.factorize(index[curve])
+    W = np.zeros((len(subcurves), len(simm_tenor_list)))
+    np.add.at(W, (rows, columns), ws[curve])
+
+    R = params.tenor_correlation_matrix()
+    phi = params.sub_curves_corr
+    W_total = W.sum(axis=0)
+    curve_part = (1 - phi) * float(np.einsum('st,tu,su->', W, R, W)) + phi * float(W_total @ R @ W_total)
+
+    S_curve = float(W_total.sum())
+    S_inflation = float(ws[inflation].sum())
+    S_xccy = float(ws[xccy].sum())
+    return (
+        curve_part
+        + S_inflation**2
+        + S_xccy**2
+        + 2 * params.inflation_corr * S_inflation * S_curve
+        + 2 * params.ccy_basis_spread_corr * S_xccy * (S_curve + S_inflation)
+    )
+
+
+# Rates vega and curvature: tenor correlations bordered by the inflation volatility entries
+def rates_vol_k_squared(
+    values: Iterable[float],
+    index: Iterable[str],
+    params: wnc.ParameterPack,
+    squared: bool = False,
+) -> float:
+    """sum_k x_k^2 + sum_{k != l} rho_kl * x_k * x_l of a rates vol currency bucket.
+
+    Entries are labelled by tenor or 'Inf'; rho is the tenor correlation,
+    ``inflation_corr`` against 'Inf' and 1 between 'Inf' entries. With
+    ``squared`` (curvature) rho_kl^2 is used.
+    """
+    x = np.asarray(list(values), dtype='float64')
+    labels = list(simm_tenor_list) + ['Inf']
+    label_codes = {label: code for code, label in enumerate(labels)}
+    codes = np.array([label_codes[label] for label in index], dtype='int64')
+
+    corr = np.ones((len(labels), len(labels)))
+    corr[:-1, :-1] = params.tenor_correlation_matrix()
+    corr[:-1, -1] = corr[-1, :-1] = params.inflation_corr
+    if squared:
+        corr = corr**2
+    return float(np.dot(x, x)) + kernels.labelled_pair_sum(x, codes, corr)
+
+
+# Credit correlations only depend on same issuer / different issuer / residual
+def credit_k_squared(
+    values: Iterable[float],
+    concentration: Iterable[float],
+    index: Iterable[str],
+    rho_same: float,
+    rho_different: float,
+    rho_residual: float,
+) -> float:
+    """sum_i x_i^2 + sum_{i != j} rho_ij * f_ij * x_i * x_j for credit buckets, in O(n log n).
+
+    rho_ij is ``rho_residual`` when either index is 'Res', ``rho_same`` for
+    equal indices and ``rho_different`` otherwise; f_ij is the concentration
+    ratio min(CR) / max(CR) (pass ones for curvature).
+    """
+    x = np.asarray(list(values), dtype='float64')
+    cr = np.asarray(list(concentration), dtype='float64')
+    index = np.asarray(list(index), dtype=object)
+
+    residual = index == 'Res'
+    x_named, cr_named = x[~residual], cr[~residual]
+    issuers = pd.factorize(index[~residual])[0]
+
+    pairs_named = _concentration_pair_sum(x_named, cr_named)
+    pairs_all = _concentration_pair_sum(x, cr) if residual.any() else pairs_named
+    pairs_same = _concentration_pair_sum(x_named, cr_named, issuers)
+
+    return (
+        float(np.dot(x, x))
+        + rho_residual * (pairs_all - pairs_named)
+        + rho_different * (pairs_named - pairs_same)
+        + rho_same * pairs_same
+    )
+
+
+# Equity, commodity and FX vega buckets: one correlation, pairs only differ by their concentration ratio
+def concentration_k_squared(values: Iterable[float], concentration: Iterable[float], rho: float) -> float:
+    """sum_i x_i^2 + rho * sum_{i != j} f_ij * x_i * x_j with f_ij = min(CR) / max(CR), in O(n log n)."""
+    x = np.asarray(list(values), dtype='float64')
+    cr = np.asarray(list(concentration), dtype='float64')
+    return float(np.dot(x, x)) + rho * _concentration_pair_sum(x, cr)
+
+
+def _fx_delta_k_squared(
+    values: List[float],
+    concentration: List[float],
+    currencies: List[str],
+    calculation_currency: str,
+    params: wnc.ParameterPack,
+) -> float:
+    """FX delta quadratic form: correlations depend on the high/regular volatility group of each currency."""
+    x = np.asarray(values, dtype='float64')
+    cr = np.asarray(concentration, dtype='float64')
+    high = np.array([currency in params.high_vol_currency_group for currency in currencies], dtype=bool)
+    corr = params.fx_high_vol_corr if calculation_currency in params.high_vol_currency_group else params.fx_reg_vol_corr
+
+    pairs_all = _concentration_pair_sum(x, cr)
+    pairs_high = _concentration_pair_sum(x[high], cr[high])
+    pairs_regular = _concentration_pair_sum(x[~high], cr[~high])
+    # Each cross pair appears once in each order
+    rho_cross = (corr['High']['Regular'] + corr['Regular']['High']) / 2
+
+    return (
+        float(np.dot(x, x))
+        + corr['High']['High'] * pairs_high
+        + corr['Regular']['Regular'] * pairs_regular
+        + rho_cross * (pairs_all - pairs_high - pairs_regular)
+    )
+
+
+def _credit_correlations(risk_class: str, params: wnc.ParameterPack) -> tuple:
+    """(same issuer, different issuer, residual) correlations of a credit risk class."""
+    return (
+        params.rho(risk_class, 'issuer', 'issuer'),
+        params.rho(risk_class, 'issuer', 'other'),
+        params.rho(risk_class, 'Res', 'Res'),
+    )
+
+
 def k_delta(
     risk_class: str,
     list_WS: Iterable[float],
@@ -26,9 +231,11 @@ def k_delta(
     tenor: Optional[Iterable[str]] = None,
     index: Optional[Iterable[str]] = None,
     calculation_currency: str = 'USD',
+    params: Optional[wnc.ParameterPack] = None,
 ) -> float:
     """Aggregate weighted sensitivities for delta margin."""
 
+    params = params or wnc.DEFAULT_PACK
     list_ws = list(list_WS)
     list_cr = list(list_CR) if list_CR is not None else []
     list_bucket = list(bucket) if isinstance(bucket, (list, tuple)) else []
@@ -36,78 +243,23 @@ def k_delta(
     list_tenor = list(tenor) if tenor is not None else []
     list_index = list(index) if index is not None else []
 
-    K = sum([np.array([WS], dtype='double')[0]**2 for WS in list_ws]) # numpy is used due to overflow issue
-    for i, _ in enumerate(list_ws):
-        for j, _ in enumerate(list_ws):
-            if i == j:
-                continue
-            else:    
-                # Rates
-                if risk_class == 'Rates':
-
-                    if (list_index[i] == list_index[j]):
-                        phi = 1
-                    
-                    elif (list_index[i] == 'XCcy') or (list_index[j] == 'XCcy'):
-                        phi = wnc.ccy_basis_spread_corr
-
-                    elif (list_index[i] == 'Inf') or (list_index[j] == 'Inf'):
-                        phi = wnc.inflation_corr
-
-                    else:
-                        phi = wnc.sub_curves_corr
-
-                    if (list_index[i] not in ['Inf','XCcy']) and (list_index[j] not in ['Inf','XCcy']):
-                        rho = wnc.rho('Risk_IRCurve', list_tenor[i], list_tenor[j])
-
-                    else:
-                        rho = 1                   
-                
-                # Credit
-                elif risk_class in list_creditQ + list_credit_nonQ:
-                    rho = wnc.rho(risk_class, list_index[i], list_index[j])
-                    
-                # Equity, Commodity, FX
-                else:
-                    if risk_class in list_equity + list_commodity:
-                        rho = wnc.rho(risk_class, bucket=bucket_value)
-
-                    elif risk_class in list_fx:
-                                        
-                        currency1 = list_bucket[i]
-                        currency2 = list_bucket[j]
-
-                        is_ccy1_high_vol = currency1 in wnc.high_vol_currency_group
-                        is_ccy2_high_vol = currency2 in wnc.high_vol_currency_group
-
-                        if calculation_currency not in wnc.high_vol_currency_group:
-                            if (is_ccy1_high_vol==True) and (is_ccy2_high_vol==True):
-                                rho = wnc.fx_reg_vol_corr['High']['High']
-                            elif (is_ccy1_high_vol==True) and (is_ccy2_high_vol==False):
-                                rho = wnc.fx_reg_vol_corr['High']['Regular']
-                            elif (is_ccy1_high_vol==False) and (is_ccy2_high_vol==True):
-                                rho = wnc.fx_reg_vol_corr['Regular']['High']
-                            else:
-                                rho = wnc.fx_reg_vol_corr['Regular']['Regular']
-                        else:
-                            if (is_ccy1_high_vol==True) and (is_ccy2_high_vol==True):
-                                rho = wnc.fx_high_vol_corr['High']['High']
-                            elif (is_ccy1_high_vol==True) and (is_ccy2_high_vol==False):
-                                rho = wnc.fx_high_vol_corr['High']['Regular']
-                            elif (is_ccy1_high_vol==False) and (is_ccy2_high_vol==True):
-                                rho = wnc.fx_high_vol_corr['Regular']['High']
-                            else:
-                                rho = wnc.fx_high_vol_corr['Regular']['Regular']
-                    
-                if risk_class == 'Rates':
-                    f = 1
-                
-                else:
-                    f = min(list_cr[i], list_cr[j]) / max(list_cr[i], list_cr[j])
-                    phi = 1
-
-                K += rho * list_ws[i] * list_ws[j] * phi * f
-    
+    # Each risk class has a structured kernel; none enumerates the pairs
+    if risk_class == 'Rates':
+        K = rates_delta_k_squared(list_ws, list_tenor, list_index, params)
+
+    elif risk_class in list_creditQ + list_credit_nonQ:
+        K = credit_k_squared(list_ws, list_cr, list_index, *_credit_correlations(risk_class, params))
+
+    elif risk_class in list_equity + list_commodity:
+        rho = params.rho(risk_class, bucket=bucket_value) if len(list_ws) > 1 else 0.0
+        K = concentration_k_squared(list_ws, list_cr, rho)
+
+    elif risk_class in list_fx:
+        K = _fx_delta_k_squared(list_ws, list_cr, list_bucket, calculation_currency, params)
+
+    else:
+        raise KeyError(f"Unsupported risk class for k_delta: {risk_class}")
+
     LOGGER.debug("Computed k_delta for %s: %s", risk_class, K)
     return math.sqrt(K)
     
@@ -118,9 +270,11 @@ def k_vega(
     VCR: Optional[Iterable[float]] = None,
     bucket: Optional[str] = None,
     index: Iterable[str] | str = '',
+    params: Optional[wnc.ParameterPack] = None,
 ) -> float:
     """Aggregate vega sensitivities."""
 
+    params = params or wnc.DEFAULT_PACK
     list_vr = list(VR)
     list_vcr = list(VCR) if VCR is not None else []
     if index == '': # duplicate '' for the iteration
@@ -128,39 +282,22 @@ def k_vega(
     else:
         list_index = list(index)
 
-    K = sum([vr**2 for vr in list_vr])
-    for k, (VR_k, index_k) in enumerate(zip(list_vr, list_index)):
-        for l, (VR_l, index_l) in enumerate(zip(list_vr, list_index)):
-            if k == l:
-                continue
-
-            else:
-                if risk_class == 'Rates':
-                    
-                    if (index_k == 'Inf') and (index_l == 'Inf'):
-                        rho = 1
-
-                    elif (index_k == 'Inf') or (index_l == 'Inf'):
-                        rho = wnc.inflation_corr
+    # Each risk class has a structured kernel; none enumerates the pairs
+    if risk_class == 'Rates':
+        K = rates_vol_k_squared(list_vr, list_index, params)
 
-                    else:
-                        rho = wnc.rho('Risk_IRVol', index_k, index_l)
+    elif risk_class in ['Risk_CreditVol', 'Risk_CreditVolNonQ']:
+        K = credit_k_squared(list_vr, list_vcr, list_index, *_credit_correlations(risk_class, params))
 
-                elif risk_class in list_equity + list_commodity:
-                    rho = wnc.rho(risk_class,bucket=bucket)
+    elif risk_class in list_equity + list_commodity + list_fx:
+        if len(list_vr) < 2:
+            rho = 0.0
+        else:
+            rho = params.fx_vega_corr if risk_class in list_fx else params.rho(risk_class, bucket=bucket)
+        K = concentration_k_squared(list_vr, list_vcr, rho)
 
-                elif risk_class in list_fx:
-                    rho = wnc.fx_vega_corr
-
-                elif risk_class in ['Risk_CreditVol', 'Risk_CreditVolNonQ']:
-                    rho = wnc.rho(risk_class, index_k, index_l)
-                    
-                if risk_class == 'Rates':
-                    f = 1
-                else:
-                    f = min(list_vcr[k], list_vcr[l]) / max(list_vcr[k], list_vcr[l])
-                
-                K += f * rho * VR_k * VR_l
+    else:
+        raise KeyError(f"Unsupported risk class for k_vega: {risk_class}")
 
     LOGGER.debug("Computed k_vega for %s: %s", risk_class, K)
     return math.sqrt(K)
@@ -171,44 +308,30 @@ def k_curvature(
     CVR_list: Iterable[float],
     bucket: Optional[str] = None,
     index: Optional[Iterable[str]] = None,
+    params: Optional[wnc.ParameterPack] = None,
 ) -> float:
     """Aggregate curvature sensitivities."""
 
+    params = params or wnc.DEFAULT_PACK
     list_cvr = list(CVR_list)
     list_index = list(index) if index is not None else []
 
-    K = sum([CVR**2 for CVR in list_cvr])
-    for k, _ in enumerate(list_cvr):
-        for l, _ in enumerate(list_cvr):
-
-            if k == l:
-                continue
+    if risk_class == 'Rates':
+        K = rates_vol_k_squared(list_cvr, list_index, params, squared=True)
 
-            else:
-                if risk_class == 'Rates':
+    elif risk_class in ['Risk_CreditVol', 'Risk_CreditVolNonQ']:
+        rho_same, rho_different, rho_residual = _credit_correlations(risk_class, params)
+        K = credit_k_squared(list_cvr, np.ones(len(list_cvr)), list_index, rho_same**2, rho_different**2, rho_residual**2)
 
-                    if (list_index[k] == 'Inf') and (list_index[l] == 'Inf'):
-                        rho = 1
+    elif risk_class in list_equity + list_commodity + list_fx:
+        if len(list_cvr) < 2:
+            rho = 0.0
+        else:
+            rho = params.fx_vega_corr if risk_class in list_fx else params.rho(risk_class, bucket=bucket)
+        K = concentration_k_squared(list_cvr, np.ones(len(list_cvr)), rho**2)
 
-                    elif (list_index[k] == 'Inf') or (list_index[l] == 'Inf'):
-                        rho = wnc.inflation_corr
-
-                    else:
-                        rho = wnc.rho('Risk_IRVol', list_index[k], list_index[l])
-
-                        
-                elif risk_class in list_equity + list_commodity:
-                    rho = wnc.rho(risk_class,bucket=bucket)
-                    
-                elif risk_class in list_fx:
-                    rho = wnc.fx_vega_corr
-
-
-                elif risk_class in ['Risk_CreditVol', 'Risk_CreditVolNonQ']:
-
-                    rho = wnc.rho(risk_class, list_index[k], list_index[l])
-
-                K += (rho**2) * list_cvr[k] * list_cvr[l]
+    else:
+        raise KeyError(f"Unsupported risk class for k_curvature: {risk_class}")
 
     LOGGER.debug("Computed k_curvature for %s: %s", risk_class, K)
     return math.sqrt(K)
@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import glob
+import hashlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+import pandas as pd
+
+from . import wnc
+from .shared_params import SharedParameterPacks, attach_parameter_packs
+
+
+LOGGER = logging.getLogger(__name__)
+
+CRIF_SUFFIXES = ('.csv',)
+OUTPUT_FORMATS = ('csv', 'parquet')
+MANIFEST_NAME = 'totals.csv'
+MANIFEST_COLUMNS = [
+    'portfolio', 'input_path', 'input_hash', 'calculation_currency', 'exchange_rate', 'version',
+    'simm_total', 'breakdown_path', 'status', 'error',
+]
+
+
+@dataclass
+class BatchTask:
+    """One CRIF file of a batch and the settings it is margined with."""
+
+    portfolio: str
+    input_path: str
+    input_hash: str
+    calculation_currency: str
+    exchange_rate: float
+    version: str
+    breakdown_path: str
+
+
+def file_hash(path: str | Path) -> str:
+    """Digest of a file's bytes, used to skip unchanged inputs."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def expand_inputs(patterns: Iterable[str]) -> List[Path]:
+    """Resolve files, directories (their CRIF files) and glob patterns, without duplicates."""
+    paths: List[Path] = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(str(path) for path in Path(pattern).iterdir() if path.suffix.lower() in CRIF_SUFFIXES)
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True)) or ([pattern] if os.path.isfile(pattern) else [])
+        if not matches:
+            LOGGER.warning("No CRIF files match %s", pattern)
+        paths.extend(Path(match) for match in matches)
+    return list(dict.fromkeys(paths))
+
+
+def load_settings(path: Optional[str]) -> Dict[str, Dict[str, object]]:
+    """Per-portfolio overrides (portfolio, calculation_currency, exchange_rate, version) keyed by portfolio."""
+    if path is None:
+        return {}
+    settings = pd.read_csv(path, dtype={'portfolio': str})
+    if 'portfolio' not in settings.columns:
+        raise ValueError(f"Settings file {path} must have a 'portfolio' column.")
+    columns = [column for column in ('calculation_currency', 'exchange_rate', 'version') if column in settings.columns]
+    return {
+        row['portfolio']: {column: row[column] for column in columns if pd.notna(row[column])}
+        for row in settings.to_dict(orient='records')
+    }
+
+
+def _write(frame: pd.DataFrame, path: str) -> None:
+    if path.endswith('.parquet'):
+        frame.to_parquet(path, index=False)
+    else:
+        frame.to_csv(path, index=False)
+
+
+def run_task(task: BatchTask) -> Dict[str, object]:
+    """Margin one CRIF file and write its breakdown (runs in a worker process or thread)."""
+    from .agg_margins import SIMM
+
+    row: Dict[str, object] = asdict(task)
+    try:
+        crif = pd.read_csv(task.input_path, header=0)
+        portfolio = SIMM(crif, task.calculation_currency, task.exchange_rate,
+                         parameters=wnc.parameter_pack(task.version))
+        breakdown = portfolio.simm_break_down.reset_index()
+        breakdown.insert(0, 'Portfolio', task.portfolio)
+        _write(breakdown, task.breakdown_path)
+        row.update(simm_total=portfolio.simm, status='ok', error='')
+    except Exception as error:  # one bad file must not stop the batch
+        LOGGER.exception("SIMM failed for %s", task.input_path)
+        row = _failed_row(task, error)
+    return row
+
+
+def _failed_row(task: BatchTask, error: BaseException) -> Dict[str, object]:
+    row: Dict[str, object] = asdict(task)
+    row.update(simm_total=float('nan'), status='failed', error=f"{type(error).__name__}: {error}")
+    return row
+
+
+def _write_manifest(rows: Dict[str, Dict[str, object]], path: Path) -> pd.DataFrame:
+    totals = pd.DataFrame(sorted(rows.values(), key=lambda row: str(row['portfolio'])), columns=MANIFEST_COLUMNS)
+    # Replace the manifest atomically so an interrupted write never leaves it truncated
+    partial = path.with_name(path.name + '.tmp')
+    totals.to_csv(partial, index=False)
+    os.replace(partial, path)
+    return totals
+
+
+def run_batch(
+    inputs: Iterable[str],
+    output_dir: str | Path,
+    calculation_currency: str = 'USD',
+    exchange_rate: float = 1.0,
+    version: str = wnc.DEFAULT_VERSION,
+    settings_path: Optional[str] = None,
+    output_format: str = 'csv',
+    workers: Optional[int] = None,
+    resume: bool = True,
+    progress: Optional[Callable[[int, int], None]] = None,
+    threads: bool = False,
+) -> pd.DataFrame:
+    """Margin every CRIF file under ``inputs`` and write totals and breakdowns to ``output_dir``.
+
+    Each file is a portfolio named after its file stem. ``totals.csv`` in
+    the output directory lists every portfolio with its input hash and
+    settings; with ``resume`` a portfolio whose file and settings are
+    unchanged since the last successful run is skipped. The manifest is
+    also written when the batch stops early, so finished portfolios are not
+    recalculated on the next run. ``progress(done, total)`` is called as
+    files finish. With ``threads`` the files are
+    margined by a thread pool of this process instead of worker processes.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format {output_format}; use one of {OUTPUT_FORMATS}.")
+    if output_format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError as error:
+            raise ImportError("Parquet output requires pyarrow (pip install pyarrow).") from error
+
+    output_dir = Path(output_dir)
+    breakdown_dir = output_dir / 'breakdowns'
+    breakdown_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = output_dir / MANIFEST_NAME
+
+    previous: Dict[str, Dict[str, object]] = {}
+    if resume and manifest_path.exists():
+        manifest = pd.read_csv(manifest_path, dtype={'portfolio': str}, keep_default_na=False)
+        previous = {row['portfolio']: row for row in manifest.to_dict(orient='records')}
+
+    overrides = load_settings(settings_path)
+    tasks: List[BatchTask] = []
+    rows: Dict[str, Dict[str, object]] = {}
+    for path in expand_inputs(inputs):
+        portfolio = path.stem
+        if portfolio in rows or any(task.portfolio == portfolio for task in tasks):
+            raise ValueError(f"Two CRIF files map to portfolio {portfolio}; file stems must be unique.")
+
+        settings = overrides.get(portfolio, {})
+        task = BatchTask(
+            portfolio=portfolio,
+            input_path=str(path),
+            input_hash=file_hash(path),
+            calculation_currency=str(settings.get('calculation_currency', calculation_currency)),
+            exchange_rate=float(settings.get('exchange_rate', exchange_rate)),
+            version=str(settings.get('version', version)),
+            breakdown_path=str(breakdown_dir / f"{portfolio}.{output_format}"),
+        )
+
+        done = previous.get(portfolio)
+        if (
+            done is not None and done['status'] == 'ok'
+            and done['input_hash'] == task.input_hash
+            and done['calculation_currency'] == task.calculation_currency
+            and float(done['exchange_rate']) == task.exchange_rate
+            and done['version'] == task.version
+            and done['breakdown_path'] == task.breakdown_path
+            and os.path.exists(task.breakdown_path)
+        ):
+            rows[portfolio] = done
+        else:
+            tasks.append(task)
+
+    LOGGER.info("Batch of %d CRIF files: %d unchanged, %d to calculate.", len(rows) + len(tasks), len(rows), len(tasks))
+
+    total = len(rows) + len(tasks)
+    # Until a task finishes its previous manifest row is kept, so an interrupted batch resumes where it stopped
+    manifest_rows = {**rows, **{task.portfolio: previous[task.portfolio] for task in tasks if task.portfolio in previous}}
+    try:
+        if workers == 1 or len(tasks) <= 1:
+            for task in tasks:
+                rows[task.portfolio] = manifest_rows[task.portfolio] = run_task(task)
+                if progress is not None:
+                    progress(len(rows), total)
+        else:
+            with ExitStack() as stack:
+                if threads:
+                    # Threads share this process's parameter packs
+                    pool = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+                else:
+                    # Workers attach the correlation tables from shared memory instead of building their own
+                    versions = sorted({task.version for task in tasks} & set(wnc.available_versions()))
+                    packs = stack.enter_context(SharedParameterPacks(versions))
+                    pool = stack.enter_context(ProcessPoolExecutor(
+                        max_workers=workers, initializer=attach_parameter_packs, initargs=(packs.handles,),
+                    ))
+                futures = {pool.submit(run_task, task): task for task in tasks}
+                try:
+                    for future in as_completed(futures):
+                        task = futures[future]
+                        try:
+                            row = future.result()
+                        except Exception as error:  # a dead worker (e.g. BrokenProcessPool) fails its task only
+                            LOGGER.error("SIMM failed for %s: %s", task.input_path, error)
+                            row = _failed_row(task, error)
+                        rows[task.portfolio] = manifest_rows[task.portfolio] = row
+                        if progress is not None:
+                            progress(len(rows), total)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+    finally:
+        # Write whatever finished, also when the batch is interrupted
+        totals = _write_manifest(manifest_rows, manifest_path)
+
+    failed = int((totals['status'] != 'ok').sum())
+    LOGGER.info("Batch finished: %d portfolios, %d failed; totals in %s", len(totals), failed, manifest_path)
+    return totals
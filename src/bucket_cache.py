@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BucketCache:
+    """Bucket-level margin results keyed by the content of the bucket rows.
+
+    A result is looked up by its bucket key (risk type, risk measure, bucket,
+    ...) plus a digest of the CRIF rows it was computed from, so SIMM runs on
+    similar portfolios (consecutive ageing horizons, day-over-day snapshots)
+    recompute only the buckets whose rows changed. Least recently used
+    entries are evicted beyond ``max_entries``.
+
+    The cache can be shared by SIMM runs in several threads: lookups and
+    inserts hold a lock, while results are computed outside of it (two
+    threads missing the same key both compute it, with the same result).
+    """
+
+    def __init__(self, max_entries: Optional[int] = 65536) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._results: OrderedDict[Tuple[Hashable, ...], Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def get_or_compute(self, key: Tuple[Hashable, ...], digest: str, compute: Callable[[], Any]) -> Any:
+        """Return the cached result for a bucket key and row digest, computing it on a miss."""
+        full_key = key + (digest,)
+        with self._lock:
+            if full_key in self._results:
+                self.hits += 1
+                self._results.move_to_end(full_key)
+                return self._results[full_key]
+            self.misses += 1
+
+        result = compute()
+        with self._lock:
+            self._results[full_key] = result
+            if self.max_entries is not None and len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+        return result
+
+    def clear(self) -> None:
+        """Drop every cached result and reset the counters."""
+        with self._lock:
+            self._results.clear()
+            self.hits = 0
+            self.misses = 0
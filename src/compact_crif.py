@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import copy
+import logging
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from . import utils
+from . import dict_margin_by_risk_class, simm_tenor_list
+
+
+LOGGER = logging.getLogger(__name__)
+
+RISK_CLASSES: List[str] = list(dict_margin_by_risk_class) + ['AddOn']
+
+# Bucket codes: SIMM buckets keep their number, Residual is 0
+RESIDUAL = 0
+MISSING = -1
+UNPARSEABLE = -2
+
+
+def _bucket_code(value: object) -> int:
+    """Integer code of a CRIF Bucket value (1, '1', 1.0 -> 1; 'Residual' -> 0)."""
+    if isinstance(value, str):
+        if value == 'Residual':
+            return RESIDUAL
+        return int(value) if value.isdigit() and str(int(value)) == value else UNPARSEABLE
+    if value is None or pd.isna(value):
+        return MISSING
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return UNPARSEABLE
+    return int(number) if number.is_integer() else UNPARSEABLE
+
+
+def equals(codes: np.ndarray, code: int) -> np.ndarray:
+    """Rows with the given code; a missing value (-1) matches nothing, as NaN == NaN is False."""
+    return codes == code if code != MISSING else np.zeros(len(codes), dtype=bool)
+
+
+def _dictionary(values: pd.Series, dtype: str) -> tuple:
+    """Dictionary-encode a column: (codes, distinct values); missing values get -1."""
+    codes, uniques = pd.factorize(values, use_na_sentinel=True)
+    return codes.astype(dtype), np.asarray(uniques, dtype=object)
+
+
+@dataclass
+class CompactCRIF:
+    """Integer-coded view of a CRIF, aligned row by row with the frame it was built from.
+
+    RiskType, ProductClass, Qualifier and Label2 are dictionary-encoded,
+    risk classes index ``RISK_CLASSES``, buckets are their SIMM number
+    (Residual 0, missing -1) and tenors index ``simm_tenor_list`` (-1 when
+    Label1 is not a SIMM tenor; matched exactly, as the string comparisons
+    of the engine). Row selections are array comparisons
+    instead of string comparisons.
+    """
+
+    risk_type: np.ndarray
+    risk_class: np.ndarray
+    product_class: np.ndarray
+    qualifier: np.ndarray
+    bucket: np.ndarray
+    tenor: np.ndarray
+    label2: np.ndarray
+    amount_usd: np.ndarray
+    risk_types: np.ndarray
+    product_classes: np.ndarray
+    qualifiers: np.ndarray
+    label2_values: np.ndarray
+
+    def __post_init__(self) -> None:
+        self._risk_type_codes: Dict[object, int] = {value: code for code, value in enumerate(self.risk_types)}
+        self._qualifier_codes: Dict[object, int] = {value: code for code, value in enumerate(self.qualifiers)}
+        self._label2_codes: Dict[object, int] = {value: code for code, value in enumerate(self.label2_values)}
+
+    @classmethod
+    def from_crif(cls, crif: pd.DataFrame) -> CompactCRIF:
+        """Encode a CRIF once at ingest."""
+        n_rows = len(crif)
+        column = lambda name: crif[name] if name in crif.columns else pd.Series([np.nan] * n_rows, index=crif.index)
+
+        risk_type, risk_types = _dictionary(column('RiskType'), 'int16')
+        product_class, product_classes = _dictionary(column('ProductClass'), 'int8')
+        qualifier, qualifiers = _dictionary(column('Qualifier'), 'int32')
+        label2, label2_values = _dictionary(column('Label2'), 'int16')
+
+        # Trailing -1 so that a missing risk type (code -1) maps to no risk class
+        class_codes = np.array([RISK_CLASSES.index(utils.risk_class_of(value)) for value in risk_types] + [MISSING], dtype='int8')
+        risk_class = class_codes[risk_type]
+
+        tenor_codes = {tenor: code for code, tenor in enumerate(simm_tenor_list)}
+        tenor = np.array(
+            [tenor_codes.get(label, -1) if isinstance(label, str) else -1 for label in column('Label1')],
+            dtype='int8',
+        )
+        bucket = np.array([_bucket_code(value) for value in column('Bucket')], dtype='int16')
+        amount_usd = column('AmountUSD').to_numpy(dtype='float64', na_value=np.nan)
+
+        return cls(risk_type, risk_class, product_class, qualifier, bucket, tenor, label2, amount_usd,
+                   risk_types, product_classes, qualifiers, label2_values)
+
+    def __len__(self) -> int:
+        return len(self.risk_type)
+
+    def risk_type_code(self, risk_type: str) -> int:
+        return self._risk_type_codes.get(risk_type, MISSING)
+
+    def qualifier_code(self, qualifier: object) -> int:
+        return self._qualifier_codes.get(qualifier, MISSING)
+
+    def label2_code(self, label2: object) -> int:
+        return self._label2_codes.get(label2, MISSING)
+
+    def take(self, mask: np.ndarray) -> CompactCRIF:
+        """Codes of the selected rows, aligned with ``crif[mask]``; the dictionaries are shared."""
+        subset = copy.copy(self)
+        for name in ('risk_type', 'risk_class', 'product_class', 'qualifier', 'bucket', 'tenor', 'label2', 'amount_usd'):
+            setattr(subset, name, getattr(self, name)[mask])
+        return subset
+
+    def amount(self, mask: np.ndarray) -> float:
+        """AmountUSD summed over the selected rows (missing amounts skipped, as utils.sum_sensitivities)."""
+        return float(np.nansum(self.amount_usd[mask]))
+
+    def mask(
+        self,
+        risk_types: Optional[str | Iterable[str]] = None,
+        bucket: Optional[int] = None,
+        qualifier: Optional[object] = None,
+    ) -> np.ndarray:
+        """Boolean row mask; bucket 0 selects the Residual bucket."""
+        selected = np.ones(len(self), dtype=bool)
+        if risk_types is not None:
+            names = [risk_types] if isinstance(risk_types, str) else list(risk_types)
+            # Lookup table over the risk type dictionary; the trailing slot catches missing (-1) codes
+            wanted = np.zeros(len(self.risk_types) + 1, dtype=bool)
+            wanted[[self.risk_type_code(name) for name in names if self.risk_type_code(name) != MISSING]] = True
+            selected &= wanted[self.risk_type]
+        if bucket is not None:
+            selected &= self.bucket == bucket
+        if qualifier is not None:
+            selected &= equals(self.qualifier, self.qualifier_code(qualifier))
+        return selected
+
+    def bucket_list(self, mask: np.ndarray) -> List[int]:
+        """Distinct buckets of the selected rows, Residual as 0 (as utils.bucket_list)."""
+        buckets = self.bucket[mask]
+        if (buckets == UNPARSEABLE).any():
+            raise ValueError("CRIF Bucket values must be SIMM bucket numbers or 'Residual'.")
+        return list(set(int(bucket) for bucket in buckets[buckets != MISSING]))
+
+    def tenors(self, mask: np.ndarray) -> List[int]:
+        """Distinct SIMM tenor codes of the selected rows, in tenor order."""
+        tenors = self.tenor[mask]
+        return [int(code) for code in np.unique(tenors[tenors >= 0])]
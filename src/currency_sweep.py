@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import logging
+from copy import deepcopy
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from . import utils
+from . import wnc
+from .agg_margins import SIMM, risk_class_margins
+from .bucket_cache import BucketCache
+from .margin_risk_class import MarginByRiskClass
+
+
+LOGGER = logging.getLogger(__name__)
+
+CurrencyRate = Tuple[str, float]
+Margins = Dict[str, Dict[str, float]]
+
+
+@dataclass
+class CurrencySweep:
+    """SIMM of one portfolio for several (calculation currency, exchange rate) pairs."""
+
+    results: pd.DataFrame
+    portfolios: Dict[CurrencyRate, SIMM] = field(default_factory=dict, repr=False)
+
+    def simm(self, calculation_currency: str, exchange_rate: float) -> float:
+        """Total SIMM for one swept pair."""
+        return self.portfolios[(calculation_currency, exchange_rate)].simm
+
+
+# Only the FX delta margin and the inflation-vol curvature exception depend on the calculation currency
+def currency_dependent_margins(
+    crif: pd.DataFrame,
+    calculation_currency: str,
+    bucket_cache: Optional[BucketCache] = None,
+    parameters: Optional[wnc.ParameterPack] = None,
+) -> Margins:
+    """Recalculate the margins of a product class that depend on the calculation currency."""
+    updates: Margins = {}
+    if 'Risk_FX' in utils.unique_list(crif, 'RiskType'):
+        crif_fx = crif[crif['RiskType'] == 'Risk_FX']
+        margin = MarginByRiskClass(crif_fx, calculation_currency, bucket_cache=bucket_cache, parameters=parameters)
+        updates['FX'] = {'Delta': margin.DeltaMargin()['FX']['Delta']}
+
+    if 'Risk_InflationVol' in utils.unique_list(crif, 'RiskType'):
+        margin = MarginByRiskClass(crif, calculation_currency, bucket_cache=bucket_cache, parameters=parameters)
+        updates['Rates'] = {'Curvature': margin.IRCurvatureMargin()['Rates']['Curvature']}
+
+    return updates
+
+
+def sweep_currencies(
+    crif: pd.DataFrame,
+    currency_rates: Sequence[CurrencyRate],
+    bucket_cache: Optional[BucketCache] = None,
+    parameters: Optional[wnc.ParameterPack] = None,
+) -> CurrencySweep:
+    """Calculate SIMM for each (calculation currency, exchange rate) pair.
+
+    Margins by risk class are calculated once for the first currency; the
+    other currencies only recalculate the currency-dependent margins and
+    every pair only rescales by its exchange rate.
+    """
+    currency_rates = [(currency, rate) for currency, rate in currency_rates]
+    if not currency_rates:
+        raise ValueError("At least one (calculation currency, exchange rate) pair is required.")
+
+    bucket_cache = bucket_cache if bucket_cache is not None else BucketCache()
+    product_crifs = {
+        product_class: crif[crif['ProductClass'] == product_class]
+        for product_class in utils.product_list(crif)
+    }
+
+    base_currency = currency_rates[0][0]
+    base_margins = {
+        product_class: risk_class_margins(crif_product, base_currency, bucket_cache, parameters)
+        for product_class, crif_product in product_crifs.items()
+    }
+
+    margins_by_currency: Dict[str, Dict[str, Margins]] = {base_currency: base_margins}
+    portfolios: Dict[CurrencyRate, SIMM] = {}
+    rows: List[Dict[str, float]] = []
+    for currency, rate in currency_rates:
+        if currency not in margins_by_currency:
+            margins_by_currency[currency] = {}
+            for product_class, crif_product in product_crifs.items():
+                margins = deepcopy(base_margins[product_class])
+                updates = currency_dependent_margins(crif_product, currency, bucket_cache, parameters)
+                for risk_class, measures in updates.items():
+                    margins[risk_class].update(measures)
+                margins_by_currency[currency][product_class] = margins
+
+        portfolio = SIMM(
+            crif,
+            currency,
+            rate,
+            bucket_cache=bucket_cache,
+            parameters=parameters,
+            risk_class_margins=margins_by_currency[currency],
+        )
+        portfolios[(currency, rate)] = portfolio
+        rows.append({'Currency': currency, 'ExchangeRate': rate, 'SIMM': portfolio.simm})
+
+    LOGGER.info(
+        "Swept %d currency/rate pairs over %d currencies (bucket cache: %d hits, %d misses).",
+        len(currency_rates), len(margins_by_currency), bucket_cache.hits, bucket_cache.misses,
+    )
+    return CurrencySweep(pd.DataFrame(rows).set_index(['Currency', 'ExchangeRate']), portfolios)
@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+import pandas as pd
+
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_PATH = "results/jobs.db"
+
+JOB_KINDS = ('simm', 'batch', 'ageing')
+
+# A running job whose lease is not renewed within this time is taken as abandoned by a dead worker
+DEFAULT_LEASE_SECONDS = 300
+# Claims per job before an abandoned job is failed instead of queued again
+MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id      INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind        TEXT NOT NULL,
+    payload     TEXT NOT NULL,
+    status      TEXT NOT NULL DEFAULT 'queued',
+    progress    REAL NOT NULL DEFAULT 0,
+    result      TEXT,
+    error       TEXT,
+    worker      TEXT,
+    created_at  TEXT NOT NULL,
+    started_at  TEXT,
+    finished_at TEXT,
+    lease_until TEXT,
+    attempts    INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, job_id);
+"""
+
+# Columns added after the first schema, created on queues made by older versions
+MIGRATIONS = {
+    'lease_until': "ALTER TABLE jobs ADD COLUMN lease_until TEXT",
+    'attempts': "ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+}
+
+Progress = Callable[[int, int], None]
+
+
+def _now(seconds: float = 0) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat(timespec='seconds')
+
+
+@dataclass
+class Job:
+    """A queued calculation."""
+
+    job_id: int
+    kind: str
+    payload: Dict[str, Any]
+
+
+class JobQueue:
+    """Persistent SQLite queue of SIMM, batch and ageing jobs.
+
+    The API enqueues jobs and reads their status; worker processes claim
+    them one at a time (the claim runs in an immediate transaction, so two
+    workers never take the same job) and record progress and results.
+    A claimed job holds a lease of ``lease_seconds`` that progress updates
+    and heartbeats renew; when it runs out the job is queued again, or
+    failed after ``MAX_ATTEMPTS`` claims.
+    """
+
+    def __init__(self, path: str | Path = DEFAULT_QUEUE_PATH, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> None:
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds
+        if self.path.parent != Path('.'):
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(SCHEMA)
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(jobs)")}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                self.connection.execute(statement)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> JobQueue:
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def submit(self, kind: str, payload: Dict[str, Any]) -> int:
+        """Enqueue a job and return its id."""
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unsupported job kind {kind}; use one of {JOB_KINDS}.")
+        cursor = self.connection.execute(
+            "INSERT INTO jobs (kind, payload, created_at) VALUES (?, ?, ?)",
+            (kind, json.dumps(payload), _now()),
+        )
+        LOGGER.info("Queued %s job %d", kind, cursor.lastrowid)
+        return int(cursor.lastrowid)
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Status, progress and (once finished) the result or error of a job."""
+        cursor = self.connection.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        job = dict(zip([column[0] for column in cursor.description], row))
+        job['payload'] = json.loads(job['payload'])
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    def claim(self, worker: str) -> Optional[Job]:
+        """Take the oldest queued job, or None when the queue is empty."""
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._release_expired()
+            row = self.connection.execute(
+                "SELECT job_id, kind, payload FROM jobs WHERE status = 'queued' ORDER BY job_id LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                self.connection.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, started_at = ?, lease_until = ?, "
+                    "attempts = attempts + 1 WHERE job_id = ?",
+                    (worker, _now(), _now(self.lease_seconds), row[0]),
+                )
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        return Job(int(row[0]), row[1], json.loads(row[2])) if row is not None else None
+
+    def _release_expired(self) -> None:
+        # Runs inside the claim transaction
+        now = _now()
+        expired = self.connection.execute(
+            "SELECT job_id, worker, attempts FROM jobs WHERE status = 'running' AND lease_until < ?", (now,)
+        ).fetchall()
+        for job_id, worker, attempts in expired:
+            if attempts >= MAX_ATTEMPTS:
+                LOGGER.warning("Job %d lost its worker %s %d times; failing it", job_id, worker, attempts)
+                self.connection.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, lease_until = NULL WHERE job_id = ?",
+                    (f"Lease expired after {attempts} attempts; last worker {worker}", now, job_id),
+                )
+            else:
+                LOGGER.warning("Job %d lost its worker %s; queueing it again", job_id, worker)
+                self.connection.execute(
+                    "UPDATE jobs SET status = 'queued', progress = 0, worker = NULL, lease_until = NULL WHERE job_id = ?",
+                    (job_id,),
+                )
+
+    def heartbeat(self, job_id: int) -> None:
+        """Renew the lease of a running job."""
+        self.connection.execute(
+            "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND status = 'running'",
+            (_now(self.lease_seconds), job_id),
+        )
+
+    def set_progress(self, job_id: int, progress: float) -> None:
+        self.connection.execute(
+            "UPDATE jobs SET progress = ?, lease_until = ? WHERE job_id = ? AND status = 'running'",
+            (float(progress), _now(self.lease_seconds), job_id),
+        )
+
+    def complete(self, job_id: int, result: Any) -> None:
+        self.connection.execute(
+            "UPDATE jobs SET status = 'done', progress = 1, result = ?, finished_at = ?, lease_until = NULL "
+            "WHERE job_id = ?",
+            (json.dumps(result, default=str), _now(), job_id),
+        )
+
+    def fail(self, job_id: int, error: str) -> None:
+        self.connection.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, lease_until = NULL WHERE job_id = ?",
+            (error, _now(), job_id),
+        )
+
+
+def _load_crif(payload: Dict[str, Any]) -> pd.DataFrame:
+    if payload.get('records'):
+        return pd.DataFrame(payload['records'])
+    if payload.get('crif_path'):
+        return pd.read_csv(payload['crif_path'], header=0)
+    raise ValueError("Job payload needs 'records' or 'crif_path'.")
+
+
+def _run_simm(payload: Dict[str, Any], progress: Progress) -> Dict[str, Any]:
+    from . import wnc
+    from .agg_margins import SIMM
+
+    currency = payload.get('calculation_currency', 'USD')
+    rate = float(payload.get('exchange_rate', 1.0))
+    version = payload.get('version') or wnc.DEFAULT_VERSION
+    portfolio = SIMM(_load_crif(payload), currency, rate, parameters=wnc.parameter_pack(version))
+
+    result: Dict[str, Any] = {'simm_total': portfolio.simm, 'calculation_currency': currency, 'exchange_rate': rate}
+    if payload.get('portfolio'):
+        from .result_store import DEFAULT_STORE_PATH, ResultStore
+
+        calc_date = payload.get('calc_date') or datetime.now(timezone.utc).date().isoformat()
+        with ResultStore(payload.get('result_store_path') or DEFAULT_STORE_PATH) as store:
+            result['run_id'] = store.save(portfolio, payload['portfolio'], calc_date)
+    if payload.get('return_breakdown', True):
+        result['breakdown'] = portfolio.simm_break_down.reset_index().to_dict(orient='records')
+    return result
+
+
+def _run_batch(payload: Dict[str, Any], progress: Progress) -> Dict[str, Any]:
+    from . import wnc
+    from .batch import run_batch
+
+    totals = run_batch(
+        payload['inputs'],
+        payload.get('output_dir', 'results/batch'),
+        calculation_currency=payload.get('calculation_currency', 'USD'),
+        exchange_rate=float(payload.get('exchange_rate', 1.0)),
+        version=payload.get('version') or wnc.DEFAULT_VERSION,
+        settings_path=payload.get('settings'),
+        output_format=payload.get('format', 'csv'),
+        workers=payload.get('workers'),
+        resume=payload.get('resume', True),
+        progress=progress,
+    )
+    return {'totals': totals.to_dict(orient='records')}
+
+
+def _run_ageing(payload: Dict[str, Any], progress: Progress) -> Dict[str, Any]:
+    from . import wnc
+    from .mva import aged_simm_profile
+
+    profile = aged_simm_profile(
+        _load_crif(payload),
+        payload.get('day_offsets', [0]),
+        payload.get('calculation_currency', 'USD'),
+        float(payload.get('exchange_rate', 1.0)),
+        parameters=wnc.parameter_pack(payload.get('version') or wnc.DEFAULT_VERSION),
+        progress=progress,
+    )
+    return {'profile': [{'Days': days, 'SIMM': simm} for days, simm in profile.items()]}
+
+
+HANDLERS: Dict[str, Callable[[Dict[str, Any], Progress], Dict[str, Any]]] = {
+    'simm': _run_simm,
+    'batch': _run_batch,
+    'ageing': _run_ageing,
+}
+
+
+def _keep_leased(path: Path, lease_seconds: float, job_id: int, stop: threading.Event) -> None:
+    # Own connection: SQLite connections stay in the thread that opened them
+    with JobQueue(path, lease_seconds) as queue:
+        while not stop.wait(lease_seconds / 3):
+            queue.heartbeat(job_id)
+
+
+def run_job(queue: JobQueue, job: Job) -> None:
+    """Run a claimed job and record its result, or its error.
+
+    A heartbeat thread renews the job's lease while it runs, so only a job
+    whose worker died is claimed again.
+    """
+    LOGGER.info("Running %s job %d", job.kind, job.job_id)
+    report = lambda done, total: queue.set_progress(job.job_id, done / total if total else 1.0)
+    stop = threading.Event()
+    heartbeat = threading.Thread(
+        target=_keep_leased, args=(queue.path, queue.lease_seconds, job.job_id, stop), daemon=True,
+    )
+    heartbeat.start()
+    try:
+        result = HANDLERS[job.kind](job.payload, report)
+    except Exception as error:  # a failing job must not stop the worker
+        LOGGER.exception("Job %d failed", job.job_id)
+        queue.fail(job.job_id, f"{type(error).__name__}: {error}")
+    else:
+        queue.complete(job.job_id, result)
+        LOGGER.info("Finished %s job %d", job.kind, job.job_id)
+    finally:
+        stop.set()
+        heartbeat.join()
+
+
+def work(
+    path: str | Path = DEFAULT_QUEUE_PATH,
+    poll_interval: float = 1.0,
+    max_jobs: Optional[int] = None,
+    exit_when_empty: bool = False,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+) -> int:
+    """Worker loop: claim and run jobs until stopped; returns the number of jobs run."""
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    processed = 0
+    with JobQueue(path, lease_seconds) as queue:
+        while max_jobs is None or processed < max_jobs:
+            job = queue.claim(worker)
+            if job is None:
+                if exit_when_empty:
+                    break
+                time.sleep(poll_interval)
+                continue
+            run_job(queue, job)
+            processed += 1
+    return processed
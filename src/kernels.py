@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import logging
+import os
+from functools import lru_cache
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Set to 1 to always use the NumPy kernels, even when Numba is installed
+ENV_DISABLE_JIT = "ISDA_SIMM_DISABLE_JIT"
+
+
+@lru_cache(maxsize=1)
+def _numba() -> Optional[Any]:
+    """The numba module, or None if it is not installed or disabled (imported on first use)."""
+    if os.getenv(ENV_DISABLE_JIT, "").strip().lower() in ("1", "true", "yes"):
+        LOGGER.debug("JIT kernels disabled by %s", ENV_DISABLE_JIT)
+        return None
+    try:
+        import numba
+    except ImportError:
+        LOGGER.debug("Numba is not installed, using the NumPy kernels")
+        return None
+    return numba
+
+
+def jit_available() -> bool:
+    """True if the pairwise sums run as compiled Numba kernels."""
+    return _numba() is not None
+
+
+@lru_cache(maxsize=None)
+def _compiled(loop: Callable) -> Callable:
+    # cache=True keeps the machine code next to the module, so only the first process compiles
+    return _numba().njit(cache=True, nogil=True)(loop)
+
+
+def _dispatch(loop: Callable, fallback: Callable) -> Callable:
+    """Use the compiled loop when Numba is available, otherwise the NumPy fallback."""
+    return _compiled(loop) if jit_available() else fallback
+
+
+# Concentration-weighted pair sum over entries sorted by (group, CR)
+
+def _sorted_pair_sum_loop(x: np.ndarray, cr: np.ndarray, group: np.ndarray) -> float:
+    total = 0.0
+    before = 0.0
+    for j in range(len(x)):
+        if j > 0 and group[j] != group[j - 1]:
+            before = 0.0
+        total += x[j] / cr[j] * before
+        before += cr[j] * x[j]
+    return 2.0 * total
+
+
+def _sorted_pair_sum_numpy(x: np.ndarray, cr: np.ndarray, group: np.ndarray) -> float:
+    weighted = cr * x
+    before = np.cumsum(weighted) - weighted
+    # Restart the prefix sums at each group
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    before -= np.repeat(before[starts], np.diff(np.r_[starts, len(x)]))
+    return 2.0 * float(np.dot(x / cr, before))
+
+
+def sorted_pair_sum(x: np.ndarray, cr: np.ndarray, group: np.ndarray) -> float:
+    """sum_{i != j, same group} min(CR_i, CR_j) / max(CR_i, CR_j) * x_i * x_j.
+
+    The entries must be sorted by group, then by CR, so the ratio of a pair
+    i < j is CR_i / CR_j and the sum is a running prefix sum per group. The
+    compiled loop restarts the running sum at each group instead of
+    subtracting group offsets from one global cumulative sum.
+    """
+    if len(x) < 2:
+        return 0.0
+    x = np.ascontiguousarray(x, dtype='float64')
+    cr = np.ascontiguousarray(cr, dtype='float64')
+    group = np.ascontiguousarray(group, dtype='int64')
+    return float(_dispatch(_sorted_pair_sum_loop, _sorted_pair_sum_numpy)(x, cr, group))
+
+
+# Pair sum with a correlation looked up by label code
+
+def _labelled_pair_sum_loop(x: np.ndarray, codes: np.ndarray, corr: np.ndarray) -> float:
+    totals = np.zeros(corr.shape[0])
+    diagonal = 0.0
+    for i in range(len(x)):
+        totals[codes[i]] += x[i]
+        diagonal += corr[codes[i], codes[i]] * x[i] * x[i]
+    total = 0.0
+    for a in range(corr.shape[0]):
+        for b in range(corr.shape[0]):
+            total += corr[a, b] * totals[a] * totals[b]
+    return total - diagonal
+
+
+def _labelled_pair_sum_numpy(x: np.ndarray, codes: np.ndarray, corr: np.ndarray) -> float:
+    totals = np.bincount(codes, weights=x, minlength=corr.shape[0])
+    diagonal = float(np.dot(corr[codes, codes] * x, x))
+    return float(totals @ corr @ totals) - diagonal
+
+
+def labelled_pair_sum(x: np.ndarray, codes: np.ndarray, corr: np.ndarray) -> float:
+    """sum_{i != j} corr[code_i, code_j] * x_i * x_j.
+
+    Entries sharing a label are summed first, so the pairs reduce to a
+    quadratic form over the labels minus the i == j terms.
+    """
+    if len(x) < 2:
+        return 0.0
+    x = np.ascontiguousarray(x, dtype='float64')
+    codes = np.ascontiguousarray(codes, dtype='int64')
+    corr = np.ascontiguousarray(corr, dtype='float64')
+    return float(_dispatch(_labelled_pair_sum_loop, _labelled_pair_sum_numpy)(x, codes, corr))
@@ -2,19 +2,22 @@ from __future__ import annotations
 
 import logging
 from copy import deepcopy
-from math import isnan, sqrt
-from typing import Dict, List
+from math import sqrt
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
-from scipy.stats import norm
 
 from . import utils
 from . import wnc
 from .agg_sensitivities import (
+    cross_bucket_k_squared,
     k_delta, 
     k_vega, 
     k_curvature
 )
+from .bucket_cache import BucketCache
+from .compact_crif import MISSING, CompactCRIF, equals
 from . import (
     dict_margin_by_risk_class,
     dict_margin_by_risk_class,
@@ -24,158 +27,238 @@ from . import (
     list_creditQ,
     list_equity,
     list_commodity,
+    simm_tenor_list,
 )
 
 LOGGER = logging.getLogger(__name__)
 
 
+# Zero margins by risk class and measure (a fresh copy of dict_margin_by_risk_class)
+def _zero_margins() -> Dict[str, Dict[str, float]]:
+    return {risk_class: dict(measures) for risk_class, measures in dict_margin_by_risk_class.items()}
+
+
+# Sum of margin dicts, typed as the sum of their frames: a risk class is float once any of its margins is
+def _add_margins(margins: List[Dict[str, Dict[str, float]]]) -> Dict[str, Dict[str, float]]:
+    total = {}
+    for risk_class, measures in dict_margin_by_risk_class.items():
+        values = {risk_measure: sum(updates[risk_class][risk_measure] for updates in margins) for risk_measure in measures}
+        if any(isinstance(value, float) for value in values.values()):
+            values = {risk_measure: float(value) for risk_measure, value in values.items()}
+        total[risk_class] = values
+    return total
+
+
 class MarginByRiskClass:
     """Aggregate margins by SIMM risk class."""
 
-    def __init__(self, crif: pd.DataFrame, calculation_currency: str) -> None:
+    def __init__(
+        self,
+        crif: pd.DataFrame,
+        calculation_currency: str,
+        bucket_cache: Optional[BucketCache] = None,
+        parameters: Optional[wnc.ParameterPack] = None,
+        codes: Optional[CompactCRIF] = None,
+        row_hashes: Optional[pd.Series] = None,
+    ) -> None:
         self.crif = crif
-        self.results = dict_margin_by_risk_class
+        self.results = deepcopy(dict_margin_by_risk_class)
         self.calculation_currency = calculation_currency
+        self.bucket_cache = bucket_cache
+        self.params = parameters or wnc.DEFAULT_PACK
         self.list_risk_types = utils.unique_list(self.crif, 'RiskType')
+        # Callers margining many subsets of one CRIF pass its codes and row hashes instead
+        self.codes = codes if codes is not None else CompactCRIF.from_crif(self.crif)
+        self._row_hashes: Optional[pd.Series] = row_hashes
+        self._vol_results: Dict[Tuple, Any] = {}
+
+    # Row selection on the integer codes instead of string comparisons
+    def _rows(self, risk_types: str | List[str], bucket: Optional[int] = None, qualifier: Optional[str] = None) -> pd.DataFrame:
+        """CRIF rows of the given risk types, optionally of one bucket (0 = Residual) or qualifier."""
+        return self.crif[self.codes.mask(risk_types, bucket=bucket, qualifier=qualifier)]
+
+    def _coded_rows(
+        self, risk_types: str | List[str], bucket: Optional[int] = None, qualifier: Optional[str] = None,
+    ) -> Tuple[pd.DataFrame, CompactCRIF]:
+        """As _rows, with the integer codes of the selected rows."""
+        selected = self.codes.mask(risk_types, bucket=bucket, qualifier=qualifier)
+        return self.crif[selected], self.codes.take(selected)
+
+    # Bucket-level results (K_b, S_b, ...) are reused from the cache when the bucket rows did not change
+    def _bucket(self, key: Tuple, rows: pd.DataFrame | np.ndarray, compute: Callable[[], Any]) -> Any:
+        """Compute a bucket-level result, or reuse it from the bucket cache (rows: a frame or a mask of the CRIF)."""
+        if self.bucket_cache is None:
+            return compute()
+
+        # Hash every row once, then digest buckets from their slice of the row hashes
+        if self._row_hashes is None and self.crif.index.is_unique:
+            self._row_hashes = utils.row_hashes(self.crif)
+        if isinstance(rows, np.ndarray):
+            # A cached bucket never builds its rows: the index picks its row hashes
+            rows = self.crif[rows] if self._row_hashes is None else self.crif.index[rows]
+        digest = utils.crif_digest(rows, self._row_hashes)
+        return self.bucket_cache.get_or_compute((self.params.version,) + key, digest, compute)
+
+    # Vega and curvature read the same vol rows: each vol bucket is grouped once and serves both margins
+    def _vol(self, key: Tuple, select: Callable[[], np.ndarray], compute: Callable[[pd.DataFrame], Any]) -> Any:
+        """(vega, curvature) results of a vol bucket, computed by whichever of the two margins runs first."""
+        if key not in self._vol_results:
+            selected = select()
+            self._vol_results[key] = self._bucket(key, selected, lambda: compute(self.crif[selected]))
+        return self._vol_results[key]
+
+    def _ir_vol_currencies(self) -> List[str]:
+        """Currencies with rates vol rows (the other currencies add nothing to IR vega or curvature)."""
+        return utils.unique_list(self._rows(['Risk_IRVol','Risk_InflationVol']), 'Qualifier')
+
+    def _ir_vol(self, currency: str) -> Tuple:
+        """Rates vol results of a currency (see _ir_vol_currency)."""
+        return self._vol(
+            ('Rates', 'Vol', currency),
+            lambda: self.codes.mask(['Risk_IRVol','Risk_InflationVol'], qualifier=currency),
+            lambda crif_currency: self._ir_vol_currency(crif_currency, currency),
+        )
+
+    def _vol_measures(self, risk_class: str, bucket: Optional[int] = None) -> Tuple:
+        """Vol results of an FX risk class (see _fx_vol) or of a credit, equity or commodity bucket (see _vol_bucket)."""
+        if risk_class in list_fx:
+            return self._vol((risk_class, 'Vol'), lambda: self.codes.mask(risk_class), self._fx_vol)
+        return self._vol(
+            (risk_class, 'Vol', bucket),
+            lambda: self.codes.mask(risk_class, bucket=bucket),
+            lambda crif_bucket: self._vol_bucket(risk_class, bucket, crif_bucket),
+        )
 
     # Delta Margin for Rates Risk Classes Only (Risk_IRCurve, Risk_Inflation, Risk_XCcyBasis)
     def IRDeltaMargin(self) -> pd.DataFrame:
         """Delta margin for rates risk classes only."""
-        updates = deepcopy(dict_margin_by_risk_class)
+        return pd.DataFrame(self._ir_delta_margins())
+
+    def _ir_delta_margins(self) -> Dict[str, Dict[str, float]]:
+        """IRDeltaMargin by risk class and measure."""
+        updates = _zero_margins()
 
         # Skip any risk types other than rates
         if ('Risk_IRCurve'   not in self.list_risk_types) and \
            ('Risk_Inflation' not in self.list_risk_types) and \
            ('Risk_XCcyBasis' not in self.list_risk_types):
             LOGGER.debug("No rates risk types found; IR delta margin is zero.")
-            return pd.DataFrame(updates)
+            return updates
 
         else:
             dict_CR: Dict[str, float] = {}
             list_K: List[float] = []
             list_S: List[float] = []
 
-            crif = self.crif[(self.crif['RiskType'].isin(['Risk_IRCurve', 'Risk_Inflation', 'Risk_XCcyBasis']))]
+            ir_delta_risk_types = ['Risk_IRCurve', 'Risk_Inflation', 'Risk_XCcyBasis']
+            crif = self._rows(ir_delta_risk_types)
             currency_list = utils.unique_list(crif, 'Qualifier')
             for currency in currency_list:
 
-                list_WS = []
-                tenor_K = []
-                index   = []
-
                 # CRIF by currency
-                crif_currency = crif[(crif['Qualifier'] == currency)]
-
-                # Risk_XCcyBasis is not considered for the concentration risk factor(CR) calculation
-                crif_wo_xccybasis = crif_currency.drop(crif_currency[(crif_currency.RiskType == 'Risk_XCcyBasis')].index)
-
-                # Concentration Thresholds
-                T  = wnc.T('Rates','Delta',currency=currency)
-                CR = utils.concentration_threshold(utils.sum_sensitivities(crif_wo_xccybasis), T)
+                selected = self.codes.mask(ir_delta_risk_types, qualifier=currency)
+                codes = self.codes.take(selected)
+
+                K, S_b, CR = self._bucket(
+                    ('Rates', 'Delta', currency),
+                    selected,
+                    lambda: self._ir_delta_currency(codes, currency),
+                )
                 dict_CR[currency] = CR
-
-                # Iteration over the rates risk type existing in the CRIF
-                list_rates_risk_types = utils.unique_list([risk_class for risk_class in crif_currency['RiskType'] if risk_class in ['Risk_IRCurve', 'Risk_Inflation', 'Risk_XCcyBasis']])
-                for risk_class in list_rates_risk_types:
-
-                    # CRIF by risk type
-                    crif_risk_class = crif_currency[crif_currency['RiskType'] == risk_class]
-
-                    # Sensitivities Sum
-                    sensitivities = utils.sum_sensitivities(crif_risk_class)
-                    if risk_class == 'Risk_Inflation':
-                        RW = wnc.inflation_rw
-                        WS = RW * sensitivities * CR
-                        
-                        list_WS.append(WS)
-                        tenor_K.append('Inf')
-                        index.append('Inf')
-
-                    elif risk_class == 'Risk_XCcyBasis':
-                        RW = wnc.ccy_basis_swap_spread_rw
-                        WS = RW * sensitivities
-
-                        list_WS.append(WS)
-                        tenor_K.append('XCcy')
-                        index.append('XCcy')
-
-                    elif risk_class == 'Risk_IRCurve':
-                        # Mapping sensitivity to tenor k
-                        # e.g. 3m: 10000
-                        dict_sensitivities = {}
-
-                        # Curve types such as LIBOR3M, OIS, etc
-                        subcurve_list = utils.unique_list(crif_risk_class, 'Label2')
-                        for subcurve in subcurve_list:
-                            # CRIF by curve
-                            crif_subcurve = crif_risk_class[crif_risk_class['Label2']==subcurve]
-
-                            dict_sensitivities_tenor = {}
-                            # Iteration over tenors
-                            for tenor in utils.tenor_list(crif_subcurve):
-                                # CRIF by tenor
-                                crif_tenor = crif_subcurve[crif_subcurve['Label1']==tenor]
-                                
-                                # Sensitivities by tenor
-                                dict_sensitivities_tenor[tenor] = utils.sum_sensitivities(crif_tenor)
-                                dict_sensitivities[subcurve]    = dict_sensitivities_tenor
-                                # Ultimately, it is stored like,
-                                # {'Libor3m': {'1m': 32, '3m': 64},
-                                #  'OIS': {'2Y': 128, '5Y': 256}}
-
-                                #Regular Volatility
-                                if currency in wnc.reg_vol_ccy_bucket:
-                                    RW = wnc.reg_vol_rw[tenor]
-                                #Low Volatility
-                                elif currency in wnc.low_vol_ccy_bucket:
-                                    RW = wnc.low_vol_rw[tenor]
-                                #High Volatility
-                                else:
-                                    RW = wnc.high_vol_rw[tenor]
-
-                                s  = dict_sensitivities[subcurve][tenor]
-                                WS = RW * s * CR
-
-                                list_WS.append(WS)
-                                tenor_K.append(tenor)
-                                index.append(subcurve)
-
-                K = k_delta('Rates',list_WS,tenor=tenor_K,index=index,calculation_currency=self.calculation_currency)
                 list_K.append(K)
-
-                S_b = max(min(sum(list_WS),K),-K)
                 list_S.append(S_b)
 
-            K_squared_sum = sum([x**2 for x in list_K])
-            for i in range(len(currency_list)):
-                for j in range(len(currency_list)):
-
-                    if i == j:
-                        continue
-
-                    else:
-                        currency_b = currency_list[i]
-                        currency_c = currency_list[j]
-
-                        g = min(dict_CR[currency_b], dict_CR[currency_c]) / max(dict_CR[currency_b], dict_CR[currency_c])
+            # Cross-currency aggregation with g = min(CR_b, CR_c) / max(CR_b, CR_c)
+            K_squared_sum = cross_bucket_k_squared(
+                list_K, list_S, self.params.ir_gamma_diff_ccy, [dict_CR[currency] for currency in currency_list],
+            )
 
-                        if len(currency_list) > 1:
-                            gamma = wnc.ir_gamma_diff_ccy
-                        else:
-                            gamma = 1
+            updates['Rates']['Delta'] += sqrt(K_squared_sum)
+            return updates
 
-                        S1 = list_S[i]
-                        S2 = list_S[j]
+    def _ir_delta_currency(self, codes: CompactCRIF, currency: str) -> Tuple[float, float, float]:
+        """K_b, S_b and CR of a rates delta currency bucket."""
+        list_WS = []
+        tenor_K = []
+        index   = []
+
+        # Risk_XCcyBasis is not considered for the concentration risk factor(CR) calculation
+        wo_xccybasis = ~equals(codes.risk_type, codes.risk_type_code('Risk_XCcyBasis'))
+
+        # Concentration Thresholds
+        T  = self.params.T('Rates','Delta',currency=currency)
+        CR = utils.concentration_threshold(codes.amount(wo_xccybasis), T)
+
+        # Iteration over the rates risk type existing in the CRIF
+        list_rates_risk_types = [codes.risk_types[code] for code in pd.unique(codes.risk_type) if code != MISSING and codes.risk_types[code] in ['Risk_IRCurve', 'Risk_Inflation', 'Risk_XCcyBasis']]
+        for risk_class in list_rates_risk_types:
+
+            # Rows of the risk type
+            on_risk_class = equals(codes.risk_type, codes.risk_type_code(risk_class))
+
+            # Sensitivities Sum
+            sensitivities = codes.amount(on_risk_class)
+            if risk_class == 'Risk_Inflation':
+                RW = self.params.inflation_rw
+                WS = RW * sensitivities * CR
+
+                list_WS.append(WS)
+                tenor_K.append('Inf')
+                index.append('Inf')
+
+            elif risk_class == 'Risk_XCcyBasis':
+                RW = self.params.ccy_basis_swap_spread_rw
+                WS = RW * sensitivities
+
+                list_WS.append(WS)
+                tenor_K.append('XCcy')
+                index.append('XCcy')
+
+            elif risk_class == 'Risk_IRCurve':
+                # Mapping sensitivity to tenor k
+                # e.g. 3m: 10000
+                dict_sensitivities = {}
+
+                # Curve types such as LIBOR3M, OIS, etc
+                for subcurve_code in pd.unique(codes.label2[on_risk_class]):
+                    subcurve = codes.label2_values[subcurve_code] if subcurve_code != MISSING else np.nan
+                    # Rows of the curve
+                    on_subcurve = on_risk_class & equals(codes.label2, subcurve_code)
+
+                    dict_sensitivities_tenor = {}
+                    # Iteration over tenors
+                    for tenor_code in codes.tenors(on_subcurve):
+                        tenor = simm_tenor_list[tenor_code]
+
+                        # Sensitivities by tenor
+                        dict_sensitivities_tenor[tenor] = codes.amount(on_subcurve & (codes.tenor == tenor_code))
+                        dict_sensitivities[subcurve]    = dict_sensitivities_tenor
+                        # Ultimately, it is stored like,
+                        # {'Libor3m': {'1m': 32, '3m': 64},
+                        #  'OIS': {'2Y': 128, '5Y': 256}}
+
+                        # Regular, low or high volatility currency
+                        RW = self.params.resolver.ir_risk_weight(currency, tenor)
+
+                        s  = dict_sensitivities[subcurve][tenor]
+                        WS = RW * s * CR
 
-                        K_squared_sum += gamma * S1 * S2 * g
+                        list_WS.append(WS)
+                        tenor_K.append(tenor)
+                        index.append(subcurve)
 
-            updates['Rates']['Delta'] += sqrt(K_squared_sum)
-            return pd.DataFrame(updates)
+        K = k_delta('Rates',list_WS,tenor=tenor_K,index=index,calculation_currency=self.calculation_currency,params=self.params)
+        S_b = max(min(sum(list_WS),K),-K)
+        return K, S_b, CR
 
 
     def DeltaMargin(self) -> pd.DataFrame:
         """Delta margin for non-rates risk classes."""
-        updates = deepcopy(dict_margin_by_risk_class)
+        return pd.DataFrame(self._delta_margins())
+
+    def _delta_margins(self) -> Dict[str, Dict[str, float]]:
+        """DeltaMargin by risk class and measure."""
+        updates = _zero_margins()
 
         if (('Risk_FX'         not in self.list_risk_types) and \
             ('Risk_CreditQ'    not in self.list_risk_types) and \
@@ -183,7 +266,7 @@ class MarginByRiskClass:
             ('Risk_Equity'     not in self.list_risk_types) and \
             ('Risk_Commodity'  not in self.list_risk_types)):
             LOGGER.debug("No non-rates delta risk types found; delta margin is zero.")
-            return pd.DataFrame(updates)
+            return updates
 
         else:
             allowed_risk_classes = ['Risk_FX','Risk_CreditQ','Risk_CreditNonQ','Risk_Equity','Risk_Commodity']
@@ -196,237 +279,214 @@ class MarginByRiskClass:
 
                 # FX
                 if risk_class == 'Risk_FX':
-                    list_WS = []
-                    list_CR = []
-                    crif_fx = self.crif[(self.crif['RiskType']  == risk_class)]
-
-                    currency_list = utils.unique_list(crif_fx, 'Qualifier')
-
-                    for currency in currency_list:
-                        crif_currency = crif_fx[crif_fx['Qualifier'] == currency]
-                        T = wnc.T(risk_class,'Delta',currency=currency)
-                        sensitivities = utils.sum_sensitivities(crif_currency)
-                        CR = utils.concentration_threshold(sensitivities,T)
-                        list_CR.append(CR)
-
-                        is_given_currency = currency in wnc.high_vol_currency_group
-                        is_calc_currency  = self.calculation_currency in wnc.high_vol_currency_group
-                        if currency == self.calculation_currency:
-                            RW = 0
-                        elif (is_given_currency==True) and (is_calc_currency==True):
-                            RW  = wnc.fx_rw['High']['High']
-                        elif (is_given_currency==True) and (is_calc_currency==False):
-                            RW  = wnc.fx_rw['High']['Regular']
-                        elif (is_given_currency==False) and (is_calc_currency==True):
-                            RW  = wnc.fx_rw['Regular']['High']
-                        elif (is_given_currency==False) and (is_calc_currency==False):
-                            RW  = wnc.fx_rw['Regular']['Regular']
-                        
-                        list_WS.append(sensitivities * CR * RW)
-
-                    K = k_delta(risk_class,list_WS,list_CR=list_CR,bucket=currency_list,calculation_currency=self.calculation_currency)
+                    crif_fx, codes = self._coded_rows(risk_class)
+
+                    # FX risk weights and correlations depend on the calculation currency
+                    K = self._bucket(
+                        (risk_class, 'Delta', self.calculation_currency),
+                        crif_fx,
+                        lambda: self._fx_delta(crif_fx, codes),
+                    )
                     updates['FX']['Delta'] += K
+                    continue
 
                 # CreditQ, CreditNonQ, Equity, Commodity
-                elif risk_class in ['Risk_CreditQ','Risk_CreditNonQ','Risk_Equity','Risk_Commodity']:
+                bucket_list = self.codes.bucket_list(self.codes.mask(risk_class))
 
-                    crif_others = self.crif[(self.crif['RiskType'] == risk_class)]
-                    bucket_list = utils.bucket_list(crif_others)
-
-                    for bucket in bucket_list:
-                        if bucket == 0:
-                            crif_bucket = crif_others[(crif_others['RiskType'] == risk_class) & (crif_others['Bucket']  == 'Residual')]
-                        else:
-                            crif_bucket = crif_others[(crif_others['RiskType'] == risk_class) & (crif_others['Bucket'].isin([bucket, str(bucket)]))]
-
-                        # Risk Weight
-                        RW = wnc.RW(risk_class, bucket)                         
+                for bucket in bucket_list:
+                    # Bucket 0 is the Residual bucket
+                    selected = self.codes.mask(risk_class, bucket=bucket)
+                    codes = self.codes.take(selected)
 
-                        # Concentration Thresholds
-                        T = wnc.T(risk_class,'Delta',bucket=bucket)
+                    K, S_b = self._bucket(
+                        (risk_class, 'Delta', bucket),
+                        selected,
+                        lambda: self._delta_bucket(risk_class, bucket, codes),
+                    )
 
-                        list_WS = []
-                        list_CR = []
-                        index   = []
+                    if bucket == 0:
+                        K_Res += K
+                    else:
+                        list_K.append(K)
+                        list_S.append(S_b)
 
-                        qualifier_list = utils.unique_list(crif_bucket, 'Qualifier')
-                        for qualifier in qualifier_list:
-                            crif_qualifier = crif_bucket[crif_bucket['Qualifier'] == qualifier]
+                if 0 in bucket_list:
+                    bucket_list.remove(0)
 
-                            # Credit
-                            if risk_class in ['Risk_CreditQ','Risk_CreditNonQ']:
+                K_squared_sum = cross_bucket_k_squared(list_K, list_S, self.params.gamma_matrix(risk_class, bucket_list))
 
-                                sensitivities_CR = utils.sum_sensitivities(crif_qualifier)
-                                CR = max(1,sqrt(abs(sensitivities_CR)/T))
+                if risk_class in list_creditQ:
+                    updates['CreditQ']['Delta'] += sqrt(K_squared_sum) + K_Res
 
-                                list_lable2 = utils.unique_list(crif_qualifier, 'Label2')
-                                for label2 in list_lable2:
-                                    crif_label2 = crif_qualifier[crif_qualifier['Label2'] == label2]
+                elif risk_class in list_credit_nonQ:
+                    updates['CreditNonQ']['Delta'] += sqrt(K_squared_sum) + K_Res
 
-                                    for tenor in utils.tenor_list(crif_qualifier):
-                                        crif_tenor = crif_label2[crif_label2['Label1'] == tenor]
-                                        sensitivities = utils.sum_sensitivities(crif_tenor)
+                elif risk_class in list_equity:
+                    updates['Equity']['Delta'] += sqrt(K_squared_sum) + K_Res
 
-                                        list_WS.append(RW * sensitivities * CR)
-                                        list_CR.append(CR)
+                elif risk_class in list_commodity:
+                    updates['Commodity']['Delta'] += sqrt(K_squared_sum)
 
-                                        if bucket == 0:
-                                            index.append('Res')
+        return updates
 
-                                        else:
-                                            if risk_class == 'Risk_CreditQ':
-                                                index.append(qualifier)
+    def _fx_delta(self, crif_fx: pd.DataFrame, codes: CompactCRIF) -> float:
+        """K of the FX delta risk class (a single bucket of currencies)."""
+        risk_class = 'Risk_FX'
+        list_WS = []
+        list_CR = []
 
-                                            elif risk_class == 'Risk_CreditNonQ':
-                                                index.append(label2)
+        currency_list = utils.unique_list(crif_fx, 'Qualifier')
 
-                            # Equity, Commodity
-                            elif risk_class in ['Risk_Equity','Risk_Commodity']:
-                                sensitivities_EQCO = utils.sum_sensitivities(crif_qualifier)
-                                CR = max(1,sqrt(abs(sensitivities_EQCO)/T))
-                                list_CR.append(CR)
-                                list_WS.append(RW * sensitivities_EQCO * CR)
+        # Thresholds and risk weights of all currencies at once
+        list_T  = self.params.resolver.thresholds([risk_class] * len(currency_list), 'Delta', currencies=currency_list)
+        list_RW = self.params.resolver.fx_risk_weights(currency_list, self.calculation_currency)
 
-                        K = k_delta(risk_class,list_WS,list_CR=list_CR,bucket=bucket,index=index,calculation_currency=self.calculation_currency)
+        for currency, T, RW in zip(currency_list, list_T, list_RW):
+            sensitivities = codes.amount(equals(codes.qualifier, codes.qualifier_code(currency)))
+            CR = utils.concentration_threshold(sensitivities,T)
+            list_CR.append(CR)
 
-                        if bucket == 0:
-                            K_Res += K
-                        else:
-                            list_K.append(K)
-                            S_b = max(min(sum(list_WS),K),-K)
-                            list_S.append(S_b)
+            # The calculation currency carries no FX risk
+            if currency == self.calculation_currency:
+                RW = 0
 
-                    if 0 in bucket_list:
-                        bucket_list.remove(0)
+            list_WS.append(sensitivities * CR * RW)
 
-                if risk_class == 'Risk_FX':
-                    pass
+        return k_delta(risk_class,list_WS,list_CR=list_CR,bucket=currency_list,calculation_currency=self.calculation_currency,params=self.params)
 
-                else:
-                    K_squared_sum = sum([x**2 for x in list_K])
-                    for i, _ in enumerate(bucket_list):
-                        for j, _ in enumerate(bucket_list):
+    def _delta_bucket(self, risk_class: str, bucket: int, codes: CompactCRIF) -> Tuple[float, float]:
+        """K_b and S_b of a credit, equity or commodity delta bucket."""
+        # Risk Weight
+        RW = self.params.RW(risk_class, bucket)
 
-                            if i == j:
-                                continue
+        # Concentration Thresholds
+        T = self.params.T(risk_class,'Delta',bucket=bucket)
 
-                            else:
-                                bucket1 = bucket_list[i]
-                                bucket2 = bucket_list[j]
+        list_WS = []
+        list_CR = []
+        index   = []
 
-                                if risk_class in list_rates:
-                                    g = min(list_CR)/max(list_CR)
+        # Qualifiers and labels in order of appearance, missing values (code -1) included
+        for qualifier_code in pd.unique(codes.qualifier):
+            qualifier = codes.qualifiers[qualifier_code] if qualifier_code != MISSING else np.nan
+            on_qualifier = equals(codes.qualifier, qualifier_code)
 
-                                    if len(self.currency_list()) > 1:
-                                        gamma = wnc.ir_gamma_diff_ccy
-                                    else:
-                                        gamma = 1
+            # Credit
+            if risk_class in ['Risk_CreditQ','Risk_CreditNonQ']:
 
-                                elif risk_class in list_fx:
-                                    g = 1
-                                    gamma = wnc.FX_Corr[4]
+                sensitivities_CR = codes.amount(on_qualifier)
+                CR = max(1,sqrt(abs(sensitivities_CR)/T))
 
-                                elif risk_class in list_credit_nonQ:
-                                    g = 1
-                                    gamma = wnc.gamma(risk_class)
+                for label2_code in pd.unique(codes.label2[on_qualifier]):
+                    label2 = codes.label2_values[label2_code] if label2_code != MISSING else np.nan
+                    on_label2 = on_qualifier & equals(codes.label2, label2_code)
 
-                                else:
-                                    g = 1
-                                    gamma = wnc.gamma(risk_class,str(bucket1),str(bucket2))
+                    for tenor_code in codes.tenors(on_qualifier):
+                        sensitivities = codes.amount(on_label2 & (codes.tenor == tenor_code))
 
-                                S1 = list_S[i]
-                                S2 = list_S[j]
-                                K_squared_sum += gamma * S1 * S2 * g
+                        list_WS.append(RW * sensitivities * CR)
+                        list_CR.append(CR)
 
-                if risk_class in list_creditQ:
-                    updates['CreditQ']['Delta'] += sqrt(K_squared_sum) + K_Res
+                        if bucket == 0:
+                            index.append('Res')
 
-                elif risk_class in list_credit_nonQ:
-                    updates['CreditNonQ']['Delta'] += sqrt(K_squared_sum) + K_Res
+                        else:
+                            if risk_class == 'Risk_CreditQ':
+                                index.append(qualifier)
 
-                elif risk_class in list_equity:
-                    updates['Equity']['Delta'] += sqrt(K_squared_sum) + K_Res
+                            elif risk_class == 'Risk_CreditNonQ':
+                                index.append(label2)
 
-                elif risk_class in list_commodity:
-                    updates['Commodity']['Delta'] += sqrt(K_squared_sum)
+            # Equity, Commodity
+            elif risk_class in ['Risk_Equity','Risk_Commodity']:
+                sensitivities_EQCO = codes.amount(on_qualifier)
+                CR = max(1,sqrt(abs(sensitivities_EQCO)/T))
+                list_CR.append(CR)
+                list_WS.append(RW * sensitivities_EQCO * CR)
 
-        return pd.DataFrame(updates)
+        K = k_delta(risk_class,list_WS,list_CR=list_CR,bucket=bucket,index=index,calculation_currency=self.calculation_currency,params=self.params)
+        S_b = max(min(sum(list_WS),K),-K)
+        return K, S_b
 
 
     def IRVegaMargin(self) -> pd.DataFrame:
         """Vega margin for rates risk classes."""
-        updates = deepcopy(dict_margin_by_risk_class)
+        return pd.DataFrame(self._ir_vega_margins())
+
+    def _ir_vega_margins(self) -> Dict[str, Dict[str, float]]:
+        """IRVegaMargin by risk class and measure."""
+        updates = _zero_margins()
 
         list_K   = []
         dict_S   = {}
         dict_VCR = {}
 
-        allowed_risk_classes = [risk_class for risk_class in self.list_risk_types if risk_class in ['Risk_IRVol', 'Risk_InflationVol']]
         if ('Risk_IRVol' not in self.list_risk_types) and \
            ('Risk_InflationVol' not in self.list_risk_types):
             LOGGER.debug("No rates vega risk types found; IR vega margin is zero.")
-            return pd.DataFrame(updates)
+            return updates
 
         else:
-            for risk_class in allowed_risk_classes:
-                VRW = wnc.ir_vrw
-                currency_list = utils.unique_list(self.crif, 'Qualifier')
-                for currency in currency_list:
+            currency_list = self._ir_vol_currencies()
+            for currency in currency_list:
 
-                    crif_currency = self.crif[(self.crif['RiskType'].isin(['Risk_IRVol','Risk_InflationVol'])) & (self.crif['Qualifier'] == currency)]
+                K, S, VCR = self._ir_vol(currency)[0]
+                dict_VCR[currency] = VCR
+                list_K.append(K)
+                dict_S[currency] = S
 
-                    VR    = []
-                    index = []
-                    sensitivities_CR = utils.sum_sensitivities(crif_currency)
+            # Cross-currency aggregation with g = min(VCR_b, VCR_c) / max(VCR_b, VCR_c)
+            K_squared_sum = cross_bucket_k_squared(
+                list_K,
+                [dict_S[currency] for currency in currency_list],
+                self.params.ir_gamma_diff_ccy,
+                [dict_VCR[currency] for currency in currency_list],
+            )
 
-                    VT  = wnc.T('Rates','Vega',currency=currency)
-                    VCR = max(1, sqrt(abs(sensitivities_CR)/VT))
-                    dict_VCR[currency] = VCR
+            updates['Rates']['Vega'] += sqrt(K_squared_sum)
+            return updates
 
-                    list_rates_risk_types = utils.unique_list([risk_class for risk_class in crif_currency['RiskType'] if risk_class in ['Risk_IRVol','Risk_InflationVol']])
-                    for risk_class in list_rates_risk_types:
-                        crif_riskClass = crif_currency[crif_currency['RiskType'] == risk_class]           
-                    
-                        tenor_list = utils.tenor_list(crif_riskClass)
-                        for tenor in tenor_list:
-                            crif_tenor = crif_riskClass[crif_riskClass['Label1'] == tenor]
-                            sensitivities = utils.sum_sensitivities(crif_tenor)
-
-                            VR.append(VRW * sensitivities * VCR)
-
-                            if risk_class == 'Risk_IRVol':
-                                index.append(tenor)
-                            elif risk_class == 'Risk_InflationVol':
-                                index.append('Inf')
-                            
-                    K = k_vega('Rates',VR,index=index)            
-                    list_K.append(K)
-                    
-                    S = max(min(sum(VR), K), -K)
-                    dict_S[currency] = S
+    def _ir_vol_currency(self, crif_currency: pd.DataFrame, currency: str) -> Tuple[Tuple, Tuple, bool]:
+        """Vega (K_b, S_b, VCR) and curvature (K_b, S_b, sum(CVR), sum(|CVR|)) of a rates vol currency bucket.
 
-                K_squared_sum = sum([K**2 for K in list_K])
-                for b in range(len(currency_list)):
-                    for c in range(len(currency_list)):
+        Sensitivities are summed once by risk type and tenor. Vega uses the
+        SIMM tenors; curvature scales every tenor. The flag tells whether the
+        bucket only holds InflationVol rows that net to zero.
+        """
+        VRW = self.params.ir_vrw
+        sensitivities_CR = utils.sum_sensitivities(crif_currency)
 
-                        if b == c:
-                            continue
+        VT  = self.params.T('Rates','Vega',currency=currency)
+        VCR = max(1, sqrt(abs(sensitivities_CR)/VT))
 
-                        else:
-                            currency_b = currency_list[b]
-                            currency_c = currency_list[c]
-                            g = min(dict_VCR[currency_b], dict_VCR[currency_c]) / max(dict_VCR[currency_b], dict_VCR[currency_c])
-                            gamma = wnc.ir_gamma_diff_ccy
-                        
-                        K_squared_sum += gamma * dict_S[currency_b] * dict_S[currency_c] * g
+        list_rates_risk_types = utils.unique_list([risk_class for risk_class in crif_currency['RiskType'] if risk_class in ['Risk_IRVol','Risk_InflationVol']])
+        inflation_only_flat = (list_rates_risk_types == ['Risk_InflationVol']) and (sensitivities_CR == 0)
+
+        crif_vol = crif_currency[crif_currency['RiskType'].isin(list_rates_risk_types)]
+        sensitivities = crif_vol.groupby(['RiskType', 'Label1'], sort=False, dropna=False)['AmountUSD'].sum()
+        tenors = sensitivities.index.get_level_values('Label1')
+        amounts = sensitivities.to_numpy(dtype='float64')
+        index = np.where(sensitivities.index.get_level_values('RiskType') == 'Risk_InflationVol', 'Inf', tenors.to_numpy(dtype=object))
+
+        on_tenor = tenors.isin(simm_tenor_list)
+        VR = (VRW * amounts[on_tenor] * VCR).tolist()
+        K = k_vega('Rates', VR, index=index[on_tenor].tolist(), params=self.params)
+        vega = (K, max(min(sum(VR), K), -K), VCR)
 
-                updates['Rates']['Vega'] += sqrt(K_squared_sum)
-                return pd.DataFrame(updates)
+        CVR_ik = (utils.scaling_factors(tenors) * amounts).tolist()
+        K = k_curvature('Rates', CVR_ik, index=index.tolist(), params=self.params)
+        curvature = (K, max(min(sum(CVR_ik), K), -K), sum(CVR_ik), sum([abs(CVR) for CVR in CVR_ik]))
+
+        return vega, curvature, inflation_only_flat
 
 
     def VegaMargin(self) -> pd.DataFrame:
         """Vega margin for non-rates risk classes."""
-        updates = deepcopy(dict_margin_by_risk_class)
+        return pd.DataFrame(self._vega_margins())
+
+    def _vega_margins(self) -> Dict[str, Dict[str, float]]:
+        """VegaMargin by risk class and measure."""
+        updates = _zero_margins()
         
         allowed_risk_classes = ['Risk_CreditVol','Risk_CreditVolNonQ','Risk_EquityVol','Risk_CommodityVol','Risk_FXVol']
         list_risk_classes = [risk_class for risk_class in self.list_risk_types if risk_class in allowed_risk_classes]
@@ -436,8 +496,7 @@ class MarginByRiskClass:
             K_Res    = 0
             list_K   = []
             list_S   = []
-            list_VCR = []
-            
+
             credit    = ['Risk_CreditVol','Risk_CreditVolNonQ']
             equity    = ['Risk_EquityVol']
             commodity = ['Risk_CommodityVol']
@@ -445,156 +504,30 @@ class MarginByRiskClass:
             
             # Skip risk_class not in the lists
             if risk_class not in credit + equity + commodity + fx:
-                return pd.DataFrame(updates)
+                return updates
 
             elif risk_class in fx:
-
-                list_VR  = []
-                list_VCR = []
-
-                for currency_pair in utils.currencyPair_list(self.crif):              
-                # k: currency_pair
-
-                    pair_list = [currency_pair, currency_pair[3:]+currency_pair[:3]]    
-                    crif_fx   = self.crif[(self.crif['RiskType']  == risk_class) & (self.crif['Qualifier'].isin(pair_list))]
-                    
-                    is_currency1 = currency_pair[:3] in wnc.high_vol_currency_group
-                    is_currency2 = currency_pair[3:] in wnc.high_vol_currency_group
-
-                    fx_vol_group1 = 'High' if is_currency1 else 'Regular'
-                    fx_vol_group2 = 'High' if is_currency2 else 'Regular'
-
-                    RW = wnc.fx_rw[fx_vol_group2][fx_vol_group1]
-
-                    sigma = RW * sqrt(365/14)/norm.ppf(0.99)
-
-                    HVR = wnc.fx_hvr  # Historical Volatility Ratio
-                    VRW = wnc.fx_vrw  # Vega Risk Weight
-
-                    VT = wnc.T(risk_class,'Vega',currency=currency_pair) # Vega Concentration Threshold
-                    sensitivities = utils.sum_sensitivities(crif_fx)
-                    
-                    VR_ik = HVR * sigma * sensitivities
-
-                    VCR = max(1,sqrt(abs(VR_ik)/VT))
-                    list_VCR.append(VCR)
-                    
-                    VR_k = VRW * VR_ik * VCR
-                    list_VR.append(VR_k)
-                    
-                K = k_vega(risk_class, list_VR, VCR=list_VCR)                                
+                K = self._vol_measures(risk_class)[0]
                 updates['FX']['Vega'] += K
                                             
             # Equity, Commodity, Credit
             elif risk_class in equity + commodity + credit:            
                 
-                bucket_list = utils.bucket_list(self.crif[(self.crif['RiskType'] == risk_class)])
+                bucket_list = self.codes.bucket_list(self.codes.mask(risk_class))
                 
                 for bucket in bucket_list:
-                    if bucket == 0:
-                        crif_others = self.crif[(self.crif['RiskType'] == risk_class) & (self.crif['Bucket']  == 'Residual')]
-                    else:
-                        crif_others = self.crif[(self.crif['RiskType'] == risk_class) & (self.crif['Bucket'].isin([bucket, str(bucket)]))]
-                    
-                    VR       = []
-                    list_VCR = []
-                    index    = []
-
-                    qualifier_list = utils.unique_list(crif_others, 'Qualifier')
-                    for qualifier in qualifier_list:
-                        
-                        crif_qualifier = crif_others[crif_others['Qualifier'] == qualifier]
-
-                        VR_ik = []
-                        RW    = wnc.RW(risk_class,bucket)
-                        sigma = RW * sqrt(365/14)/norm.ppf(0.99)
-
-                        if risk_class in equity:
-                            HVR = wnc.equity_hvr  # Historical Volatility Ratio
-
-                            if bucket == 12:
-                                VRW = wnc.equity_vrw_bucket_12  # Vega Risk Weight
-                                
-                            else:
-                                VRW = wnc.equity_vrw  # Vega Risk Weight
-
-                        elif risk_class in commodity:
-                            HVR = wnc.commodity_hvr  # Historical Volatility Ratio
-                            VRW = wnc.commodity_vrw  # Vega Risk Weight
-
-                        elif risk_class in credit:                   
-                            
-                            VT = wnc.T(risk_class,'Vega',bucket=bucket)
-                            sensitivities_VT = utils.sum_sensitivities(crif_qualifier)
-                            VCR = max(1,sqrt(abs(sensitivities_VT)/VT))
-                            
-                            list_lable2 = utils.unique_list(list(crif_qualifier['Label2']))
-                            for label2 in list_lable2:
-                                crif_label2 = crif_qualifier[crif_qualifier['Label2'] == label2]
-
-                                for tenor in utils.tenor_list(crif_qualifier):
-                                    crif_tenor = crif_label2[crif_label2['Label1'] == tenor]
-                                    sensitivities = utils.sum_sensitivities(crif_tenor)
-
-                                    if risk_class == 'Risk_CreditVol':
-                                        VRW = wnc.creditQ_vrw
-                                    elif risk_class == 'Risk_CreditVolNonQ':
-                                        VRW = wnc.creditNonQ_vrw                        
-                                        
-                                    VR.append(VRW * sensitivities * VCR)
-                                    list_VCR.append(VCR)
-
-                                    if bucket == 0:
-                                        index.append('Res')
-                                    else:
-                                        if risk_class == 'Risk_CreditVol':
-                                            index.append(qualifier)
-                                        
-                                        elif risk_class == 'Risk_CreditVolNonQ':
-                                            index.append(label2)
-                                    
-                        if risk_class in equity + commodity:
-                            sensitivities = utils.sum_sensitivities(crif_qualifier)
-                            VR_ik.append(HVR * sigma * sensitivities)
-                            
-                            VR_i = sum(VR_ik)
-                            VT   = wnc.T(risk_class,'Vega',bucket=bucket)
-                            VCR  = max(1, sqrt(abs(VR_i)/VT))
-
-                            list_VCR.append(VCR)
-                            VR.append(VR_i * VRW * VCR)
-
-                            index = ''
-
-                    K = k_vega(risk_class,VR,VCR=list_VCR,bucket=bucket,index=index)
+                    K, S = self._vol_measures(risk_class, bucket)[0]
 
                     if bucket == 0:
                         K_Res += K
                     else:
                         list_K.append(K)
-                        S = max(min(sum(VR), K), -K)
                         list_S.append(S)                
 
                 if 0 in bucket_list:
                     bucket_list.remove(0)  
 
-                K_squared_sum = sum([K**2 for K in list_K])
-                for i, _ in enumerate(list_S):
-                    for j, _ in enumerate(list_S):
-
-                        if i == j:
-                            continue
-
-                        else:
-                            bucket_i = str(bucket_list[i])
-                            bucket_j = str(bucket_list[j])
-                            
-                            if risk_class == 'Risk_CreditVolNonQ':
-                                gamma = wnc.gamma(risk_class)
-                            else:
-                                gamma = wnc.gamma(risk_class, bucket_i, bucket_j)
-                            
-                            K_squared_sum += gamma * list_S[i] * list_S[j]
+                K_squared_sum = cross_bucket_k_squared(list_K, list_S, self.params.gamma_matrix(risk_class, bucket_list))
             
 
                 if risk_class in list_creditQ:
@@ -609,86 +542,165 @@ class MarginByRiskClass:
                 elif risk_class in list_commodity:
                     updates['Commodity']['Vega'] += sqrt(K_squared_sum) + K_Res 
 
-        return pd.DataFrame(updates)
+        return updates
+
+    def _fx_vol(self, crif_fx: pd.DataFrame) -> Tuple[float, Tuple[float, float, float]]:
+        """Vega K and curvature (K, sum(CVR), sum(|CVR|)) of the FX vol risk class (a single bucket of currency pairs)."""
+        risk_class = 'Risk_FXVol'
+
+        # One group per currency pair (inverse pairs together), reduced in one pass
+        pair_codes, pairs = utils.fx_pair_groups(crif_fx['Qualifier'])
+        in_pair = pair_codes >= 0
+        crif_pairs = crif_fx[in_pair]
+        amounts = crif_pairs['AmountUSD'].to_numpy(dtype='float64')
+        sensitivities = np.bincount(pair_codes[in_pair], weights=np.nan_to_num(amounts), minlength=len(pairs))
+        scaled_vega = np.bincount(pair_codes[in_pair], weights=utils.scaling_factors(crif_pairs['Label1']) * amounts, minlength=len(pairs))
+
+        RW = self.params.resolver.fx_pair_risk_weights(pairs)
+        sigma = RW * sqrt(365/14)/utils.NORM_PPF_99
+
+        # Vega
+        VT = self.params.resolver.thresholds([risk_class] * len(pairs), 'Vega', currencies=pairs) # Vega Concentration Thresholds
+        HVR = self.params.fx_hvr  # Historical Volatility Ratio
+        VRW = self.params.fx_vrw  # Vega Risk Weight
+
+        VR_ik = HVR * sigma * sensitivities
+        VCR = np.maximum(1, np.sqrt(np.abs(VR_ik)/VT))
+        list_VR = (VRW * VR_ik * VCR).tolist()
+        K_vega = k_vega(risk_class, list_VR, VCR=VCR.tolist(), params=self.params)
+
+        # Curvature
+        list_CVR = (sigma * scaled_vega).tolist()
+        K = k_curvature(risk_class, list_CVR, params=self.params)
+
+        return K_vega, (K, sum([CVR for CVR in list_CVR]), sum([abs(CVR) for CVR in list_CVR]))
+
+    def _vol_bucket(self, risk_class: str, bucket: int, crif_bucket: pd.DataFrame) -> Tuple[Tuple[float, float], Tuple[float, float, float, float]]:
+        """Vega (K_b, S_b) and curvature (K_b, S_b, sum(CVR), sum(|CVR|)) of a credit, equity or commodity vol bucket."""
+        credit    = ['Risk_CreditVol','Risk_CreditVolNonQ']
+        equity    = ['Risk_EquityVol']
+        commodity = ['Risk_CommodityVol']
+
+        qualifier_codes, qualifiers = pd.factorize(crif_bucket['Qualifier'], use_na_sentinel=False)
+        amounts = np.nan_to_num(crif_bucket['AmountUSD'].to_numpy(dtype='float64'))
+
+        if risk_class in equity + commodity:
+            RW    = self.params.RW(risk_class,bucket)
+            sigma = RW * sqrt(365/14)/utils.NORM_PPF_99
+
+            if risk_class in equity:
+                HVR = self.params.equity_hvr  # Historical Volatility Ratio
+                VRW = self.params.equity_vrw_bucket_12 if bucket == 12 else self.params.equity_vrw  # Vega Risk Weight
+            else:
+                HVR = self.params.commodity_hvr  # Historical Volatility Ratio
+                VRW = self.params.commodity_vrw  # Vega Risk Weight
+
+            # Vega: sensitivities summed by qualifier (first-seen order)
+            VR_i = HVR * sigma * np.bincount(qualifier_codes, weights=amounts, minlength=len(qualifiers))
+            VT   = self.params.T(risk_class,'Vega',bucket=bucket)
+            VCR  = np.maximum(1, np.sqrt(np.abs(VR_i)/VT))
+            VR   = (VR_i * VRW * VCR).tolist()
+            list_VCR = VCR.tolist()
+            index = ''
+
+            # Curvature: scaled vegas summed by qualifier; no curvature margin for equity with bucket 12
+            sigma_curvature = 0 if (risk_class in equity) and (bucket == 12) else sigma
+            CVR_rows = utils.scaling_factors(crif_bucket['Label1']) * sigma_curvature * amounts
+            CVR_i = np.bincount(qualifier_codes, weights=CVR_rows, minlength=len(qualifiers)).tolist()
+            index_curvature = ''
+
+        elif risk_class in credit:
+            # VCR of a qualifier from all of its rows
+            VT = self.params.T(risk_class,'Vega',bucket=bucket)
+            VCR_q = np.maximum(1, np.sqrt(np.abs(np.bincount(qualifier_codes, weights=amounts, minlength=len(qualifiers)))/VT))
+
+            # Sensitivities by (qualifier, Label2, SIMM tenor), shared by vega and curvature
+            on_tenor = (crif_bucket['Label1'].isin(simm_tenor_list) & crif_bucket['Label2'].notna()).to_numpy()
+            crif_tenor = crif_bucket[on_tenor]
+            sensitivities = pd.Series(amounts[on_tenor]).groupby(
+                [qualifier_codes[on_tenor], crif_tenor['Label2'].to_numpy(), crif_tenor['Label1'].to_numpy()], sort=False,
+            ).sum()
+            codes = sensitivities.index.get_level_values(0).to_numpy()
+            label2 = sensitivities.index.get_level_values(1).to_numpy(dtype=object)
+            tenors = sensitivities.index.get_level_values(2)
+            amounts = sensitivities.to_numpy(dtype='float64')
+
+            if bucket == 0:
+                index = ['Res'] * len(amounts)
+            elif risk_class == 'Risk_CreditVol':
+                index = np.asarray(qualifiers, dtype=object)[codes].tolist()
+            else:
+                index = label2.tolist()
+            index_curvature = index
+
+            VRW = self.params.creditQ_vrw if risk_class == 'Risk_CreditVol' else self.params.creditNonQ_vrw
+            list_VCR = VCR_q[codes].tolist()
+            VR = (VRW * amounts * VCR_q[codes]).tolist()
+            CVR_i = (utils.scaling_factors(tenors) * amounts).tolist()
+
+        K = k_vega(risk_class,VR,VCR=list_VCR,bucket=bucket,index=index,params=self.params)
+        vega = (K, max(min(sum(VR), K), -K))
+
+        K = k_curvature(risk_class, CVR_i, bucket, index_curvature, params=self.params)
+        curvature = (K, max(min(sum(CVR_i), K), -K), sum(CVR_i), sum([abs(CVR) for CVR in CVR_i]))
+
+        return vega, curvature
 
 
-    def IRCurvatureMargin(self) -> pd.DataFrame:
-        """Curvature margin for rates risk classes."""
-        updates = deepcopy(dict_margin_by_risk_class)
+    def IRCurvatureMargin(self, direction: int = 1) -> pd.DataFrame:
+        """Curvature margin for rates risk classes (direction -1: every sensitivity negated)."""
+        return pd.DataFrame(self._ir_curvature_margins(direction))
+
+    def _ir_curvature_margins(self, direction: int = 1) -> Dict[str, Dict[str, float]]:
+        """IRCurvatureMargin by risk class and measure."""
+        updates = _zero_margins()
 
         if ('Risk_IRVol' not in self.list_risk_types) and ('Risk_InflationVol' not in self.list_risk_types):
             LOGGER.debug("No rates curvature risk types found; IR curvature margin is zero.")
-            return pd.DataFrame(updates)
+            return updates
 
         else:
-            allowed_risk_classes = [risk_class for risk_class in self.list_risk_types if risk_class in ['Risk_IRVol', 'Risk_InflationVol']]
-            for risk_class in allowed_risk_classes:
-            
-                list_K = []
-                list_S = []
+            list_K = []
+            list_S = []
 
-                CVR_sum     = 0
-                CVR_abs_sum = 0
+            CVR_sum     = 0
+            CVR_abs_sum = 0
 
-                currency_list = utils.unique_list(self.crif, 'Qualifier')
-                for currency in currency_list:
-                    crif_currency = self.crif[(self.crif['RiskType'].isin(['Risk_IRVol','Risk_InflationVol'])) & (self.crif['Qualifier'] == currency)]
-                    list_rates_risk_types = utils.unique_list([risk_class for risk_class in list(crif_currency['RiskType']) if risk_class in ['Risk_IRVol','Risk_InflationVol']])
-                    
-                    index = []
-                    CVR_ik = []
-                    
-                    # Make an exception for Risk_InflationVol
-                    if (list_rates_risk_types == ['Risk_InflationVol']) and (crif_currency['AmountUSD'].sum()==0) and (self.calculation_currency==currency):
-                        return pd.DataFrame(updates)
-                    else:
-                        for risk_class in list_rates_risk_types:
-                            
-                            crif_riskClass = crif_currency[crif_currency['RiskType'] == risk_class]
-
-                            for tenor in utils.unique_list(crif_riskClass, 'Label1'):
-                                crif_tenor = crif_riskClass[crif_riskClass['Label1'] == tenor]
-
-                                sensitivities = utils.sum_sensitivities(crif_tenor)
-
-                                CVR = utils.scaling_func(tenor) * sensitivities
-                                CVR_ik.append(CVR)
-                                CVR_sum += CVR    
-                                CVR_abs_sum += abs(CVR)             
-
-                                if risk_class == 'Risk_IRVol':
-                                    index.append(tenor)
-                                elif risk_class == 'Risk_InflationVol':
-                                    index.append('Inf')
-                                
-                        K = k_curvature('Rates', CVR_ik, index=index)
-                        list_K.append(K)
+            currency_list = self._ir_vol_currencies()
+            for currency in currency_list:
+                _, (K, S, CVR_sum_b, CVR_abs_sum_b), inflation_only_flat = self._ir_vol(currency)
 
-                        S = max(min(sum(CVR_ik), K), -K)
-                        list_S.append(S)
+                # Make an exception for Risk_InflationVol
+                if inflation_only_flat and (self.calculation_currency==currency):
+                    return updates
 
-                theta  = min(CVR_sum/CVR_abs_sum, 0)
-                _lambda = (norm.ppf(0.995)**2 - 1) * (1 + theta) - theta
+                list_K.append(K)
+                list_S.append(S)
+                CVR_sum     += direction * CVR_sum_b
+                CVR_abs_sum += CVR_abs_sum_b
 
+            theta  = utils.curvature_theta(CVR_sum, CVR_abs_sum)
+            _lambda = (utils.NORM_PPF_995**2 - 1) * (1 + theta) - theta
 
-                K = sum([K**2 for K in list_K])
-                for i in range(len(list_S)):
-                    for j in range(len(list_S)):
-                        if i == j:
-                            continue
 
-                        else:
-                            gamma = wnc.ir_gamma_diff_ccy
-                            K += list_S[i] * list_S[j] * (gamma**2)
-                
-                HVR = wnc.ir_hvr
-                updates['Rates']['Curvature'] += max(CVR_sum + _lambda * sqrt(K), 0) / (HVR**2) 
-                return pd.DataFrame(updates)
+            K = cross_bucket_k_squared(list_K, list_S, self.params.ir_gamma_diff_ccy**2)
+
+            HVR = self.params.ir_hvr
+            updates['Rates']['Curvature'] += max(CVR_sum + _lambda * sqrt(K), 0) / (HVR**2) 
+            return updates
 
+    def CurvatureMargin(self, direction: int = 1) -> pd.DataFrame:
+        """Curvature margin for non-rates risk classes (direction -1: every sensitivity negated)."""
+        return pd.DataFrame(self._curvature_margins(direction))
 
-    def CurvatureMargin(self) -> pd.DataFrame:
-        """Curvature margin for non-rates risk classes."""
-        updates = deepcopy(dict_margin_by_risk_class)
+    def _curvature_margins(self, direction: int = 1) -> Dict[str, Dict[str, float]]:
+        """CurvatureMargin by risk class and measure.
+
+        Negating the sensitivities leaves every K_b, sum(|CVR|) and S_b * S_c
+        unchanged and only flips sum(CVR), so both directions share the
+        bucket results.
+        """
+        updates = _zero_margins()
         
         credit    = ['Risk_CreditVol','Risk_CreditVolNonQ']
         equity    = ['Risk_EquityVol']
@@ -706,78 +718,18 @@ class MarginByRiskClass:
             CVR_sum_res     = 0
             CVR_abs_sum     = 0
             CVR_abs_sum_res = 0
-            
-            crif_risk_class = self.crif[(self.crif['RiskType']==risk_class)]
-
-            # Skip risk_class not in the lists
-            if risk_class not in credit + equity + commodity + fx:
-                pass
 
             # Equity, Commodity, Credit
-            elif risk_class in credit + equity + commodity:
-                bucket_list = utils.bucket_list(self.crif[(self.crif['RiskType']==risk_class)])
+            if risk_class in credit + equity + commodity:
+                bucket_list = self.codes.bucket_list(self.codes.mask(risk_class))
                 for bucket in bucket_list:
-                    if bucket == 0:
-                        crif_risk_class = self.crif[(self.crif['RiskType']==risk_class) & (self.crif['Bucket']=='Residual')]
-                    else:
-                        crif_risk_class = self.crif[(self.crif['RiskType']==risk_class) & (self.crif['Bucket'].isin([bucket, str(bucket)]))]
-
-                    CVR_i = []
-                    index = []
-                    
-                    for qualifier in utils.unique_list(crif_risk_class, 'Qualifier'):
-                        
-                        crif_qualifier = crif_risk_class[crif_risk_class['Qualifier'] == qualifier]           
-                        
-                        # tenor_list = utils.unique_list(crif_qualifier, 'Label1')
-                        # list_vega  = utils.unique_list(crif_qualifier, 'AmountUSD')
-                        tenor_list = crif_qualifier['Label1'].to_list()
-                        vega_list  = crif_qualifier['AmountUSD'].to_list()
-
-                        RW    = wnc.RW(risk_class,bucket)
-                        sigma = RW * sqrt(365/14)/norm.ppf(0.99)
-
-                        if risk_class in equity + commodity:
-
-                            # No curvature margin for equity with bucket 12
-                            if (risk_class in equity) and (bucket == 12):
-                                sigma = 0                              
-                        
-                            CVR_ik = []                 
-                            for k, vega in zip(tenor_list,vega_list):
-                                CVR_ik.append(utils.scaling_func(k) * sigma * vega)
-                            CVR_i.append(sum(CVR_ik))
-                            index = ''
-
-                        elif risk_class in credit:
-
-                            list_lable2 = utils.unique_list(crif_qualifier, 'Label2')
-                            for label2 in list_lable2:
-                                crif_label2 = crif_qualifier[crif_qualifier['Label2'] == label2]
-
-                                for tenor in utils.tenor_list(crif_qualifier):
-                                    crif_tenor = crif_label2[crif_label2['Label1'] == tenor]
-
-                                    sensitivities = utils.sum_sensitivities(crif_tenor)
-
-                                    if bucket == 0:
-                                        index.append('Res')
-                                    else:
-                                        if risk_class == 'Risk_CreditVol':
-                                            index.append(qualifier)
-                                        
-                                        elif risk_class == 'Risk_CreditVolNonQ':
-                                            index.append(label2)
-                                    
-                                    CVR_i.append(utils.scaling_func(tenor) * sensitivities)
-
-                    K = k_curvature(risk_class, CVR_i, bucket, index)
+                    K, S, CVR_sum_b, CVR_abs_sum_b = self._vol_measures(risk_class, bucket)[1]
                     
                     #  Residual bucket
                     if bucket == 0:
                         K_Res += K             
-                        CVR_sum_res     += sum(CVR_i)
-                        CVR_abs_sum_res += sum([abs(CVR) for CVR in CVR_i])
+                        CVR_sum_res     += direction * CVR_sum_b
+                        CVR_abs_sum_res += CVR_abs_sum_b
 
                     else:
                         if (risk_class == 'Risk_EquityVol') and (bucket == 12):
@@ -785,45 +737,16 @@ class MarginByRiskClass:
 
                         else:
                             list_K.append(K)
-                            S = max(min(sum(CVR_i), K), -K)
                             list_S.append(S)
-                            CVR_sum     += sum(CVR_i)
-                            CVR_abs_sum += sum([abs(CVR) for CVR in CVR_i])
+                            CVR_sum     += direction * CVR_sum_b
+                            CVR_abs_sum += CVR_abs_sum_b
 
             elif risk_class in fx:
-                list_CVR = []
-                for currency_pair in utils.currencyPair_list(self.crif):
-                    pair_list = [currency_pair, currency_pair[3:]+currency_pair[:3]]
-                    df = self.crif[(self.crif['RiskType']  == risk_class) & (self.crif['Qualifier'].isin(pair_list))]
-            
-                    is_ccy1_high_vol = currency_pair[:3] in wnc.high_vol_currency_group
-                    is_ccy2_high_vol = currency_pair[3:] in wnc.high_vol_currency_group
-
-                    fx_vol_group1 = 'High' if is_ccy1_high_vol else 'Regular'
-                    fx_vol_group2 = 'High' if is_ccy2_high_vol else 'Regular'
-
-                    RW = wnc.fx_rw[fx_vol_group2][fx_vol_group1]
-                                                       
-                    sigma = RW * sqrt(365/14)/norm.ppf(0.99)                
-                    list_vega  = df['AmountUSD'].to_list()
-                    tenor_list = df['Label1'].to_list()
-
-                    CVR = 0
-                    for k, vega in zip(tenor_list, list_vega):
-                        CVR += utils.scaling_func(k) * sigma * vega
-                                     
-                    list_CVR.append(CVR)  
-                    
-
-                K = k_curvature(risk_class, list_CVR)
-                list_K.append(K)
-
-                CVR_sum     += sum([CVR for CVR in list_CVR]) 
-                CVR_abs_sum += sum([abs(CVR) for CVR in list_CVR]) 
+                K, CVR_sum, CVR_abs_sum = self._vol_measures(risk_class)[1]
+                CVR_sum = direction * CVR_sum
 
-
-                theta  = 0 if isnan(CVR_sum/CVR_abs_sum) else min(CVR_sum/CVR_abs_sum, 0)
-                _lambda = (norm.ppf(0.995)**2 - 1) * (1 + theta) - theta
+                theta  = utils.curvature_theta(CVR_sum, CVR_abs_sum)
+                _lambda = (utils.NORM_PPF_995**2 - 1) * (1 + theta) - theta
                 updates['FX']['Curvature'] += max(CVR_sum + _lambda * K, 0)
                 
             
@@ -836,51 +759,34 @@ class MarginByRiskClass:
             else:
                 # Exceptions on _lambda & theta for Residual bucket
                 if ( 0 in utils.unique_list(bucket_list) ) and ( len(utils.unique_list(bucket_list)) > 1 ):
-                    theta   = min(CVR_sum/CVR_abs_sum, 0)
-                    _lambda = (norm.ppf(0.995)**2 - 1) * (1 + theta) - theta
+                    theta   = utils.curvature_theta(CVR_sum, CVR_abs_sum)
+                    _lambda = (utils.NORM_PPF_995**2 - 1) * (1 + theta) - theta
 
-                    theta_res   = min(CVR_sum_res/CVR_abs_sum_res, 0)
-                    _lambda_res = (norm.ppf(0.995)**2 - 1) * (1 + theta_res) - theta_res
+                    theta_res   = utils.curvature_theta(CVR_sum_res, CVR_abs_sum_res)
+                    _lambda_res = (utils.NORM_PPF_995**2 - 1) * (1 + theta_res) - theta_res
 
                 elif 0 not in bucket_list:               
-                    theta   = min(CVR_sum/CVR_abs_sum, 0)
-                    _lambda = (norm.ppf(0.995)**2 - 1) * (1 + theta) - theta
+                    theta   = utils.curvature_theta(CVR_sum, CVR_abs_sum)
+                    _lambda = (utils.NORM_PPF_995**2 - 1) * (1 + theta) - theta
 
                     theta_res   = 0
                     _lambda_res = 0
                 
                 elif ( 0 in utils.unique_list(bucket_list) ) and ( len(utils.unique_list(bucket_list)) == 1 ):
                     
-                    theta_res  = min(CVR_sum_res/CVR_abs_sum_res, 0)
-                    _lambda_res = (norm.ppf(0.995)**2 - 1) * (1 + theta_res) - theta_res
+                    theta_res  = utils.curvature_theta(CVR_sum_res, CVR_abs_sum_res)
+                    _lambda_res = (utils.NORM_PPF_995**2 - 1) * (1 + theta_res) - theta_res
                 
                     theta   = 0
                     _lambda = 0
                 
 
-                K_squared = sum([K**2 for K in list_K])
-                if risk_class not in fx:
-
-                    if 0 in bucket_list:
-                        bucket_list.remove(0)
-
-                    for i in range(len(list_S)):
-                        for j in range(len(list_S)):
-
-                            if i == j:
-                                continue
-
-                            else:  
-                                if risk_class in equity + commodity + credit:
-                                    bucket_i = str(bucket_list[i])
-                                    bucket_j = str(bucket_list[j])
-
-                                    if risk_class == 'Risk_CreditVolNonQ':
-                                        gamma = wnc.gamma(risk_class)
-                                    else:
-                                        gamma = wnc.gamma(risk_class, bucket_i, bucket_j)
+                if 0 in bucket_list:
+                    bucket_list.remove(0)
 
-                                    K_squared += list_S[i] * list_S[j] * (gamma**2)
+                # Gammas are read by position in bucket_list, which still holds equity bucket 12
+                gamma = self.params.gamma_matrix(risk_class, bucket_list[:len(list_S)])
+                K_squared = cross_bucket_k_squared(list_K, list_S, gamma**2)
 
                 curvature_margin_non_res = max(CVR_sum + _lambda * sqrt(K_squared), 0)
                 curvature_margin_res    = max(CVR_sum_res + _lambda_res * K_Res, 0)
@@ -898,23 +804,25 @@ class MarginByRiskClass:
                 elif risk_class == 'Risk_CreditVolNonQ':
                     updates['CreditNonQ']['Curvature'] += curvature_margin_non_res + curvature_margin_res
             
-        return pd.DataFrame(updates)
-
+        return updates
 
     def BaseCorrMargin(self) -> pd.DataFrame:
         """Base correlation margin for qualifying credit."""
-        updates = deepcopy(dict_margin_by_risk_class)
-        crif_base_corr = self.crif[(self.crif['RiskType'] == 'Risk_BaseCorr')]
+        return pd.DataFrame(self._base_corr_margins())
+
+    def _base_corr_margins(self) -> Dict[str, Dict[str, float]]:
+        """BaseCorrMargin by risk class and measure."""
+        updates = _zero_margins()
+        crif_base_corr, codes = self._coded_rows('Risk_BaseCorr')
         if crif_base_corr.empty:
             LOGGER.debug("No base correlation risk types found; base corr margin is zero.")
-            return pd.DataFrame(updates)
+            return updates
         list_WS = []
 
         qualifier_list = utils.unique_list(crif_base_corr, 'Qualifier')
         for qualifier in qualifier_list:
-            crif_qualifier = crif_base_corr[crif_base_corr['Qualifier']==qualifier]
-            RW = wnc.base_corr_weight
-            sensitivities = utils.sum_sensitivities(crif_qualifier)
+            RW = self.params.base_corr_weight
+            sensitivities = codes.amount(equals(codes.qualifier, codes.qualifier_code(qualifier)))
             WS = RW * sensitivities
             list_WS.append(WS)
 
@@ -924,9 +832,32 @@ class MarginByRiskClass:
                 if (i == j) or (qualifier[i]==qualifier[j]):
                     rho = 1
                 else:
-                    rho = wnc.rho('Risk_BaseCorr')
+                    rho = self.params.rho('Risk_BaseCorr')
 
                 BaseCorr += list_WS[i]*list_WS[j]*rho
 
         updates['CreditQ']['BaseCorr'] += sqrt(BaseCorr)
-        return pd.DataFrame(updates) 
+        return updates
+
+    # All measures at once: adding dicts instead of the measure frames keeps cached buckets cheap
+    def margins_by_direction(self, directions: Tuple[int, ...] = (1,)) -> Dict[int, Dict[str, Dict[str, float]]]:
+        """Margins by risk class and measure per curvature direction (BaseCorr only for CreditQ)."""
+        shared = [
+            self._ir_delta_margins(),
+            self._delta_margins(),
+            self._ir_vega_margins(),
+            self._vega_margins(),
+            self._base_corr_margins(),
+        ]
+
+        margins_by_direction = {}
+        for direction in directions:
+            dict_margins = _add_margins(shared + [self._ir_curvature_margins(direction), self._curvature_margins(direction)])
+
+            # BaseCorr only presents in the CreditQ
+            for dict_risk_class in dict_margins:
+                if dict_risk_class != 'CreditQ':
+                    del dict_margins[dict_risk_class]['BaseCorr']
+
+            margins_by_direction[direction] = dict_margins
+        return margins_by_direction
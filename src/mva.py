@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import logging
+import math
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+import pandas as pd
+
+from . import utils
+from . import wnc
+from .agg_margins import SIMM
+from .bucket_cache import BucketCache
+from .sensivities_ageing import tenor_vectors
+
+
+LOGGER = logging.getLogger(__name__)
+
+DAYS_PER_YEAR = 365.0
+
+Curve = Union[float, Callable[[float], float]]
+
+
+@dataclass
+class MVAResult:
+    """MVA with the IM profile it was integrated from."""
+
+    mva: float
+    profile: pd.DataFrame
+    simm_evaluations: int
+
+
+def _spread_function(funding_spread: Curve) -> Callable[[float], float]:
+    """Funding spread as a function of time in years (flat if a number)."""
+    if callable(funding_spread):
+        return funding_spread
+    return lambda t: float(funding_spread)
+
+
+def _discount_function(discount_curve: Curve) -> Callable[[float], float]:
+    """Discount factor as a function of time in years.
+
+    A number is read as a flat continuously compounded rate.
+    """
+    if callable(discount_curve):
+        return discount_curve
+    return lambda t: math.exp(-float(discount_curve) * t)
+
+
+def _aged_simm(
+    aged: pd.DataFrame,
+    calculation_currency: str,
+    exchange_rate: float,
+    bucket_cache: BucketCache,
+    parameters: Optional[wnc.ParameterPack] = None,
+) -> float:
+    """SIMM of an aged CRIF; zero once every sensitivity has matured."""
+    if not utils.product_list(aged):
+        return 0.0
+    return SIMM(aged, calculation_currency, exchange_rate, bucket_cache=bucket_cache, parameters=parameters).simm
+
+
+def aged_simm_profile(
+    crif: pd.DataFrame,
+    day_offsets: Sequence[float],
+    calculation_currency: str,
+    exchange_rate: float,
+    tenors: Optional[Sequence[str]] = None,
+    bucket_cache: Optional[BucketCache] = None,
+    parameters: Optional[wnc.ParameterPack] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> pd.Series:
+    """SIMM of the CRIF aged to each day offset.
+
+    ``progress(done, total)`` is called after each horizon.
+
+    All horizons share one bucket cache. Only the buckets whose rows moved
+    between horizons (Rates and Credit tenor buckets) are recomputed; Equity,
+    Commodity and FX buckets are reused together with their K_b and S_b.
+    """
+    cache = bucket_cache if bucket_cache is not None else BucketCache()
+    day_offsets = list(day_offsets)
+    profile: Dict[float, float] = {}
+    for offset, aged in tenor_vectors(crif, tenors).iter_aged(day_offsets):
+        profile[offset] = _aged_simm(aged, calculation_currency, exchange_rate, cache, parameters)
+        if progress is not None:
+            progress(len(profile), len(day_offsets))
+    LOGGER.debug("Aged SIMM profile: %d bucket cache hits, %d misses.", cache.hits, cache.misses)
+    return pd.Series(profile, name='SIMM')
+
+
+class MVACalculator:
+    """Integrate the discounted funding cost of the aged SIMM profile.
+
+    MVA = integral over t of s(t) * D(t) * IM(t) dt, reported as a positive
+    funding cost, where IM(t) is the SIMM of the CRIF aged by t. The horizon
+    grid starts from the roll-off points of the booked tenors and intervals
+    are bisected only where the trapezoid estimate still moves by more than
+    their share of the tolerance.
+    """
+
+    def __init__(
+        self,
+        crif: pd.DataFrame,
+        calculation_currency: str,
+        exchange_rate: float,
+        funding_spread: Curve,
+        discount_curve: Curve = 0.0,
+        tenors: Optional[Sequence[str]] = None,
+        parameters: Optional[wnc.ParameterPack] = None,
+    ) -> None:
+        self.calculation_currency = calculation_currency
+        self.exchange_rate = exchange_rate
+        self.parameters = parameters
+        self.spread = _spread_function(funding_spread)
+        self.discount = _discount_function(discount_curve)
+        self.vectors = tenor_vectors(crif, tenors)
+        self.bucket_cache = BucketCache()
+        self.im: Dict[float, float] = {}
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def _evaluate(self, days: Sequence[float]) -> None:
+        """Run SIMM on the CRIF aged to each horizon not yet evaluated."""
+        pending = sorted(set(days) - set(self.im))
+        for offset, aged in self.vectors.iter_aged(pending):
+            self.im[offset] = _aged_simm(
+                aged, self.calculation_currency, self.exchange_rate, self.bucket_cache, self.parameters,
+            )
+
+    def _integrand(self, day: float) -> float:
+        t = day / DAYS_PER_YEAR
+        return self.spread(t) * self.discount(t) * self.im[day]
+
+    def _trapezoid(self, a: float, b: float) -> float:
+        return 0.5 * (b - a) / DAYS_PER_YEAR * (self._integrand(a) + self._integrand(b))
+
+    def calculate(
+        self,
+        horizon_days: Optional[float] = None,
+        tolerance: float = 1e-3,
+        min_step_days: float = 1.0,
+        max_evaluations: int = 2000,
+    ) -> MVAResult:
+        """Integrate the IM profile up to ``horizon_days``.
+
+        ``tolerance`` is relative to the MVA: refinement stops once the
+        estimated integration error of every interval is below its share of
+        ``tolerance * |MVA|``, intervals reach ``min_step_days`` or the SIMM
+        evaluation budget is spent. The horizon defaults to the longest tenor
+        booked in the CRIF.
+        """
+        end = float(horizon_days) if horizon_days is not None else self.vectors.max_tenor_days()
+        if end <= 0:
+            raise ValueError("MVA horizon must be positive; no tenor sensitivities found in the CRIF.")
+
+        grid = sorted({0.0, end} | {day for day in self.vectors.roll_off_days() if 0 < day < end})
+        self._evaluate(grid)
+
+        intervals = list(zip(grid[:-1], grid[1:]))
+        while intervals and len(self.im) < max_evaluations:
+            self._evaluate([(a + b) / 2 for a, b in intervals])
+
+            estimate = sum(self._trapezoid(a, b) for a, b in zip(grid[:-1], grid[1:]))
+            budget = tolerance * abs(estimate)
+
+            refine: List[tuple] = []
+            for a, b in intervals:
+                m = (a + b) / 2
+                coarse = self._trapezoid(a, b)
+                fine = self._trapezoid(a, m) + self._trapezoid(m, b)
+                grid.append(m)
+                if abs(fine - coarse) > budget * (b - a) / end and (b - a) / 2 > min_step_days:
+                    refine.extend([(a, m), (m, b)])
+
+            grid.sort()
+            intervals = refine
+            self.logger.debug("MVA refinement: %d SIMM runs, %d intervals left.", len(self.im), len(intervals))
+
+        if intervals:
+            self.logger.warning("MVA stopped at %d SIMM evaluations before reaching the tolerance.", len(self.im))
+
+        mva = sum(self._trapezoid(a, b) for a, b in zip(grid[:-1], grid[1:]))
+        profile = pd.DataFrame({'Days': grid})
+        profile['Years'] = profile['Days'] / DAYS_PER_YEAR
+        profile['IM'] = [self.im[day] for day in grid]
+        profile['FundingSpread'] = [self.spread(t) for t in profile['Years']]
+        profile['DiscountFactor'] = [self.discount(t) for t in profile['Years']]
+        self.logger.info(
+            "MVA %s from %d SIMM evaluations (%d bucket cache hits, %d misses).",
+            mva, len(self.im), self.bucket_cache.hits, self.bucket_cache.misses,
+        )
+        return MVAResult(mva=mva, profile=profile, simm_evaluations=len(self.im))
+
+
+def calculate_mva(
+    crif: pd.DataFrame,
+    calculation_currency: str,
+    exchange_rate: float,
+    funding_spread: Curve,
+    discount_curve: Curve = 0.0,
+    horizon_days: Optional[float] = None,
+    tolerance: float = 1e-3,
+    tenors: Optional[Sequence[str]] = None,
+    parameters: Optional[wnc.ParameterPack] = None,
+) -> MVAResult:
+    """Compute MVA for a CRIF portfolio with adaptive horizon refinement."""
+    calculator = MVACalculator(
+        crif, calculation_currency, exchange_rate, funding_spread, discount_curve,
+        tenors=tenors, parameters=parameters,
+    )
+    return calculator.calculate(horizon_days=horizon_days, tolerance=tolerance)
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from . import (
+    list_creditQ,
+    list_credit_nonQ,
+    list_equity,
+    list_commodity,
+    list_rates,
+    list_fx,
+)
+
+if TYPE_CHECKING:
+    from .wnc import ParameterPack
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Thresholds are quoted in USD millions
+THRESHOLD_UNIT = 1000000
+
+
+def _resolve(columns: Sequence[Iterable[Any]], lookup: Callable[..., float]) -> np.ndarray:
+    """Apply a scalar lookup to each distinct row of the key columns and broadcast back."""
+    rows = list(zip(*columns))
+    if not rows:
+        return np.empty(0, dtype='float64')
+    keys = np.empty(len(rows), dtype=object)
+    keys[:] = rows
+    codes, uniques = pd.factorize(keys, use_na_sentinel=False)
+    values = np.array([lookup(*key) for key in uniques], dtype='float64')
+    return values[codes]
+
+
+class ParameterResolver:
+    """Risk weights, VRW, HVR and concentration thresholds of one parameter pack.
+
+    The list and try/except lookups of the parameter modules are compiled
+    once into dictionaries keyed by risk type, bucket and currency. The
+    scalar methods back ``ParameterPack.RW``/``T``; the array methods
+    resolve whole columns, evaluating each distinct key once.
+    """
+
+    def __init__(self, pack: ParameterPack) -> None:
+        self.version = pack.version
+
+        # Rates: currency -> volatility group -> tenor risk weights
+        self.ir_vol_group: Dict[str, str] = {currency: 'Low' for currency in pack.low_vol_ccy_bucket}
+        self.ir_vol_group.update({currency: 'Regular' for currency in pack.reg_vol_ccy_bucket})
+        self.ir_rw: Dict[str, Dict[str, float]] = {
+            'Regular': pack.reg_vol_rw, 'Low': pack.low_vol_rw, 'High': pack.high_vol_rw,
+        }
+
+        # FX: currency -> category (1, 2, 3 = others) and volatility group
+        self.fx_category: Dict[str, int] = {currency: 2 for currency in pack.fx_category2}
+        self.fx_category.update({currency: 1 for currency in pack.fx_category1})
+        self.fx_high_vol = frozenset(pack.high_vol_currency_group)
+        self.fx_rw: Dict[str, Dict[str, float]] = pack.fx_rw
+
+        # Risk type -> bucket tables
+        self.rw: Dict[str, Dict[int, float]] = {}
+        self.delta_ct: Dict[str, Any] = {}
+        self.vega_ct: Dict[str, Any] = {}
+        self.vrw: Dict[str, float] = {}
+        self.hvr: Dict[str, float] = {}
+        for risk_type in list_creditQ:
+            self.rw[risk_type] = pack.creditQ_rw
+            self.delta_ct[risk_type] = pack.credit_delta_CT['Qualifying']
+            self.vega_ct[risk_type] = pack.credit_vega_CT['Qualifying']
+            self.vrw[risk_type] = pack.creditQ_vrw
+        for risk_type in list_credit_nonQ:
+            self.rw[risk_type] = pack.creiditNonQ_rw
+            self.delta_ct[risk_type] = pack.credit_delta_CT['Non-Qualifying']
+            self.vega_ct[risk_type] = pack.credit_vega_CT['Non-Qualifying']
+            self.vrw[risk_type] = pack.creditNonQ_vrw
+        for risk_type in list_equity:
+            self.rw[risk_type] = pack.equity_rw
+            self.delta_ct[risk_type] = pack.equity_delta_CT
+            self.vega_ct[risk_type] = pack.equity_vega_CT
+            self.vrw[risk_type] = pack.equity_vrw
+            self.hvr[risk_type] = pack.equity_hvr
+        for risk_type in list_commodity:
+            self.rw[risk_type] = pack.commodity_rw
+            self.delta_ct[risk_type] = pack.commodity_delta_CT
+            self.vega_ct[risk_type] = pack.commodity_vega_CT
+            self.vrw[risk_type] = pack.commodity_vrw
+            self.hvr[risk_type] = pack.commodity_hvr
+        for risk_type in list_rates:
+            self.vrw[risk_type] = pack.ir_vrw
+            self.hvr[risk_type] = pack.ir_hvr
+        for risk_type in list_fx:
+            self.vrw[risk_type] = pack.fx_vrw
+            self.hvr[risk_type] = pack.fx_hvr
+
+        self.ir_delta_ct: Dict[str, float] = pack.ir_delta_CT
+        self.ir_vega_ct: Dict[str, float] = pack.ir_vega_CT
+        self.fx_delta_ct: Dict[int, float] = {
+            1: pack.fx_delta_CT['Category1'], 2: pack.fx_delta_CT['Category2'], 3: pack.fx_delta_CT['Others'],
+        }
+        self.fx_vega_ct: Dict[tuple, float] = {}
+        for pair, threshold in pack.fx_vega_CT.items():
+            category1, category2 = (int(part[-1]) for part in pair.split('-'))
+            self.fx_vega_ct[(category1, category2)] = self.fx_vega_ct[(category2, category1)] = threshold
+        self.equity_vrw_bucket_12: float = pack.equity_vrw_bucket_12
+
+    # Scalar lookups
+
+    def risk_weight(self, risk_type: str, bucket: int) -> float:
+        """Delta risk weight of a credit, equity or commodity bucket."""
+        if risk_type not in self.rw:
+            raise KeyError(f"Unsupported risk class for RW: {risk_type}")
+        return self.rw[risk_type][bucket]
+
+    def ir_risk_weight(self, currency: str, tenor: str) -> float:
+        """Delta risk weight of a rates tenor, by the currency's volatility group."""
+        return self.ir_rw[self.ir_vol_group.get(currency, 'High')][tenor]
+
+    def fx_risk_weight(self, currency: str, calculation_currency: str) -> float:
+        """FX risk weight of a currency against the calculation currency group."""
+        group = 'High' if currency in self.fx_high_vol else 'Regular'
+        calculation_group = 'High' if calculation_currency in self.fx_high_vol else 'Regular'
+        return self.fx_rw[group][calculation_group]
+
+    def fx_pair_risk_weight(self, currency_pair: str) -> float:
+        """FX risk weight of a currency pair, as used by FX vega and curvature."""
+        return self.fx_risk_weight(currency_pair[3:6], currency_pair[:3])
+
+    def vega_risk_weight(self, risk_type: str, bucket: Optional[int] = None) -> float:
+        if risk_type in list_equity and bucket == 12:
+            return self.equity_vrw_bucket_12
+        return self.vrw[risk_type]
+
+    def threshold(self, risk_type: str, measure: str, currency: Optional[str] = None, bucket: Optional[int] = None) -> float:
+        """Delta or vega concentration threshold (in USD)."""
+        if measure == 'Delta':
+            if risk_type == 'Rates' or risk_type in list_rates:
+                value = self.ir_delta_ct.get(currency, self.ir_delta_ct['Others'])
+            elif risk_type in list_fx:
+                value = self.fx_delta_ct[self.fx_category.get(currency, 3)]
+            elif risk_type in self.delta_ct:
+                value = self.delta_ct[risk_type][bucket]
+            else:
+                raise KeyError(f"Unsupported risk class for T: {risk_type}")
+        elif measure == 'Vega':
+            if risk_type == 'Rates' or risk_type in list_rates:
+                value = self.ir_vega_ct.get(currency, self.ir_vega_ct['Others'])
+            elif risk_type in list_fx:
+                value = self.fx_vega_ct[(self.fx_category.get(currency[0:3], 3), self.fx_category.get(currency[3:6], 3))]
+            elif risk_type in self.vega_ct:
+                value = self.vega_ct[risk_type]
+                value = value[bucket] if isinstance(value, dict) else value
+            else:
+                raise KeyError(f"Unsupported risk class for T: {risk_type}")
+        else:
+            raise KeyError(f"Unsupported risk measure for T: {measure}")
+        return value * THRESHOLD_UNIT
+
+    # Column lookups (one value per row)
+
+    def risk_weights(self, risk_types: Iterable[str], buckets: Iterable[int]) -> np.ndarray:
+        return _resolve([risk_types, buckets], self.risk_weight)
+
+    def ir_risk_weights(self, currencies: Iterable[str], tenors: Iterable[str]) -> np.ndarray:
+        return _resolve([currencies, tenors], self.ir_risk_weight)
+
+    def fx_risk_weights(self, currencies: Iterable[str], calculation_currency: str) -> np.ndarray:
+        return _resolve([currencies], lambda currency: self.fx_risk_weight(currency, calculation_currency))
+
+    def fx_pair_risk_weights(self, currency_pairs: Iterable[str]) -> np.ndarray:
+        return _resolve([currency_pairs], self.fx_pair_risk_weight)
+
+    def vega_risk_weights(self, risk_types: Iterable[str], buckets: Iterable[Optional[int]]) -> np.ndarray:
+        return _resolve([risk_types, buckets], self.vega_risk_weight)
+
+    def historical_volatility_ratios(self, risk_types: Iterable[str]) -> np.ndarray:
+        return _resolve([risk_types], lambda risk_type: self.hvr[risk_type])
+
+    def thresholds(
+        self,
+        risk_types: Iterable[str],
+        measure: str,
+        currencies: Optional[Iterable[Optional[str]]] = None,
+        buckets: Optional[Iterable[Optional[int]]] = None,
+    ) -> np.ndarray:
+        risk_types = np.asarray(risk_types, dtype=object)
+        currencies = [None] * len(risk_types) if currencies is None else currencies
+        buckets = [None] * len(risk_types) if buckets is None else buckets
+        return _resolve(
+            [risk_types, currencies, buckets],
+            lambda risk_type, currency, bucket: self.threshold(risk_type, measure, currency, bucket),
+        )
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import logging
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from . import utils
+from .agg_margins import SIMM
+
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_STORE_PATH = "results/simm_results.db"
+
+# Breakdown columns of SIMM.simm_break_down and their stored names
+BREAKDOWN_COLUMNS = {
+    'Product Class': 'product_class',
+    'SIMM_ProductClass': 'simm_product_class',
+    'Risk Class': 'risk_class',
+    'SIMM_RiskClass': 'simm_risk_class',
+    'Risk Measure': 'risk_measure',
+    'SIMM_RiskMeasure': 'simm_risk_measure',
+}
+
+RUN_KEYS = ('portfolio', 'calc_date', 'version', 'input_hash', 'calculation_currency', 'exchange_rate')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id               INTEGER PRIMARY KEY AUTOINCREMENT,
+    portfolio            TEXT NOT NULL,
+    calc_date            TEXT NOT NULL,
+    version              TEXT NOT NULL,
+    input_hash           TEXT NOT NULL,
+    calculation_currency TEXT NOT NULL,
+    exchange_rate        REAL NOT NULL,
+    simm_total           REAL NOT NULL,
+    add_on               REAL NOT NULL DEFAULT 0,
+    created_at           TEXT NOT NULL,
+    UNIQUE (portfolio, calc_date, version, input_hash, calculation_currency, exchange_rate)
+);
+CREATE INDEX IF NOT EXISTS idx_runs_portfolio_date ON runs (portfolio, calc_date);
+CREATE INDEX IF NOT EXISTS idx_runs_calc_date ON runs (calc_date);
+CREATE INDEX IF NOT EXISTS idx_runs_version ON runs (version);
+CREATE INDEX IF NOT EXISTS idx_runs_input_hash ON runs (input_hash);
+
+CREATE TABLE IF NOT EXISTS breakdown (
+    run_id             INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    product_class      TEXT NOT NULL,
+    simm_product_class REAL,
+    risk_class         TEXT NOT NULL,
+    simm_risk_class    REAL,
+    risk_measure       TEXT NOT NULL,
+    simm_risk_measure  REAL
+);
+CREATE INDEX IF NOT EXISTS idx_breakdown_run ON breakdown (run_id);
+"""
+
+
+@dataclass
+class StoredResult:
+    """A SIMM result read back from the store."""
+
+    run_id: int
+    portfolio: str
+    calc_date: str
+    version: str
+    input_hash: str
+    calculation_currency: str
+    exchange_rate: float
+    simm: float
+    add_on: float
+    created_at: str
+    simm_break_down: pd.DataFrame
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Flat JSON-friendly view, with the breakdown as records."""
+        return {
+            'run_id': self.run_id,
+            'portfolio': self.portfolio,
+            'calc_date': self.calc_date,
+            'version': self.version,
+            'input_hash': self.input_hash,
+            'calculation_currency': self.calculation_currency,
+            'exchange_rate': self.exchange_rate,
+            'simm_total': self.simm,
+            'add_on': self.add_on,
+            'created_at': self.created_at,
+            'breakdown': self.simm_break_down.to_dict(orient='records'),
+        }
+
+
+class ResultStore:
+    """SQLite store of SIMM totals and flat breakdowns.
+
+    Runs are keyed by portfolio, calculation date, parameter version, input
+    hash, calculation currency and exchange rate; saving a run with an
+    existing key replaces it. Every key column is indexed.
+    """
+
+    def __init__(self, path: str | Path = DEFAULT_STORE_PATH) -> None:
+        self.path = Path(path)
+        if self.path.parent != Path('.'):
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> ResultStore:
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def save(
+        self,
+        portfolio: SIMM,
+        portfolio_id: str,
+        calc_date: str,
+        input_hash: Optional[str] = None,
+    ) -> int:
+        """Write a SIMM result and its breakdown, returning the run id."""
+        input_hash = input_hash or utils.input_hash(portfolio.crif)
+        breakdown = portfolio.simm_break_down.reset_index()
+        add_on = float(breakdown['Add-On'].iloc[0]) if 'Add-On' in breakdown.columns and len(breakdown) else 0.0
+        key = (portfolio_id, str(calc_date), portfolio.params.version, input_hash,
+               portfolio.calc_currency, float(portfolio.exchange_rate))
+
+        rows = breakdown.reindex(columns=list(BREAKDOWN_COLUMNS)).itertuples(index=False, name=None)
+        with self.connection:
+            self.connection.execute(
+                f"DELETE FROM runs WHERE {' AND '.join(f'{column} = ?' for column in RUN_KEYS)}", key,
+            )
+            cursor = self.connection.execute(
+                "INSERT INTO runs (portfolio, calc_date, version, input_hash, calculation_currency, exchange_rate,"
+                " simm_total, add_on, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                key + (float(portfolio.simm), add_on, datetime.now(timezone.utc).isoformat(timespec='seconds')),
+            )
+            run_id = int(cursor.lastrowid)
+            self.connection.executemany(
+                f"INSERT INTO breakdown (run_id, {', '.join(BREAKDOWN_COLUMNS.values())}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(run_id,) + tuple(_sql_value(value) for value in row) for row in rows],
+            )
+
+        LOGGER.info("Stored SIMM run %d for %s on %s (%d breakdown rows).", run_id, portfolio_id, calc_date, len(breakdown))
+        return run_id
+
+    def find(self, **keys: Any) -> pd.DataFrame:
+        """List stored runs (without breakdowns) matching the given key columns, newest first."""
+        unknown = set(keys) - set(RUN_KEYS)
+        if unknown:
+            raise KeyError(f"Unsupported result store keys: {sorted(unknown)}")
+
+        filters = {column: value for column, value in keys.items() if value is not None}
+        where = ' AND '.join(f'{column} = ?' for column in filters) or '1 = 1'
+        return pd.read_sql_query(
+            f"SELECT * FROM runs WHERE {where} ORDER BY calc_date DESC, run_id DESC",
+            self.connection,
+            params=list(filters.values()),
+        )
+
+    def load(self, run_id: int) -> Optional[StoredResult]:
+        """Read a stored run with its breakdown."""
+        runs = pd.read_sql_query("SELECT * FROM runs WHERE run_id = ?", self.connection, params=[run_id])
+        if runs.empty:
+            return None
+
+        run = runs.iloc[0]
+        breakdown = pd.read_sql_query(
+            f"SELECT {', '.join(BREAKDOWN_COLUMNS.values())} FROM breakdown WHERE run_id = ? ORDER BY rowid",
+            self.connection,
+            params=[run_id],
+        ).rename(columns={stored: column for column, stored in BREAKDOWN_COLUMNS.items()})
+        # SIMM.simm_break_down carries the rounded totals
+        breakdown.insert(0, 'SIMM Total', round(run['simm_total'], 2))
+        if run['add_on']:
+            breakdown.insert(1, 'Add-On', run['add_on'])
+
+        return StoredResult(
+            run_id=int(run['run_id']),
+            portfolio=run['portfolio'],
+            calc_date=run['calc_date'],
+            version=run['version'],
+            input_hash=run['input_hash'],
+            calculation_currency=run['calculation_currency'],
+            exchange_rate=float(run['exchange_rate']),
+            simm=float(run['simm_total']),
+            add_on=float(run['add_on']),
+            created_at=run['created_at'],
+            simm_break_down=breakdown,
+        )
+
+    def latest(self, **keys: Any) -> Optional[StoredResult]:
+        """Read the most recent run matching the given key columns."""
+        runs = self.find(**keys)
+        if runs.empty:
+            return None
+        return self.load(int(runs['run_id'].iloc[0]))
+
+    def run_ids(self, **keys: Any) -> List[int]:
+        return [int(run_id) for run_id in self.find(**keys)['run_id']]
+
+
+def _sql_value(value: Any) -> Any:
+    # numpy scalars are not accepted by sqlite3
+    if pd.isna(value):
+        return None
+    return value.item() if hasattr(value, 'item') else value
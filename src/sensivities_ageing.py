@@ -2,15 +2,23 @@ from __future__ import annotations
 
 import logging
 from dataclasses import dataclass
-from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
 from . import simm_tenor_list
+from . import utils
 
 
 LOGGER = logging.getLogger(__name__)
 
+AMOUNT_COLUMNS = ("Amount", "AmountUSD")
+
+# Memory allowed for the aged vectors of one chunk of horizons, which bounds the chunk size
+AGEING_CHUNK_BYTES = 128 << 20
+
 
 @dataclass(frozen=True)
 class TenorBucket:
@@ -76,15 +84,145 @@ def _bucket_remaining_tenor(
     return [(lower.tenor, weight_lower), (upper.tenor, weight_upper)]
 
 
-def age_sensitivities(
-    crif: pd.DataFrame,
-    tenors: Optional[Sequence[str]] = None,
-) -> Dict[str, pd.DataFrame]:
-    """Age spot sensitivities across SIMM tenor buckets.
+def tenor_transition_matrix(
+    ageing_days: float,
+    source: Sequence[TenorBucket],
+    buckets: List[TenorBucket],
+) -> sparse.csr_matrix:
+    """Build the sparse tenor-transition matrix for one ageing horizon.
 
-    Returns a dictionary keyed by "0D" (spot) and each tenor in the input list.
-    For each tenor key, the CRIF sensitivities are aged by rolling down the
-    Label1 tenor bucket by that amount. Sensitivities that mature are dropped.
+    Row i holds the prorata temporis weights that move a sensitivity booked at
+    ``source[i]`` onto ``buckets`` after ``ageing_days``. Matured rows are empty.
+    """
+    position = {bucket.tenor: idx for idx, bucket in enumerate(buckets)}
+    rows: List[int] = []
+    cols: List[int] = []
+    weights: List[float] = []
+    for idx, tenor_bucket in enumerate(source):
+        for tenor, weight in _bucket_remaining_tenor(tenor_bucket.days - ageing_days, buckets):
+            if weight == 0:
+                continue
+            rows.append(idx)
+            cols.append(position[tenor])
+            weights.append(weight)
+    return sparse.csr_matrix((weights, (rows, cols)), shape=(len(source), len(buckets)))
+
+
+def _source_tenors(labels: pd.Series, buckets: List[TenorBucket]) -> Tuple[List[TenorBucket], np.ndarray]:
+    """Map Label1 values to source tenor indices, -1 for non-tenor labels.
+
+    The source axis starts with the bucket tenors and is extended by any other
+    parseable tenor (e.g. "7y") found in the CRIF.
+    """
+    source = list(buckets)
+    position = {bucket.tenor: idx for idx, bucket in enumerate(source)}
+    lookup: Dict[str, int] = {}
+    for label in labels.unique():
+        label_str = str(label).lower()
+        if label_str not in position:
+            days = _tenor_to_days(label_str)
+            if days is None:
+                continue
+            position[label_str] = len(source)
+            source.append(TenorBucket(tenor=label_str, days=days))
+        lookup[label] = position[label_str]
+    codes = labels.map(lookup).fillna(-1).astype(np.int64).to_numpy()
+    return source, codes
+
+
+def _cell_keys(matrix: sparse.spmatrix, n_columns: int) -> np.ndarray:
+    """Sorted row-major keys (row * n_columns + column) of the stored cells of a sparse matrix."""
+    cells = matrix.tocoo()
+    return np.sort(cells.row.astype(np.int64) * n_columns + cells.col)
+
+
+@dataclass
+class TenorVectors:
+    """Per-risk-factor tenor vectors netted from a CRIF.
+
+    ``amounts`` maps each amount column to a sparse (n_factors x n_source)
+    matrix and ``presence`` flags the (factor, source tenor) cells booked in
+    the CRIF.
+    """
+
+    columns: List[str]
+    buckets: List[TenorBucket]
+    source: List[TenorBucket]
+    factors: pd.DataFrame
+    presence: sparse.csr_matrix
+    amounts: Dict[str, sparse.csr_matrix]
+    passthrough: pd.DataFrame
+
+    def chunk_size(self) -> int:
+        """Horizons per chunk, so that its aged vectors fit in ``AGEING_CHUNK_BYTES`` even if every cell is booked."""
+        # A stored cell is an 8-byte value and a 4-byte index, held twice while converted to columns
+        horizon_bytes = self.presence.shape[0] * len(self.buckets) * 24 * (1 + len(self.amounts))
+        return max(1, AGEING_CHUNK_BYTES // max(1, horizon_bytes))
+
+    def iter_aged(self, offsets: Sequence[float], chunk_size: Optional[int] = None) -> Iterator[Tuple[float, pd.DataFrame]]:
+        """Apply the tenor-transition matrices chunk by chunk and rebuild frames.
+
+        The products stay sparse; ``chunk_size`` defaults to the memory bound
+        of ``chunk_size()``.
+        """
+        n_buckets = len(self.buckets)
+        bucket_tenors = np.array([bucket.tenor for bucket in self.buckets], dtype=object)
+        chunk_size = chunk_size or self.chunk_size()
+        for start in range(0, len(offsets), chunk_size):
+            chunk = offsets[start:start + chunk_size]
+            block = sparse.hstack(
+                [tenor_transition_matrix(float(offset), self.source, self.buckets) for offset in chunk],
+                format="csr",
+            )
+            # Column slices of the products give the cells of each horizon
+            aged_presence = (self.presence @ block).tocsc()
+            aged_amounts = {column: (values @ block).tocsc() for column, values in self.amounts.items()}
+
+            for position, offset in enumerate(chunk):
+                horizon = slice(position * n_buckets, (position + 1) * n_buckets)
+                # Cells keyed factor by factor, tenor by tenor
+                cells = _cell_keys(aged_presence[:, horizon], n_buckets)
+                factor_idx, bucket_idx = np.divmod(cells, n_buckets)
+
+                aged_rows = self.factors.iloc[factor_idx].reset_index(drop=True)
+                aged_rows["Label1"] = bucket_tenors[bucket_idx]
+                for column, aged in aged_amounts.items():
+                    # Amounts that net to zero are not stored in the product and stay 0
+                    aged_horizon = aged[:, horizon].tocoo()
+                    values = np.zeros(len(cells))
+                    values[np.searchsorted(cells, aged_horizon.row.astype(np.int64) * n_buckets + aged_horizon.col)] = aged_horizon.data
+                    aged_rows[column] = values
+
+                df = pd.concat([self.passthrough, aged_rows[self.columns]], ignore_index=True)
+                LOGGER.debug("Aged sensitivities for %s days with %d rows.", offset, len(df))
+                yield offset, df
+
+    def max_tenor_days(self) -> float:
+        """Longest tenor booked in the CRIF, i.e. the last roll-off date."""
+        booked = self.presence.getnnz(axis=0) > 0
+        return max((tenor.days for tenor, flag in zip(self.source, booked) if flag), default=0.0)
+
+    def roll_off_days(self) -> List[float]:
+        """Horizons at which a booked tenor reaches a bucket or matures.
+
+        Between two consecutive roll-off points every transition weight is
+        linear in the horizon, so these are the kinks of the aged profile.
+        """
+        booked = self.presence.getnnz(axis=0) > 0
+        points = set()
+        for tenor, flag in zip(self.source, booked):
+            if not flag:
+                continue
+            points.add(tenor.days)
+            points.update(tenor.days - bucket.days for bucket in self.buckets if bucket.days < tenor.days)
+        return sorted(points)
+
+
+def tenor_vectors(crif: pd.DataFrame, tenors: Optional[Sequence[str]] = None) -> TenorVectors:
+    """Net the tenor rows of a CRIF into one tenor vector per risk factor.
+
+    A risk factor is identified by every column but Label1 and the amounts.
+    Rows with a non-tenor Label1 are kept aside unchanged.
     """
     tenor_list = list(tenors) if tenors is not None else list(simm_tenor_list)
     buckets = _tenor_buckets(tenor_list)
@@ -96,33 +234,89 @@ def age_sensitivities(
     if "AmountUSD" not in crif.columns:
         raise KeyError("CRIF data must include an AmountUSD column for prorata aging.")
 
-    aged: Dict[str, pd.DataFrame] = {"0D": crif.copy()}
+    source, source_codes = _source_tenors(crif["Label1"], buckets)
+    is_tenor = source_codes >= 0
+    tenor_rows = crif[is_tenor]
+
+    amount_columns = [column for column in AMOUNT_COLUMNS if column in crif.columns]
+    key_columns = [column for column in crif.columns if column != "Label1" and column not in amount_columns]
+
+    if key_columns:
+        factor_codes = tenor_rows.groupby(key_columns, dropna=False, sort=False).ngroup().to_numpy()
+    else:
+        factor_codes = np.zeros(len(tenor_rows), dtype=np.int64)
+    n_factors = int(factor_codes.max()) + 1 if len(factor_codes) else 0
+    _, first_rows = np.unique(factor_codes, return_index=True)
+
+    row_codes = source_codes[is_tenor]
+    shape = (n_factors, len(source))
+    # Duplicate (factor, tenor) rows are summed
+    amounts = {
+        column: sparse.csr_matrix((tenor_rows[column].to_numpy(dtype=float), (factor_codes, row_codes)), shape=shape)
+        for column in amount_columns
+    }
+    presence = sparse.csr_matrix((np.ones(len(factor_codes)), (factor_codes, row_codes)), shape=shape)
+
+    return TenorVectors(
+        columns=list(crif.columns),
+        buckets=buckets,
+        source=source,
+        factors=tenor_rows[key_columns].iloc[first_rows].reset_index(drop=True),
+        presence=presence,
+        amounts=amounts,
+        passthrough=crif[~is_tenor],
+    )
+
+
+def iter_aged_sensitivities(
+    crif: pd.DataFrame,
+    day_offsets: Iterable[float],
+    tenors: Optional[Sequence[str]] = None,
+    chunk_size: Optional[int] = None,
+) -> Iterator[Tuple[float, pd.DataFrame]]:
+    """Age spot sensitivities along an arbitrary grid of day offsets.
+
+    Each horizon is a sparse tenor-transition matrix. Horizons are applied in
+    chunks of ``chunk_size`` (by default bounded by ``AGEING_CHUNK_BYTES``) as
+    one batched sparse product against the sparse per-factor tenor vectors,
+    so neither the CRIF nor the vectors are expanded densely. Both
+    Amount and AmountUSD are rolled when present, and rows with a non-tenor
+    Label1 are passed through unchanged.
+
+    Yields ``(day_offset, aged_crif)`` pairs in the order of ``day_offsets``.
+    """
+    return tenor_vectors(crif, tenors).iter_aged(list(day_offsets), chunk_size)
+
+
+def age_sensitivities(
+    crif: pd.DataFrame,
+    tenors: Optional[Sequence[str]] = None,
+    low_memory: bool = False,
+) -> Dict[str, pd.DataFrame]:
+    """Age spot sensitivities across SIMM tenor buckets.
+
+    Returns a dictionary keyed by "0D" (spot) and each tenor in the input list.
+    For each tenor key, the CRIF sensitivities are aged by rolling down the
+    Label1 tenor bucket by that amount. Sensitivities that mature are dropped.
+
+    With ``low_memory`` the CRIF is first netted to the engine columns (see
+    utils.aggregate_sensitivities): every frame, spot included, holds only
+    those columns and the spot frame is not copied again.
+    """
+    tenor_list = list(tenors) if tenors is not None else list(simm_tenor_list)
+
+    ageing_tenors: List[str] = []
     for ageing_tenor in tenor_list:
-        ageing_days = _tenor_to_days(ageing_tenor)
-        if ageing_days is None:
+        if _tenor_to_days(ageing_tenor) is None:
             LOGGER.debug("Skipping unrecognized ageing tenor: %s", ageing_tenor)
             continue
+        ageing_tenors.append(ageing_tenor)
 
-        rows: List[dict] = []
-        for _, row in crif.iterrows():
-            label = row["Label1"]
-            label_str = str(label).lower()
-            original_days = _tenor_to_days(label_str)
-            if original_days is None:
-                rows.append(row.to_dict())
-                continue
-            remaining_days = original_days - ageing_days
-            allocations = _bucket_remaining_tenor(remaining_days, buckets)
-            if not allocations:
-                continue
-            for tenor, weight in allocations:
-                new_row = row.to_dict()
-                new_row["Label1"] = tenor
-                new_row["AmountUSD"] = new_row["AmountUSD"] * weight
-                rows.append(new_row)
-
-        df = pd.DataFrame(rows)
+    if low_memory:
+        crif = utils.aggregate_sensitivities(crif)
+    aged: Dict[str, pd.DataFrame] = {"0D": crif if low_memory else crif.copy()}
+    offsets = [_tenor_to_days(ageing_tenor) for ageing_tenor in ageing_tenors]
+    for ageing_tenor, (_, df) in zip(ageing_tenors, iter_aged_sensitivities(crif, offsets, tenor_list)):
         aged[ageing_tenor] = df
-        LOGGER.debug("Aged sensitivities for %s with %d rows.", ageing_tenor, len(df))
 
     return aged
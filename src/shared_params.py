@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from . import wnc
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Correlation matrices of a parameter pack; the other tables are small scalars and dicts
+MATRIX_TABLES = ('ir_corr', 'creditQ_corr_non_res', 'equity_corr_non_res', 'commodity_corr_non_res', 'corr_params')
+
+
+@dataclass(frozen=True)
+class SharedPackHandle:
+    """Picklable description of a parameter pack published in shared memory.
+
+    The correlation matrices live in the shared block; the other tables
+    (risk weights, thresholds, scalars) are small and travel in the handle.
+    """
+
+    version: str
+    block: str
+    layout: Tuple[Tuple[str, int, Tuple[int, ...]], ...]  # (table, byte offset, shape)
+    tables: Dict[str, Any]
+
+
+class SharedParameterPacks:
+    """Correlation matrices of several SIMM versions, compiled once into shared memory.
+
+    The publishing process owns the blocks and unlinks them on ``close``;
+    workers of its pools receive ``handles`` through the pool initializer
+    and call ``attach_parameter_packs``, which maps the matrices read-only
+    without copying them and builds the pack without importing its version
+    module. Pool workers share the publisher's resource tracker, so their
+    exit does not unlink the blocks.
+    """
+
+    def __init__(self, versions: Optional[Iterable[str]] = None) -> None:
+        self.blocks: List[shared_memory.SharedMemory] = []
+        self.handles: List[SharedPackHandle] = []
+        for version in (wnc.available_versions() if versions is None else versions):
+            self._publish(version)
+
+    def _publish(self, version: str) -> None:
+        all_tables = wnc.parameter_pack(version).tables()
+        tables = [(name, np.asarray(all_tables.pop(name), dtype='float64')) for name in MATRIX_TABLES]
+
+        layout = []
+        offset = 0
+        for name, table in tables:
+            layout.append((name, offset, table.shape))
+            offset += table.nbytes
+
+        block = shared_memory.SharedMemory(create=True, size=offset)
+        for (name, start, shape), (_, table) in zip(layout, tables):
+            np.ndarray(shape, dtype='float64', buffer=block.buf, offset=start)[...] = table
+
+        self.blocks.append(block)
+        self.handles.append(SharedPackHandle(version, block.name, tuple(layout), all_tables))
+        LOGGER.debug("Published parameter pack %s in shared memory %s (%d bytes)", version, block.name, offset)
+
+    def close(self) -> None:
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self) -> SharedParameterPacks:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+
+# Kept referenced for the life of the process so the mapped views stay valid
+_ATTACHED: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def attach_parameter_packs(handles: Iterable[SharedPackHandle]) -> None:
+    """Install read-only views of published packs as this process's parameter packs.
+
+    A forked worker already holds its parent's packs, with their labelled
+    matrices and resolvers, and keeps them.
+    """
+    for handle in handles:
+        if wnc.loaded_parameter_pack(handle.version) is not None:
+            continue
+        block = _ATTACHED.get(handle.block) or shared_memory.SharedMemory(name=handle.block)
+        _ATTACHED[handle.block] = block
+
+        tables = dict(handle.tables)
+        for name, offset, shape in handle.layout:
+            view = np.ndarray(shape, dtype='float64', buffer=block.buf, offset=offset)
+            view.flags.writeable = False
+            tables[name] = view
+        wnc.install_parameter_pack(wnc.ParameterPack(handle.version, tables=tables))
+        LOGGER.debug("Attached parameter pack %s from shared memory %s", handle.version, handle.block)
@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+
+from . import utils
+
+
+LOGGER = logging.getLogger(__name__)
+
+INDEX_FILE = "index.json"
+SNAPSHOT_FORMAT = 1
+
+
+def _json_value(value: Any) -> Any:
+    """Plain Python value of a dictionary entry (numpy scalars are not JSON serializable)."""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _column_file(position: int, suffix: str) -> str:
+    return f"col{position:03d}_{suffix}.npy"
+
+
+@dataclass
+class SensitivitySnapshot:
+    """Netted CRIF state loaded from a snapshot directory.
+
+    Numeric columns are stored as-is and text columns as integer codes
+    into a dictionary kept in the index, so a load is a handful of
+    ``np.load`` calls. With ``mmap_mode='r'`` the arrays are read-only
+    views of the files and processes opening the same snapshot share the
+    pages through the OS cache.
+    """
+
+    path: Path
+    index: Dict[str, Any]
+    arrays: Dict[str, np.ndarray]
+
+    @property
+    def columns(self) -> List[str]:
+        return [column['name'] for column in self.index['columns']]
+
+    @property
+    def input_hash(self) -> str:
+        """Hash of the CRIF the snapshot was taken from (see utils.input_hash)."""
+        return self.index['input_hash']
+
+    def __len__(self) -> int:
+        return int(self.index['rows'])
+
+    def to_crif(self) -> pd.DataFrame:
+        """Netted CRIF frame, decoded with array lookups (no parsing)."""
+        data: Dict[str, Any] = {}
+        for column in self.index['columns']:
+            codes = self.arrays[column['name']]
+            if column['kind'] == 'numeric':
+                data[column['name']] = codes
+                continue
+            # Trailing NaN slot for missing values (code -1)
+            values = np.empty(len(column['values']) + 1, dtype=object)
+            values[:-1] = column['values']
+            values[-1] = np.nan
+            data[column['name']] = values[codes]
+        return pd.DataFrame(data, columns=self.columns)
+
+
+# Persist the netted sensitivities of a CRIF as .npy arrays plus a JSON index
+def save_snapshot(crif: pd.DataFrame, path: str | Path) -> Path:
+    """Net a CRIF and write it as a memory-mappable snapshot directory."""
+    path = Path(path)
+    netted = utils.net_sensitivities(crif)
+
+    columns = []
+    arrays: Dict[str, np.ndarray] = {}
+    for position, name in enumerate(netted.columns):
+        series = netted[name]
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            file_name = _column_file(position, 'values')
+            arrays[file_name] = series.to_numpy()
+            columns.append({'name': name, 'kind': 'numeric', 'file': file_name})
+        else:
+            codes, uniques = pd.factorize(series, use_na_sentinel=True)
+            file_name = _column_file(position, 'codes')
+            arrays[file_name] = codes.astype('int32')
+            columns.append({'name': name, 'kind': 'dictionary', 'file': file_name,
+                            'values': [_json_value(value) for value in uniques]})
+
+    index = {
+        'format': SNAPSHOT_FORMAT,
+        'rows': len(netted),
+        'source_rows': len(crif),
+        'input_hash': utils.input_hash(crif),
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'columns': columns,
+    }
+
+    # Write next to the target and swap in, so readers never see a half-written snapshot
+    path.parent.mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(prefix=f".{path.name}.", dir=path.parent))
+    try:
+        for file_name, array in arrays.items():
+            np.save(staging / file_name, array, allow_pickle=False)
+        (staging / INDEX_FILE).write_text(json.dumps(index, indent=2))
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(staging, path)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    LOGGER.info("Saved snapshot of %d netted rows (%d CRIF rows) to %s", len(netted), len(crif), path)
+    return path
+
+
+def load_snapshot(path: str | Path, mmap_mode: str | None = 'r') -> SensitivitySnapshot:
+    """Open a snapshot directory; arrays are memory-mapped unless mmap_mode is None."""
+    path = Path(path)
+    index = json.loads((path / INDEX_FILE).read_text())
+    if index.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unsupported snapshot format {index.get('format')} in {path}.")
+
+    arrays = {
+        column['name']: np.load(path / column['file'], mmap_mode=mmap_mode, allow_pickle=False)
+        for column in index['columns']
+    }
+    return SensitivitySnapshot(path, index, arrays)
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+import pandas as pd
+
+from . import utils
+from . import wnc
+from .agg_margins import SIMM, directional_risk_class_margins
+from .bucket_cache import BucketCache
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Collect: the CRIF as given; post: the counterparty's view, every sensitivity negated
+SIDE_DIRECTIONS = {'collect': 1, 'post': -1}
+
+
+def negate_sensitivities(crif: pd.DataFrame) -> pd.DataFrame:
+    """CRIF with the Risk_* amounts negated; add-on, multiplier and notional rows are kept as they are."""
+    negated = crif.copy()
+    sensitivities = negated['RiskType'].astype(str).str.startswith('Risk_')
+    for column in ('Amount', 'AmountUSD'):
+        if column in negated.columns:
+            negated.loc[sensitivities, column] = -negated.loc[sensitivities, column]
+    return negated
+
+
+@dataclass
+class TwoSidedSIMM:
+    """SIMM of the collect side and the post side of one portfolio."""
+
+    collect: SIMM
+    post: SIMM
+
+    @property
+    def results(self) -> pd.DataFrame:
+        """Total SIMM by side."""
+        return pd.DataFrame({'SIMM': [self.collect.simm, self.post.simm]}, index=pd.Index(list(SIDE_DIRECTIONS), name='Side'))
+
+
+def two_sided_simm(
+    crif: pd.DataFrame,
+    calculation_currency: str,
+    exchange_rate: float,
+    bucket_cache: Optional[BucketCache] = None,
+    parameters: Optional[wnc.ParameterPack] = None,
+) -> TwoSidedSIMM:
+    """Calculate the collect and post SIMM of a CRIF in one pass.
+
+    Delta, vega and base correlation margins are shared by both sides and
+    curvature reuses its bucket results; only the curvature totals, the
+    product class sums and the add-ons are evaluated per side. ``post.crif``
+    is the negated CRIF, so ``SIMM(post.crif, ...)`` gives the same result.
+    """
+    margins = {
+        product_class: directional_risk_class_margins(
+            crif[crif['ProductClass'] == product_class], calculation_currency, bucket_cache, parameters,
+            directions=tuple(SIDE_DIRECTIONS.values()),
+        )
+        for product_class in utils.product_list(crif)
+    }
+
+    sides = {}
+    for side, direction in SIDE_DIRECTIONS.items():
+        sides[side] = SIMM(
+            crif if direction == 1 else negate_sensitivities(crif),
+            calculation_currency,
+            exchange_rate,
+            bucket_cache=bucket_cache,
+            parameters=parameters,
+            risk_class_margins={product_class: by_direction[direction] for product_class, by_direction in margins.items()},
+        )
+
+    LOGGER.info("Two-sided SIMM: collect %s, post %s", sides['collect'].simm, sides['post'].simm)
+    return TwoSidedSIMM(**sides)
@@ -1,24 +1,127 @@
 from __future__ import annotations
 
+import hashlib
 import logging
 import math
-from typing import Iterable, List, Sequence
+from typing import Iterable, List, Optional, Sequence, Tuple
 
-from . import simm_tenor_list
+import numpy as np
+import pandas as pd
+
+from . import (
+    simm_tenor_list,
+    list_rates,
+    list_fx,
+    list_creditQ,
+    list_credit_nonQ,
+    list_equity,
+    list_commodity,
+)
 
 # Calculate Concentration Threshold
 LOGGER = logging.getLogger(__name__)
 
+# Standard normal quantiles used by vega and curvature (scipy.stats.norm.ppf(0.99) and .ppf(0.995)),
+# precomputed so that the engine does not import scipy.stats
+NORM_PPF_99 = 2.3263478740408408
+NORM_PPF_995 = 2.5758293035489004
+
+# Columns that determine the margin of a CRIF subset
+DIGEST_COLUMNS = ['RiskType', 'Qualifier', 'Bucket', 'Label1', 'Label2', 'AmountUSD']
+
+# Columns read by the margin engine; trade ids, Amount, AmountCurrency, ... are not needed
+ENGINE_COLUMNS = ['ProductClass'] + DIGEST_COLUMNS
+
+# Rows per chunk when a CRIF file is read in low-memory mode
+CRIF_CHUNK_ROWS = 500000
+
 
 def concentration_threshold(sum_s: float, T: float) -> float:
     """Calculate the concentration threshold."""
     return float(max(1, math.sqrt(abs(sum_s) / T)))
 
+# Curvature theta; no curvature exposure (e.g. only bucket 12 equities) gives 0
+def curvature_theta(cvr_sum: float, cvr_abs_sum: float) -> float:
+    """Calculate theta = min(sum(CVR) / sum(|CVR|), 0) for curvature margin."""
+    if cvr_abs_sum == 0:
+        return 0.0
+    return min(cvr_sum / cvr_abs_sum, 0)
+
 # Sum Sensitivities(AmountUSD) from CRIF
 def sum_sensitivities(crif) -> float:
     """Sum the AmountUSD column for a CRIF subset."""
     return crif['AmountUSD'].sum()
 
+# Net CRIF rows that only differ by amount (same product class, risk factor and currency)
+def net_sensitivities(crif) -> pd.DataFrame:
+    """Sum Amount/AmountUSD over rows sharing every other column, keeping first-seen order."""
+    amount_columns = [column for column in ('Amount', 'AmountUSD') if column in crif.columns]
+    keys = [column for column in crif.columns if column not in amount_columns]
+    if not keys or not amount_columns:
+        return crif.reset_index(drop=True)
+
+    netted = crif.groupby(keys, dropna=False, sort=False)[amount_columns].sum(min_count=1).reset_index()
+    return netted[list(crif.columns)]
+
+# Net a CRIF down to the engine columns, one row per product class and risk factor
+def aggregate_sensitivities(crif) -> pd.DataFrame:
+    """Sum AmountUSD by product class and risk factor, with the rows of each product class contiguous.
+
+    Only ENGINE_COLUMNS are kept. Product classes come in first-seen order,
+    so a product class is a row slice (a view) of the result.
+    """
+    columns = [column for column in ENGINE_COLUMNS if column in crif.columns]
+    keys = [column for column in columns if column != 'AmountUSD']
+    aggregated = crif.groupby(keys, dropna=False, sort=False)['AmountUSD'].sum(min_count=1).reset_index()[columns]
+    if 'ProductClass' not in aggregated.columns:
+        return aggregated
+
+    product_codes, _ = pd.factorize(aggregated['ProductClass'], use_na_sentinel=False)
+    return aggregated.iloc[np.argsort(product_codes, kind='stable')].reset_index(drop=True)
+
+# Read a CRIF file; in low-memory mode chunk by chunk so the raw rows are never all in memory
+def read_crif(path, low_memory: bool = False, chunk_rows: int = CRIF_CHUNK_ROWS) -> pd.DataFrame:
+    """Read a CRIF csv, or only its netted engine columns (see aggregate_sensitivities) with low_memory."""
+    if not low_memory:
+        return pd.read_csv(path, header=0)
+
+    # Key columns stay text so that every chunk parses them the same way
+    read = lambda **options: pd.read_csv(
+        path, header=0, usecols=lambda column: column in ENGINE_COLUMNS,
+        dtype={column: object for column in ENGINE_COLUMNS if column != 'AmountUSD'}, **options,
+    )
+    chunks = [aggregate_sensitivities(chunk) for chunk in read(chunksize=chunk_rows)]
+    if not chunks:
+        return read(nrows=0)
+    return aggregate_sensitivities(pd.concat(chunks, ignore_index=True))
+
+# Hash of the margin-relevant columns of each CRIF row
+def row_hashes(crif) -> pd.Series:
+    """Hash the margin-relevant columns of each CRIF row."""
+    columns = [column for column in DIGEST_COLUMNS if column in crif.columns]
+    return pd.util.hash_pandas_object(crif[columns], index=False)
+
+# Content digest of a CRIF subset (row order matters, the index does not)
+def crif_digest(crif, hashes: Optional[pd.Series] = None) -> str:
+    """Digest a CRIF subset, optionally from row hashes precomputed on its parent frame (then its index is enough)."""
+    index = crif if isinstance(crif, pd.Index) else crif.index
+    if hashes is None:
+        hashed = row_hashes(crif).to_numpy()
+    elif isinstance(hashes.index, pd.RangeIndex) and hashes.index.start == 0 and hashes.index.step == 1:
+        # Labels are positions: index the hash array directly instead of a label lookup
+        hashed = hashes.to_numpy()[index.to_numpy()]
+    else:
+        hashed = hashes.loc[index].to_numpy()
+    return hashlib.blake2b(hashed.tobytes(), digest_size=16).hexdigest()
+
+# Hash of a whole CRIF input (every column, row order matters), used to key stored results
+def input_hash(crif) -> str:
+    """Digest the full content of a CRIF input."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update('|'.join(map(str, crif.columns)).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(crif, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
 # Extract tenors as a list from CRIF
 def tenor_list(crif) -> List[str]:
     """Extract tenors as a normalized list."""
@@ -35,19 +138,26 @@ def unique_list(x, column: str | None = None) -> List:
     # pandas.dataframe
     return x[column].unique().tolist()
 
-# Extract currency pairs from CRIF as a list
-def currencyPair_list(crif) -> List[str]:
-    """Extract currency pairs from CRIF as a list."""
-    currencyPair = [x for x in list(crif['Qualifier']) if (str(x) != 'nan' and len(str(x)) == 6)]
-    currencyPair_list = []
+# Canonical index of FX currency pairs: KRWUSD and USDKRW form one group
+def fx_pair_groups(qualifiers: Iterable[object]) -> Tuple[np.ndarray, List[str]]:
+    """Group code of each qualifier (-1 if it is not a currency pair) and the first-seen pair of each group."""
+    values = pd.Series(np.asarray(qualifiers, dtype=object), dtype=object)
+    is_pair = (values.str.len() == 6).fillna(False).to_numpy(dtype=bool)
+    pairs = values[is_pair]
 
-    # Prevent from containing duplicates
-    # e.g. KRWUSD is considered to be indentical with USDKRW
-    for pair in currencyPair:
-        if pair[3:]+pair[:3] not in currencyPair_list:
-            currencyPair_list.append(pair)
+    first, second = pairs.str[:3], pairs.str[3:]
+    canonical = np.where(first <= second, first + second, second + first)
+    pair_codes, _ = pd.factorize(canonical)
 
-    return list(set(currencyPair_list))
+    codes = np.full(len(values), -1, dtype='int64')
+    codes[is_pair] = pair_codes
+    _, first_seen = np.unique(pair_codes, return_index=True)
+    return codes, pairs.to_numpy()[first_seen].tolist()
+
+# Extract currency pairs from CRIF as a list
+def currencyPair_list(crif) -> List[str]:
+    """Extract currency pairs from CRIF as a list (one per pair, e.g. KRWUSD is identical to USDKRW)."""
+    return fx_pair_groups(crif['Qualifier'])[1]
 
 # Extract product classes from CRIF
 def product_list(crif) -> List[str]:
@@ -55,6 +165,21 @@ def product_list(crif) -> List[str]:
     product_list = [x for x in list(crif['ProductClass']) if (str(x) != 'nan')]
     return list(set(product_list))     
 
+# Risk class of a CRIF risk type ('AddOn' for the add-on and multiplier rows)
+def risk_class_of(risk_type: str) -> str:
+    """Map a CRIF risk type to its SIMM risk class."""
+    for risk_class, risk_types in (
+        ('Rates', list_rates),
+        ('FX', list_fx),
+        ('CreditQ', list_creditQ),
+        ('CreditNonQ', list_credit_nonQ),
+        ('Equity', list_equity),
+        ('Commodity', list_commodity),
+    ):
+        if risk_type in risk_types:
+            return risk_class
+    return 'AddOn'
+
 # Extract buckets from CRIF
 def bucket_list(df) -> List[int]:
     """Extract bucket list with residual handling."""
@@ -82,3 +207,13 @@ def scaling_func(t: str) -> float:
         return 0.5 * min(1, 14 / t)
     LOGGER.debug("Unhandled tenor %s; defaulting scale to 0.0.", t)
     return 0.0
+
+# Curvature scaling factor of each SIMM tenor, computed once
+SCALING_BY_TENOR = {tenor: scaling_func(tenor) for tenor in simm_tenor_list}
+
+# Curvature scaling factors of a whole Label1 column
+def scaling_factors(tenors: Iterable[str]) -> np.ndarray:
+    """Scaling function of each tenor label, evaluated once per distinct label."""
+    codes, labels = pd.factorize(np.asarray(tenors, dtype=object), use_na_sentinel=False)
+    factors = np.array([SCALING_BY_TENOR[label] if label in SCALING_BY_TENOR else scaling_func(label) for label in labels], dtype='float64')
+    return factors[codes]
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+import pandas as pd
+
+from . import utils
+from . import wnc
+from .agg_margins import SIMM, margin_rows
+from .bucket_cache import BucketCache
+
+
+LOGGER = logging.getLogger(__name__)
+
+INDEX_COLUMNS = ['Product Class', 'Risk Class', 'Risk Measure']
+ALL = 'All'
+
+
+@dataclass
+class VersionComparison:
+    """SIMM of one portfolio under several parameter versions.
+
+    ``breakdown`` has one row per product class / risk class / risk measure
+    (``'All'`` marks the subtotals, ``'Total'`` the portfolio total including
+    add-ons), one column per version, and one ``'<version> - <base>'`` column
+    per non-base version.
+    """
+
+    versions: List[str]
+    totals: pd.Series
+    breakdown: pd.DataFrame
+    portfolios: Dict[str, SIMM] = field(default_factory=dict, repr=False)
+
+    @property
+    def base_version(self) -> str:
+        return self.versions[0]
+
+    def deltas(self) -> pd.DataFrame:
+        """Only the change columns of the breakdown."""
+        return self.breakdown[[delta_column(version, self.base_version) for version in self.versions[1:]]]
+
+
+def delta_column(version: str, base_version: str) -> str:
+    """Name of the column holding the change from the base version."""
+    return f"{version} - {base_version}"
+
+
+def compare_versions(
+    crif: pd.DataFrame,
+    calculation_currency: str,
+    exchange_rate: float,
+    versions: Sequence[str] = ('v2_6', wnc.DEFAULT_VERSION),
+    bucket_cache: Optional[BucketCache] = None,
+) -> VersionComparison:
+    """Calculate SIMM under each version in ``versions`` (the first is the base).
+
+    The CRIF is netted once and shared by all runs; only the bucket kernels
+    and the aggregation are evaluated per parameter pack.
+    """
+    versions = list(versions)
+    if not versions:
+        raise ValueError("At least one SIMM version is required.")
+
+    netted = utils.net_sensitivities(crif)
+    LOGGER.info("Comparing SIMM versions %s on %d netted CRIF rows (%d input rows).", versions, len(netted), len(crif))
+
+    portfolios: Dict[str, SIMM] = {}
+    columns: Dict[str, Dict[tuple, float]] = {}
+    for version in versions:
+        portfolio = SIMM(
+            netted,
+            calculation_currency,
+            exchange_rate,
+            bucket_cache=bucket_cache,
+            parameters=wnc.parameter_pack(version),
+        )
+        portfolios[version] = portfolio
+        columns[version] = margin_rows(portfolio)
+
+    breakdown = pd.DataFrame(columns).fillna(0.0)
+    breakdown.index.names = INDEX_COLUMNS
+
+    # Risk classes / measures with no exposure under any version are left out
+    breakdown = breakdown[(breakdown != 0).any(axis=1) | (breakdown.index.get_level_values('Risk Class') == ALL)]
+
+    base_version = versions[0]
+    for version in versions[1:]:
+        breakdown[delta_column(version, base_version)] = breakdown[version] - breakdown[base_version]
+
+    totals = pd.Series({version: portfolios[version].simm for version in versions}, name='SIMM')
+    return VersionComparison(versions, totals, breakdown.round(2), portfolios)
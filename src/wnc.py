@@ -1,196 +1,281 @@
 from __future__ import annotations
 
+import importlib
 import logging
-from typing import Optional
+import pkgutil
+import threading
+from types import ModuleType
+from typing import TYPE_CHECKING, Any, Dict, List, Mapping, Optional
 
-import pandas as pd
-
-from Weights_and_Corr.v2_7 import *
 from . import (
     list_creditQ,
     list_credit_nonQ,
     list_equity,
     list_commodity,
     list_rates,
-    list_fx,
     simm_tenor_list,
 )
 
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+    from .resolvers import ParameterResolver
+
 
 LOGGER = logging.getLogger(__name__)
 
+DEFAULT_VERSION = 'v2_7'
+
+
+class ParameterPack:
+    """Risk weights, correlations and thresholds of one SIMM version.
+
+    Wraps a module of ``Weights_and_Corr`` (e.g. ``v2_6``) so several
+    versions can be evaluated in the same process. Parameter tables are
+    exposed as attributes (``pack.inflation_rw``) and the lookups below
+    mirror the module-level helpers of ``wnc``.
+
+    ``tables`` supplies every parameter table instead of the version module,
+    which is then not imported, e.g. tables attached from shared memory (see
+    ``shared_params``).
+    """
+
+    def __init__(self, version: str = DEFAULT_VERSION, tables: Optional[Mapping[str, Any]] = None) -> None:
+        self.version = version
+        self.module: Optional[ModuleType] = None if tables is not None else importlib.import_module(f"Weights_and_Corr.{version}")
+        self._tables: Dict[str, Any] = dict(tables or {})
+        self._matrices: Dict[str, pd.DataFrame] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for names not set on the instance: delegate to the parameter tables
+        if name in ('module', '_tables'):
+            raise AttributeError(name)
+        if name in self._tables:
+            return self._tables[name]
+        if self.module is None:
+            raise AttributeError(f"Parameter pack {self.version} has no table {name!r}")
+        return getattr(self.module, name)
+
+    def tables(self) -> Dict[str, Any]:
+        """Every parameter table of the pack by name."""
+        if self.module is None:
+            return dict(self._tables)
+        return {
+            name: value for name, value in vars(self.module).items()
+            if not name.startswith('_') and not isinstance(value, ModuleType) and not callable(value)
+        }
+
+    def __repr__(self) -> str:
+        return f"ParameterPack({self.version!r})"
+
+    # Correlation tables are labelled once per pack rather than on every lookup
+    def _matrix(self, name: str, labels: List[str]) -> pd.DataFrame:
+        if name not in self._matrices:
+            import pandas as pd
+
+            if self.module is None:
+                # Label the array in place: shared tables must not be copied per process
+                matrix = pd.DataFrame(self._tables[name], columns=labels, index=labels, copy=False)
+            else:
+                matrix = pd.DataFrame(getattr(self.module, name), columns=labels, index=labels)
+            # Threads racing on the first lookup all keep the frame stored first
+            self._matrices.setdefault(name, matrix)
+        return self._matrices[name]
 
-def RW(risk_class: str, bucket: int) -> float:
-    """Return risk weight for a risk class and bucket."""
-    if risk_class in list_creditQ:
-        return creditQ_rw[bucket]
-        
-    elif risk_class in list_credit_nonQ:
-        return creiditNonQ_rw[bucket]
 
-    elif risk_class in list_equity:
-        return equity_rw[bucket]
 
-    elif risk_class in list_commodity:
-        return commodity_rw[bucket]
-    raise KeyError(f"Unsupported risk class for RW: {risk_class}")
+    @property
+    def resolver(self) -> ParameterResolver:
+        """Hash-table lookups of risk weights and thresholds, built on first use."""
+        if '_resolver' not in self.__dict__:
+            from .resolvers import ParameterResolver
 
-def rho(
-    risk_class: str,
-    index1: Optional[str] = None,
-    index2: Optional[str] = None,
-    bucket: Optional[int] = None,
-) -> float:
-    """Return correlation for the requested inputs."""
+            self.__dict__.setdefault('_resolver', ParameterResolver(self))
+        return self._resolver
 
-    if risk_class in list_rates:
-        return pd.DataFrame(
-            ir_corr,
-            columns=simm_tenor_list,
-            index=simm_tenor_list
-        )[index1][index2]
+    def RW(self, risk_class: str, bucket: int) -> float:
+        """Return risk weight for a risk class and bucket."""
+        return self.resolver.risk_weight(risk_class, bucket)
 
-    elif risk_class in list_creditQ:
+    def rho(
+        self,
+        risk_class: str,
+        index1: Optional[str] = None,
+        index2: Optional[str] = None,
+        bucket: Optional[int] = None,
+    ) -> float:
+        """Return correlation for the requested inputs."""
 
-        if risk_class == 'Risk_BaseCorr':
-            return float(creditQ_corr[3])
+        if risk_class in list_rates:
+            return self._matrix('ir_corr', simm_tenor_list)[index1][index2]
 
-        elif (index1 == 'Res') or (index2 == 'Res'):
-            rho = creditQ_corr[2]
-        elif index1 == index2:
-            rho = creditQ_corr[0]
-        else:
-            rho = creditQ_corr[1]
-        return float(rho)
-
-    elif risk_class in list_credit_nonQ:
-        if (index1 == 'Res') or (index2 == 'Res'):
-            rho = creditNonQ_corr[2]
-        elif index1 == index2:
-            rho = creditNonQ_corr[0]
-        else:
-            rho = creditNonQ_corr[1]
-        return rho
+        elif risk_class in list_creditQ:
+
+            if risk_class == 'Risk_BaseCorr':
+                return float(self.creditQ_corr[3])
 
-    elif risk_class in list_equity:
-        return equity_corr[bucket]
+            elif (index1 == 'Res') or (index2 == 'Res'):
+                rho = self.creditQ_corr[2]
+            elif index1 == index2:
+                rho = self.creditQ_corr[0]
+            else:
+                rho = self.creditQ_corr[1]
+            return float(rho)
 
-    elif risk_class in list_commodity:
-        return commodity_corr[bucket]
-    raise KeyError(f"Unsupported risk class for rho: {risk_class}")
+        elif risk_class in list_credit_nonQ:
+            if (index1 == 'Res') or (index2 == 'Res'):
+                rho = self.creditNonQ_corr[2]
+            elif index1 == index2:
+                rho = self.creditNonQ_corr[0]
+            else:
+                rho = self.creditNonQ_corr[1]
+            return rho
 
-def gamma(
-    risk_class: str,
-    bucket1: Optional[str] = None,
-    bucket2: Optional[str] = None,
-) -> float:
-    """Return gamma (cross-bucket correlation) for the risk class."""
+        elif risk_class in list_equity:
+            return self.equity_corr[bucket]
 
-    if risk_class in list_creditQ:
-        bucket_list = [str(i) for i in range(1,13)]
-        return pd.DataFrame(
-            creditQ_corr_non_res,
-            columns=bucket_list,
-            index=bucket_list
-        )[bucket1][bucket2]
-
-    elif risk_class in list_credit_nonQ:
-        return cr_gamma_diff_ccy
-
-    elif risk_class in list_equity:
-        bucket_list = [str(i) for i in range(1,13)]
-        return pd.DataFrame(
-            equity_corr_non_res,
-            columns=bucket_list,
-            index=bucket_list            
-        )[bucket1][bucket2]
-
-    elif risk_class in list_commodity:
-        bucket_list = [str(i) for i in range(1,18)]
-        return pd.DataFrame(
-            commodity_corr_non_res,
-            columns=bucket_list,
-            index=bucket_list,
-        )[bucket1][bucket2]
-    raise KeyError(f"Unsupported risk class for gamma: {risk_class}")
+        elif risk_class in list_commodity:
+            return self.commodity_corr[bucket]
+        raise KeyError(f"Unsupported risk class for rho: {risk_class}")
 
-def T(risk_class: str, type: str, currency: Optional[str] = None, bucket: Optional[int] = None) -> float:
-    """Return concentration thresholds for the risk class."""
-    if type == 'Delta':
-        if risk_class == 'Rates':
-            try:
-                T = ir_delta_CT[currency]
-            except KeyError:
-                T = ir_delta_CT['Others']
+    def gamma(
+        self,
+        risk_class: str,
+        bucket1: Optional[str] = None,
+        bucket2: Optional[str] = None,
+    ) -> float:
+        """Return gamma (cross-bucket correlation) for the risk class."""
 
-        elif risk_class in list_creditQ:
-            T = credit_delta_CT['Qualifying'][bucket]
+        if risk_class in list_creditQ:
+            bucket_list = [str(i) for i in range(1,13)]
+            return self._matrix('creditQ_corr_non_res', bucket_list)[bucket1][bucket2]
 
         elif risk_class in list_credit_nonQ:
-            T = credit_delta_CT['Non-Qualifying'][bucket]
+            return self.cr_gamma_diff_ccy
 
         elif risk_class in list_equity:
-            T = equity_delta_CT[bucket]                   
+            bucket_list = [str(i) for i in range(1,13)]
+            return self._matrix('equity_corr_non_res', bucket_list)[bucket1][bucket2]
 
         elif risk_class in list_commodity:
-            T = commodity_delta_CT[bucket]
+            bucket_list = [str(i) for i in range(1,18)]
+            return self._matrix('commodity_corr_non_res', bucket_list)[bucket1][bucket2]
+        raise KeyError(f"Unsupported risk class for gamma: {risk_class}")
 
-        elif risk_class in list_fx:
-            if currency in fx_category1:
-                T = fx_delta_CT['Category1']
-            elif currency in fx_category2:
-                T = fx_delta_CT['Category2']
-            else:
-                T = fx_delta_CT['Others']
-         
-    elif type == 'Vega':
-        if risk_class == 'Rates':
-            try:
-                T = ir_vega_CT[currency]
-            except KeyError:
-                T = ir_vega_CT['Others']
-                
-        elif risk_class in list_creditQ:
-            T = credit_vega_CT['Qualifying']
+    def tenor_correlation_matrix(self) -> np.ndarray:
+        """Matrix of rho('Risk_IRCurve', t1, t2) over simm_tenor_list."""
+        # rho(t1, t2) reads column t1, row t2
+        return self._matrix('ir_corr', simm_tenor_list).to_numpy(dtype='float64').T
 
-        elif risk_class in list_credit_nonQ:
-            T = credit_vega_CT['Non-Qualifying']
+    def gamma_matrix(self, risk_class: str, buckets: List[int]) -> np.ndarray:
+        """Matrix of gamma(b, c) over the given (non-residual) buckets."""
+        import numpy as np
 
-        elif risk_class in list_equity:
-            T = equity_vega_CT[bucket]         
+        if risk_class in list_credit_nonQ:
+            return np.full((len(buckets), len(buckets)), self.cr_gamma_diff_ccy, dtype='float64')
 
+        if risk_class in list_creditQ:
+            matrix = self._matrix('creditQ_corr_non_res', [str(i) for i in range(1,13)])
+        elif risk_class in list_equity:
+            matrix = self._matrix('equity_corr_non_res', [str(i) for i in range(1,13)])
         elif risk_class in list_commodity:
-            T = commodity_vega_CT[bucket]
+            matrix = self._matrix('commodity_corr_non_res', [str(i) for i in range(1,18)])
+        else:
+            raise KeyError(f"Unsupported risk class for gamma: {risk_class}")
+        # Buckets 1..n label the rows and columns in order: take them by position instead of .loc
+        positions = np.asarray(buckets, dtype='int64') - 1
+        if len(positions) and (positions.min() < 0 or positions.max() >= len(matrix)):
+            raise KeyError(f"Unsupported buckets for gamma: {buckets}")
+        # gamma(b, c) reads column b, row c
+        return matrix.to_numpy(dtype='float64')[np.ix_(positions, positions)].T
+
+    def T(self, risk_class: str, type: str, currency: Optional[str] = None, bucket: Optional[int] = None) -> float:
+        """Return concentration thresholds for the risk class."""
+        T = self.resolver.threshold(risk_class, type, currency, bucket)
+        LOGGER.debug("Threshold lookup for %s/%s computed: %s", risk_class, type, T)
+        return T
+
+    def psi(self, risk_class1: str, risk_class2: str) -> float:
+        """Return cross-risk-class correlation parameter."""
+        return self._matrix('corr_params', ['Rates','CreditQ','CreditNonQ','Equity','Commodity','FX'])[risk_class1][risk_class2]
+
+
+# Packs installed by the process (e.g. attached from shared memory) take precedence over loaded ones
+_INSTALLED_PACKS: Dict[str, ParameterPack] = {}
+
+
+def install_parameter_pack(pack: ParameterPack) -> None:
+    """Make ``parameter_pack(pack.version)`` return ``pack`` in this process."""
+    _INSTALLED_PACKS[pack.version] = pack
 
-        elif risk_class in list_fx:
-            currency1 = currency[0:3]
-            currency2 = currency[3:6]
 
-            if (currency1 in fx_category1) and (currency2 in fx_category1):
-                T = fx_vega_CT['Category1-Category1']
+# Packs loaded from their version module; the lock makes threads asking for the same version share one pack
+_LOADED_PACKS: Dict[str, ParameterPack] = {}
+_LOAD_LOCK = threading.Lock()
 
-            elif ((currency1 in fx_category1) and (currency2 in fx_category2)) or ((currency1 in fx_category2) and (currency2 in fx_category1)):
-                T = fx_vega_CT['Category1-Category2']
 
-            elif ((currency1 in fx_category1) and (currency2 not in fx_category1+fx_category2)) or ((currency1 not in fx_category1+fx_category2) and (currency2 in fx_category1)):
-                T = fx_vega_CT['Category1-Category3']
+def loaded_parameter_pack(version: str) -> Optional[ParameterPack]:
+    """The pack of a SIMM version this process already holds (e.g. inherited from its parent), if any."""
+    return _INSTALLED_PACKS.get(version) or _LOADED_PACKS.get(version)
 
-            elif (currency1 in fx_category2) and (currency2 in fx_category2):
-                T = fx_vega_CT['Category2-Category2']
 
-            elif ((currency1 in fx_category2) and (currency2 not in fx_category1+fx_category2)) or ((currency1 not in fx_category1+fx_category2) and (currency2 in fx_category2)):
-                T = fx_vega_CT['Category2-Category3']
+def parameter_pack(version: str = DEFAULT_VERSION) -> ParameterPack:
+    """Return the (shared) parameter pack of a SIMM version, e.g. 'v2_6'."""
+    pack = loaded_parameter_pack(version)
+    if pack is None:
+        with _LOAD_LOCK:
+            pack = _LOADED_PACKS.get(version)
+            if pack is None:
+                LOGGER.debug("Loading SIMM parameter pack %s", version)
+                pack = _LOADED_PACKS[version] = ParameterPack(version)
+    return pack
 
-            elif (currency1 not in fx_category1+fx_category2) and (currency2 not in fx_category1+fx_category2):
-                T = fx_vega_CT['Category3-Category3']
 
-    LOGGER.debug("Threshold lookup for %s/%s computed: %s", risk_class, type, T)
-    return T * 1000000
+def available_versions() -> List[str]:
+    """List the SIMM versions shipped in Weights_and_Corr."""
+    package = importlib.import_module("Weights_and_Corr")
+    return sorted(module.name for module in pkgutil.iter_modules(package.__path__) if module.name.startswith('v'))
+
+
+# The default pack and its tables (wnc.DEFAULT_PACK, wnc.inflation_rw, ...) are loaded on first use
+def __getattr__(name: str) -> Any:
+    if name.startswith('__'):
+        raise AttributeError(name)
+    pack = parameter_pack(DEFAULT_VERSION)
+    if name == 'DEFAULT_PACK':
+        return pack
+    try:
+        return getattr(pack, name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+
+
+def RW(risk_class: str, bucket: int) -> float:
+    """Return risk weight for a risk class and bucket."""
+    return parameter_pack(DEFAULT_VERSION).RW(risk_class, bucket)
+
+def rho(
+    risk_class: str,
+    index1: Optional[str] = None,
+    index2: Optional[str] = None,
+    bucket: Optional[int] = None,
+) -> float:
+    """Return correlation for the requested inputs."""
+    return parameter_pack(DEFAULT_VERSION).rho(risk_class, index1, index2, bucket)
+
+def gamma(
+    risk_class: str,
+    bucket1: Optional[str] = None,
+    bucket2: Optional[str] = None,
+) -> float:
+    """Return gamma (cross-bucket correlation) for the risk class."""
+    return parameter_pack(DEFAULT_VERSION).gamma(risk_class, bucket1, bucket2)
+
+def T(risk_class: str, type: str, currency: Optional[str] = None, bucket: Optional[int] = None) -> float:
+    """Return concentration thresholds for the risk class."""
+    return parameter_pack(DEFAULT_VERSION).T(risk_class, type, currency, bucket)
 
 def psi(risk_class1: str, risk_class2: str) -> float:
     """Return cross-risk-class correlation parameter."""
-    return pd.DataFrame(
-        corr_params,
-        columns = ['Rates','CreditQ','CreditNonQ','Equity','Commodity','FX'],
-        index   = ['Rates','CreditQ','CreditNonQ','Equity','Commodity','FX']
-    )[risk_class1][risk_class2]
+    return parameter_pack(DEFAULT_VERSION).psi(risk_class1, risk_class2)